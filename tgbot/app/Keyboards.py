@@ -18,8 +18,28 @@ def admin_keyboard():
             [KeyboardButton(text="📊 Статистика")],
             [KeyboardButton(text="📢 Рассылка")],
             [KeyboardButton(text="📜 Логи")],
-            [KeyboardButton(text="🔑 Сменить API")]
+            [KeyboardButton(text="🔑 Сменить API")],
+            [KeyboardButton(text="📈 Аналитика")]
         ],
         resize_keyboard=True
 
     )
+
+
+def logs_keyboard():
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="За час", callback_data="logs:3600"),
+             InlineKeyboardButton(text="За сутки", callback_data="logs:86400")],
+            [InlineKeyboardButton(text="За неделю", callback_data="logs:604800"),
+             InlineKeyboardButton(text="Всё", callback_data="logs:0")],
+        ]
+    )
+
+
+def key_pool_keyboard(removable):
+    """removable — [(id ключа, ключ)], добавленные через бота: их можно удалить."""
+    rows = [[InlineKeyboardButton(text="➕ Добавить ключ", callback_data="aikey:add")]]
+    for kid, api_key in removable:
+        rows.append([InlineKeyboardButton(text=f"🗑 Удалить …{api_key[-4:]}", callback_data=f"aikey:del:{kid}")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
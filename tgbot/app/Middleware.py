@@ -1,14 +1,24 @@
 from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import TelegramObject, Update, CallbackQuery, Message
 from typing import Callable, Dict, Any, Awaitable
 from app.database.Models import User, async_session_maker
 from app.general import check_referrals
 from app.Keyboards import get_referral_keyboard
-from datetime import datetime, timezone
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 from app.database.Models import User
 from app.redis_client import init_redis
+from app.database.requests import touch_user
+from app.activity import activity_buffer
+from app.stats import dau_key, record_signup, STATS_RETENTION_DAYS
+from app.ratelimit import GCRA_LUA, RateLimiter, rate_limiter
+from app.referrals import REFERRAL_COUNT_KEY, REFERRAL_CACHE_TTL
+from app.alerts import admin_alerter
+from app.cache import first_questions, referral_counts
+from app.events import event_log
+from redis.exceptions import RedisError
 
 import logging
 import os
@@ -52,58 +62,151 @@ class ErrorHandlerMiddleware(BaseMiddleware):
         try:
             return await handler(event, data)
         except Exception as e:
-            logging.error(f"Ошибка: {e}")
-            await event.bot.send_message(ADMIN_ID, f"⚠️ Бот упал! Ошибка: {e}")
-
-class AntiFloodMiddleware(BaseMiddleware):
-    """Middleware для защиты от флуда с использованием Redis."""
-
-    def __init__(self, limit=2):  # Лимит в секундах
-        self.limit = limit
+            # Одинаковые ошибки склеиваются, общий поток оповещений ограничен
+            await admin_alerter.alert(event.bot, ADMIN_ID, e)
+
+FIRST_QUESTION_KEY = "first_question:{user_id}"
+FLOOD_WARNING = "⛔ Вы слишком часто отправляете сообщения. Подождите {seconds} с."
+
+# Лимит частоты, флаг первого вопроса, кеш рефералов и учёт активности за один запрос к Redis.
+# Скрипт выполняется атомарно, поэтому два одновременных сообщения не проскочат оба.
+# Интервал 0 — лимит считается в памяти процесса (RATE_LIMIT_BACKEND=local), GCRA пропускаем.
+GATE_SCRIPT = GCRA_LUA + """
+local verdict = {1, 0, 0}
+if tonumber(ARGV[1]) > 0 then
+    verdict = gcra(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]))
+end
+-- Сколько ещё живёт «уже спросил» (мс; -1 — без срока, -2 — ключа нет): L1 не держит флаг дольше Redis
+local asked = redis.call('PTTL', KEYS[3])
+local referrals = redis.call('GET', KEYS[4])
+if verdict[1] == 1 then
+    -- Дневной HyperLogLog активных пользователей для статистики
+    redis.call('PFADD', KEYS[5], ARGV[3])
+    redis.call('EXPIRE', KEYS[5], ARGV[4])
+end
+return {verdict[1], verdict[2], verdict[3], asked, referrals}
+"""
+
+
+@dataclass
+class UserGate:
+    """Что знаем о пользователе до вызова хендлера. Передаётся в хендлеры как `gate`."""
+    user_id: int
+    first_question_asked: bool
+    referral_count: int
+
+
+class UserGateMiddleware(BaseMiddleware):
+    """Один проход вместо AntiFlood + LastActivity + проверок доступа в хендлере.
+
+    Redis: один EVALSHA (лимит частоты, первый вопрос, кеш рефералов, HyperLogLog активных за день).
+    Postgres: только при холодном кеше — upsert, который создаёт пользователя и возвращает referral_count.
+    В остальных случаях last_activity копится в ActivityBuffer и пишется пачкой.
+
+    Рефералы и «уже спросил» сначала ищутся в L1 (app.cache). Если оба там есть и лимиты считаются
+    в памяти процесса (RATE_LIMIT_BACKEND=local), сообщение проходит гейт вовсе без сети.
+
+    Бюджет берётся из флага хендлера: @router.message(..., flags={"rate_limit": "ai"}), по умолчанию command.
+    """
+
+    def __init__(self, limiter: RateLimiter = rate_limiter):
+        self.limiter = limiter
+        self.script = None
         super().__init__()
 
-    async def __call__(self, handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]], 
+    async def __call__(self, handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
                        event: Message, data: Dict[str, Any]) -> Any:
-        user_id = event.from_user.id
-        redis = await init_redis()
-        key = f"flood_{user_id}"
-        last_request = await redis.get(key)
+        from_user = event.from_user
+        if not from_user:
+            return await handler(event, data)
 
-        if last_request:
-            await event.answer("⛔ Вы слишком часто отправляете сообщения. Подождите немного.")
+        user_id = from_user.id
+        bucket = get_flag(data, "rate_limit", default="command")
+        referrals = referral_counts.get(user_id)
+        asked = first_questions.get(user_id, False)
+        redis = None
+        counted = False  # Скрипт уже отметил пользователя в активных за день
+
+        if referrals is not None and asked and self.limiter.local_only:
+            # Всё известно процессу, лимит тоже в памяти: в Redis не ходим
+            verdict = await self.limiter.hit(user_id, bucket)
+        else:
+            try:
+                redis = await init_redis()
+                if self.script is None:
+                    self.script = redis.register_script(GATE_SCRIPT)
+
+                allowed, retry_after, warn, stored_asked, stored_referrals = await self.script(
+                    keys=[
+                        *self.limiter.keys(user_id, bucket),
+                        FIRST_QUESTION_KEY.format(user_id=user_id),
+                        REFERRAL_COUNT_KEY.format(user_id=user_id),
+                        dau_key(),
+                    ],
+                    args=[*(self.limiter.args(bucket) if not self.limiter.local_only else (0, 0)),
+                          user_id, STATS_RETENTION_DAYS * 86400],
+                )
+                if self.limiter.local_only:
+                    verdict = await self.limiter.hit(user_id, bucket)
+                else:
+                    verdict = self.limiter.verdict(allowed, retry_after, warn)
+                counted = True
+            except RedisError as e:
+                # Без Redis: лимит в памяти процесса, рефералы из L1 или базы, пробный вопрос считаем использованным
+                verdict = self.limiter.hit_local(user_id, bucket, e)
+                redis = None
+                asked = True
+            else:
+                # Промахи L1 добираем из ответа скрипта
+                if referrals is None:
+                    referral_counts.record_l2(stored_referrals is not None)
+                    if stored_referrals is not None:
+                        referrals = int(stored_referrals)
+                        referral_counts.set(user_id, referrals)
+                if not asked:
+                    first_questions.record_l2(stored_asked != -2)
+                    if stored_asked != -2:
+                        asked = True
+                        first_questions.set(user_id, True, ttl=stored_asked / 1000 if stored_asked > 0 else None)
+
+        if not verdict.allowed:
+            # Предупреждаем один раз за окно, остальное молча отбрасываем: каждый ответ — тоже запрос к API
+            if verdict.warn:
+                await event.answer(FLOOD_WARNING.format(seconds=max(1, round(verdict.retry_after))))
             return
 
-        await redis.setex(key, self.limit, "1")  # Устанавливаем ограничение
+        if referrals is None:
+            # Кеш холодный: upsert создаёт пользователя, обновляет last_activity и возвращает referral_count
+            referral_count, created = await touch_user(user_id)
+            referral_counts.set(user_id, referral_count)
+            if redis is not None:
+                await redis.setex(REFERRAL_COUNT_KEY.format(user_id=user_id), REFERRAL_CACHE_TTL, referral_count)
+            if created:
+                await record_signup()
+                event_log.record(user_id, "signup")
+        else:
+            # Пользователь точно есть в базе, last_activity запишется пачкой в фоне
+            referral_count = referrals
+            activity_buffer.touch(user_id, count_active=not counted)
+
+        data["gate"] = UserGate(
+            user_id=user_id,
+            first_question_asked=bool(asked),
+            referral_count=referral_count,
+        )
         return await handler(event, data)
 
-class UpdateLastActivityMiddleware(BaseMiddleware):
-    async def __call__(self, handler, event: TelegramObject, data: dict):
-        # Проверяем, является ли событие `Message` или `CallbackQuery`
-        if isinstance(event, (Message, CallbackQuery)):
-            from_user = event.from_user  # Теперь точно знаем, что у события есть from_user
-            
-            if from_user and from_user.id:
-                async with async_session_maker() as session:
-                    user = await session.get(User, from_user.id)
-
-                    if not user:
-                        user = User(user_id=from_user.id, last_activity=datetime.now(timezone.utc))
-                        session.add(user)
-                    else:
-                        user.last_activity = datetime.now(timezone.utc)
+class CallbackRateLimitMiddleware(BaseMiddleware):
+    """Лимит частоты для нажатий inline-кнопок (свой бюджет callback)."""
 
-                    await session.commit()
+    def __init__(self, limiter: RateLimiter = rate_limiter):
+        self.limiter = limiter
+        super().__init__()
 
+    async def __call__(self, handler, event: CallbackQuery, data):
+        verdict = await self.limiter.hit(event.from_user.id, get_flag(data, "rate_limit", default="callback"))
+        if not verdict.allowed:
+            if verdict.warn:
+                await event.answer(FLOOD_WARNING.format(seconds=max(1, round(verdict.retry_after))))
+            return
         return await handler(event, data)
-
-class TestMiddleware(BaseMiddleware):
-    async def __call__(
-        self,
-        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
-        event: TelegramObject,
-        data: Dict[str, Any]
-    ) -> Any:
-        print('Действие до обработчика')
-        result = await handler(event, data)
-        print('Действие после обработчика')
-        return result
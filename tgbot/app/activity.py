@@ -0,0 +1,121 @@
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+from app.database.requests import bulk_update_last_activity
+from app.metrics import Gauge
+from app.redis_client import init_redis
+from app.stats import dau_key, STATS_RETENTION_DAYS
+from redis.exceptions import RedisError
+
+import asyncio
+import logging
+import os
+
+load_dotenv()
+
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "30"))  # Как часто сбрасываем last_activity в БД
+ACTIVITY_FLUSH_BATCH = int(os.getenv("ACTIVITY_FLUSH_BATCH", "5000"))  # Сколько строк в одном UPDATE
+
+
+class ActivityBuffer:
+    """Буфер last_activity с отложенной записью.
+
+    Каждое сообщение только обновляет время в памяти. Фоновая задача раз в interval секунд
+    пишет накопленное одним UPDATE на пачку, повторные касания одного пользователя схлопываются.
+    """
+
+    def __init__(self, interval=ACTIVITY_FLUSH_INTERVAL, batch_size=ACTIVITY_FLUSH_BATCH):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = {}  # user_id -> время последней активности
+        self.active = {}  # Ключ HyperLogLog дня -> user_id, которых гейт пропустил без Redis
+        self._task = None
+        self._stopping = None
+
+        # Метрики
+        self.touches = 0
+        self.coalesced = 0  # Касания, которые не стали отдельной записью в БД
+        self.flushed_rows = 0
+        self.flushes = 0
+
+    def touch(self, user_id: int, count_active=False):
+        """count_active — ещё и отметить в статистике активных за день (обычно это делает скрипт гейта)."""
+        self.touches += 1
+        if user_id in self.pending:
+            self.coalesced += 1
+        self.pending[user_id] = datetime.now(timezone.utc)
+        if count_active:
+            self.active.setdefault(dau_key(), set()).add(user_id)
+
+    async def flush_active(self):
+        if not self.active:
+            return
+        active, self.active = self.active, {}
+        try:
+            redis = await init_redis()
+            pipe = redis.pipeline(transaction=False)
+            for key, user_ids in active.items():
+                pipe.pfadd(key, *user_ids)
+                pipe.expire(key, STATS_RETENTION_DAYS * 86400)
+            await pipe.execute()
+        except RedisError as e:
+            logging.error(f"Не удалось записать активных за день: {e}")
+            for key, user_ids in active.items():
+                self.active.setdefault(key, set()).update(user_ids)
+
+    async def flush(self):
+        await self.flush_active()
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        rows = list(pending.items())
+
+        written = 0
+        try:
+            for i in range(0, len(rows), self.batch_size):
+                await bulk_update_last_activity(rows[i:i + self.batch_size])
+                written += len(rows[i:i + self.batch_size])
+        except Exception as e:
+            logging.error(f"Не удалось записать last_activity: {e}")
+            # Возвращаем незаписанное в буфер, не затирая более свежие значения
+            for user_id, ts in rows[written:]:
+                self.pending.setdefault(user_id, ts)
+        self.flushed_rows += written
+        self.flushes += 1
+        return written
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу; она делает финальный сброс перед выходом."""
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "pending_active": sum(len(user_ids) for user_ids in self.active.values()),
+            "touches": self.touches,
+            "coalesced": self.coalesced,
+            "flushed_rows": self.flushed_rows,
+            "flushes": self.flushes,
+        }
+
+
+activity_buffer = ActivityBuffer()
+
+Gauge("activity_buffer_pending", "Пользователи с незаписанной last_activity", lambda: len(activity_buffer.pending))
@@ -0,0 +1,213 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+
+load_dotenv()
+
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "3600"))  # Сколько секунд живёт ответ в кеше
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "2000"))  # Максимум ответов в памяти (LRU)
+AI_CACHE_NEAR_DUPLICATES = os.getenv("AI_CACHE_NEAR_DUPLICATES", "0") == "1"  # Искать почти одинаковые вопросы
+AI_CACHE_NEAR_THRESHOLD = float(os.getenv("AI_CACHE_NEAR_THRESHOLD", "0.85"))  # Минимальное сходство (Жаккар)
+
+SHINGLE_SIZE = 4  # Шинглы по 4 символа нечувствительны к окончаниям слов
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+_MERSENNE = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big"))
+    for i in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+
+def normalize_prompt(text: str) -> str:
+    """Регистр, лишние пробелы и знаки препинания в конце не влияют на ответ."""
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    return text.rstrip("?!.… ")
+
+
+def _shingles(text: str):
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def _minhash_bands(shingles):
+    hashed = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+    signature = [min((a * h + b) % _MERSENNE for h in hashed) for a, b in _MINHASH_SEEDS]
+    return [tuple(signature[i:i + MINHASH_ROWS]) for i in range(0, len(signature), MINHASH_ROWS)]
+
+
+class AnswerCache:
+    """Кеш ответов ИИ перед general().
+
+    Точное совпадение — по хешу модели и нормализованных сообщений. Одинаковые вопросы,
+    пришедшие одновременно, склеиваются в один запрос к API. Опционально ищутся почти
+    одинаковые вопросы через MinHash по символьным шинглам.
+    """
+
+    def __init__(self, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES,
+                 near_duplicates=AI_CACHE_NEAR_DUPLICATES, near_threshold=AI_CACHE_NEAR_THRESHOLD):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.near_duplicates = near_duplicates
+        self.near_threshold = near_threshold
+
+        self._entries = OrderedDict()  # key -> (expires_at, answer, shingles, bands)
+        self._bands = {}  # (номер полосы, значения) -> set(key)
+        self._inflight = {}  # key -> Future с ответом
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, messages) -> str:
+        normalized = [(m["role"], normalize_prompt(m["content"])) for m in messages]
+        raw = json.dumps([model, normalized], ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get_or_call(self, model: str, messages, call):
+        """Возвращает ответ из кеша, ждёт такой же запрос в полёте или вызывает call()."""
+        key = self.make_key(model, messages)
+        answer = self._lookup(key, model, messages)
+        if answer is not None:
+            return answer
+
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.misses += 1
+        future = self._claim(key)
+        try:
+            answer = await call()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._resolve(key, future, model, messages, answer)
+        return answer
+
+    async def stream_through(self, model: str, messages, stream):
+        """То же для потокового ответа: при попадании отдаёт весь текст одним куском."""
+        key = self.make_key(model, messages)
+        answer = self._lookup(key, model, messages)
+        if answer is None and key in self._inflight:
+            self.coalesced += 1
+            answer = await asyncio.shield(self._inflight[key])
+        if answer is not None:
+            yield answer
+            return
+
+        self.misses += 1
+        future = self._claim(key)
+        parts = []
+        try:
+            async for delta in stream():
+                parts.append(delta)
+                yield delta
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._resolve(key, future, model, messages, "".join(parts))
+
+    def _lookup(self, key, model, messages):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._evict(key)
+
+        if self.near_duplicates and len(messages) == 1:
+            answer = self._lookup_near(model, messages[0]["content"], now)
+            if answer is not None:
+                self.near_hits += 1
+                return answer
+        return None
+
+    def _lookup_near(self, model, content, now):
+        shingles = _shingles(model + "\n" + normalize_prompt(content))
+        candidates = set()
+        for i, band in enumerate(_minhash_bands(shingles)):
+            candidates |= self._bands.get((i, band), set())
+
+        best, best_score = None, self.near_threshold
+        for key in candidates:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now or entry[2] is None:
+                continue
+            score = len(shingles & entry[2]) / len(shingles | entry[2])
+            if score >= best_score:
+                best, best_score = key, score
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best][1]
+
+    def _claim(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    def _resolve(self, key, future, model, messages, answer):
+        self._inflight.pop(key, None)
+        if answer:  # Пустые ответы не кешируем
+            self._put(key, model, messages, answer)
+        if not future.done():
+            future.set_result(answer)
+
+    def _fail(self, key, future, error):
+        self._inflight.pop(key, None)
+        if not future.done():
+            if not isinstance(error, Exception):
+                error = RuntimeError("Запрос к ИИ прерван")
+            future.set_exception(error)
+            future.exception()  # Помечаем как полученное, даже если никто не ждал
+
+    def _put(self, key, model, messages, answer):
+        shingles = bands = None
+        if self.near_duplicates and len(messages) == 1:
+            shingles = _shingles(model + "\n" + normalize_prompt(messages[0]["content"]))
+            bands = _minhash_bands(shingles)
+            for i, band in enumerate(bands):
+                self._bands.setdefault((i, band), set()).add(key)
+
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (time.monotonic() + self.ttl, answer, shingles, bands)
+        while len(self._entries) > self.max_entries:
+            self._evict(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _evict(self, key):
+        _, _, _, bands = self._entries.pop(key)
+        for i, band in enumerate(bands or ()):
+            bucket = self._bands.get((i, band))
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._bands[(i, band)]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+answer_cache = AnswerCache()
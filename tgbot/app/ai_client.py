@@ -0,0 +1,501 @@
+"""Слой провайдеров ИИ: несколько ключей и моделей, маршрутизация, таймауты, предохранители, хеджирование.
+
+Бэкенд — пара (модель, ключ) у провайдера. Запрос попадает в ярус по длине промпта (короткие —
+в AI_FAST_MODELS, если он задан), внутри яруса бэкенд выбирается случайно по весу модели.
+Бэкенд, который подряд падает, выключается предохранителем на AI_BREAKER_COOLDOWN секунд.
+Если ответ (или первый токен потока) не пришёл за p95 этого бэкенда, при AI_HEDGE=1 тот же запрос
+уходит второму бэкенду, побеждает первый ответивший.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import async_timeout
+import httpx
+from mistralai import Mistral
+from dotenv import load_dotenv
+
+from app.ai_keys import load_keys
+from app.metrics import AI_SECONDS, AI_BACKEND_REQUESTS, AI_HEDGES, Gauge, record_ai_usage
+
+load_dotenv()
+
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))  # Сколько запросов к ИИ выполняется одновременно
+AI_POOL_SIZE = int(os.getenv("AI_POOL_SIZE", "16"))  # Размер пула keep-alive соединений
+AI_KEEPALIVE_EXPIRY = float(os.getenv("AI_KEEPALIVE_EXPIRY", "60"))  # Сколько секунд держим простаивающее соединение
+
+AI_MODELS = os.getenv("AI_MODELS", "mistral-small-latest")  # [провайдер:]модель[=вес] через запятую
+AI_FAST_MODELS = os.getenv("AI_FAST_MODELS", "")  # Модели для коротких промптов, пусто — как AI_MODELS
+AI_SHORT_PROMPT_CHARS = int(os.getenv("AI_SHORT_PROMPT_CHARS", "400"))  # Промпт (с историей) короче — короткий
+
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "45"))  # Потолок на ответ целиком без потока
+AI_FIRST_TOKEN_TIMEOUT = float(os.getenv("AI_FIRST_TOKEN_TIMEOUT", "15"))  # Сколько ждём первый кусок потока
+AI_STREAM_IDLE_TIMEOUT = float(os.getenv("AI_STREAM_IDLE_TIMEOUT", "20"))  # И каждый следующий
+AI_MAX_ATTEMPTS = int(os.getenv("AI_MAX_ATTEMPTS", "2"))  # Сколько бэкендов пробуем, пока не получим ответ
+
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))  # Ошибок подряд, после которых бэкенд выключается
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))  # На сколько секунд, потом один пробный запрос
+
+AI_HEDGE = os.getenv("AI_HEDGE", "0") == "1"  # Дублировать медленные запросы на второй бэкенд
+AI_HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY", "3"))  # Задержка хеджа, пока у бэкенда мало замеров для p95
+AI_HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", "0.5"))  # Не раньше, даже если p95 меньше
+AI_KEYS_REFRESH = float(os.getenv("AI_KEYS_REFRESH", "30"))  # Как часто перечитываем пул ключей из Redis
+
+LATENCY_WINDOW = 200  # Сколько последних замеров держим для p95
+LATENCY_MIN_SAMPLES = 20
+
+
+class AIUnavailableError(RuntimeError):
+    """Ни один бэкенд не доступен: все выключены предохранителями или упали."""
+
+
+class MistralProvider:
+    """Один ключ Mistral. HTTP-пул общий для всех ключей: TLS-рукопожатие платим один раз."""
+
+    def __init__(self, api_key, http, sync_http):
+        self.sdk = Mistral(api_key=api_key, client=sync_http, async_client=http)
+
+    async def complete(self, model, messages, **kwargs):
+        return await self.sdk.chat.complete_async(model=model, messages=messages, **kwargs)
+
+    async def stream(self, model, messages, **kwargs):
+        res = await self.sdk.chat.stream_async(model=model, messages=messages, **kwargs)
+        async with res as events:
+            async for event in events:
+                yield event.data
+
+
+PROVIDERS = {"mistral": MistralProvider}  # Новый провайдер — класс с complete/stream и строка здесь
+
+
+class CircuitBreaker:
+    """closed — работаем; open — бэкенд выключен на cooldown; half_open — пропускаем один пробный запрос."""
+
+    def __init__(self, failures=AI_BREAKER_FAILURES, cooldown=AI_BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+
+    def available(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.cooldown
+        # Проба потерялась (задачу отменили до старта) — через cooldown пускаем новую
+        return not self.probing or time.monotonic() - self.probe_started >= self.cooldown
+
+    def begin(self):
+        """Вызывается при выборе бэкенда: в half_open пробу получает только выбравший первым."""
+        if self.state == "open" and self.available():
+            self.state = "half_open"
+        if self.state == "half_open":
+            self.probing = True
+            self.probe_started = time.monotonic()
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logging.warning(f"Бэкенд ИИ выключен на {self.cooldown:.0f} с после {self.failures} ошибок подряд")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def cancelled(self):
+        self.probing = False  # Проигравший хедж — не ошибка бэкенда
+
+
+class Backend:
+    def __init__(self, name, model, client, weight=1.0):
+        self.name = name
+        self.model = model
+        self.client = client
+        self.weight = weight
+        self.breaker = CircuitBreaker()
+        # Время ответа целиком и время до первого чанка потока — это разные распределения
+        self.latencies = {"complete": deque(maxlen=LATENCY_WINDOW), "stream": deque(maxlen=LATENCY_WINDOW)}
+        self.requests = 0
+        self.errors = 0
+
+    def p95(self, kind):
+        if len(self.latencies[kind]) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies[kind])
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def hedge_delay(self, kind):
+        p95 = self.p95(kind)
+        return AI_HEDGE_DELAY if p95 is None else max(AI_HEDGE_MIN_DELAY, p95)
+
+
+class Tier:
+    def __init__(self, name, backends):
+        self.name = name
+        self.backends = backends
+        # Пространство ключей кеша ответов: одинаковый вопрос к одному ярусу — один ответ
+        self.cache_key = f"{name}:" + ",".join(sorted({backend.model for backend in backends}))
+
+
+def parse_models(spec):
+    """"mistral:mistral-small-latest=3,open-mistral-nemo" -> [("mistral", "mistral-small-latest", 3.0), ...]"""
+    models = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        item, _, weight = item.partition("=")
+        provider, _, model = item.rpartition(":")
+        provider = provider or "mistral"
+        if provider not in PROVIDERS:
+            raise ValueError(f"Неизвестный провайдер ИИ: {provider}")
+        models.append((provider, model, float(weight or 1)))
+    return models
+
+
+async def _next(stream):
+    return await stream.__anext__()
+
+
+class AIRouter:
+    def __init__(self, main, fast=None, max_concurrency=AI_MAX_CONCURRENCY, hedge=AI_HEDGE):
+        self.main = Tier("main", main)
+        self.fast = Tier("fast", fast) if fast else None
+        self.hedge = hedge
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = None
+        self._sync_http = None
+        self._refresh_task = None
+
+    # --- Конфигурация из окружения и пула ключей ---
+
+    @classmethod
+    def from_env(cls):
+        router = cls([])
+        limits = httpx.Limits(max_connections=AI_POOL_SIZE, max_keepalive_connections=AI_POOL_SIZE,
+                              keepalive_expiry=AI_KEEPALIVE_EXPIRY)
+        router._http = httpx.AsyncClient(limits=limits)
+        router._sync_http = httpx.Client(limits=limits)
+        return router
+
+    async def reload_keys(self):
+        """Пересобирает бэкенды по пулу ключей. У бэкендов, что остались, сохраняются замеры и предохранители."""
+        existing = {backend.name: backend for tier in self.tiers() for backend in tier.backends}
+        keys = {}
+        specs = {"main": parse_models(AI_MODELS), "fast": parse_models(AI_FAST_MODELS)}
+        for provider in {p for tier in specs.values() for p, _, _ in tier}:
+            keys[provider] = await load_keys(provider)
+
+        tiers = {}
+        for tier_name, models in specs.items():
+            backends = []
+            for provider, model, weight in models:
+                provider_keys = keys[provider]
+                for kid, api_key, _ in provider_keys:
+                    name = f"{provider}:{model}:{kid}"
+                    backend = existing.get(name)
+                    if backend is None:
+                        client = PROVIDERS[provider](api_key, self._http, self._sync_http)
+                        backend = Backend(name, model, client)
+                    backend.weight = weight / len(provider_keys)  # Новый ключ не меняет долю модели
+                    backends.append(backend)
+            tiers[tier_name] = backends
+
+        if not tiers["main"]:
+            logging.error("Нет ни одного ключа ИИ: задайте AI_TOKEN или добавьте ключ через админ-панель")
+        self.main = Tier("main", tiers["main"])
+        self.fast = Tier("fast", tiers["fast"]) if tiers["fast"] else None
+
+    def start(self):
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def _refresh(self):
+        while True:
+            try:
+                await self.reload_keys()
+            except Exception as e:
+                logging.error(f"Не удалось обновить пул ключей ИИ: {e}")
+            await asyncio.sleep(AI_KEYS_REFRESH)
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._sync_http.close()
+
+    # --- Выбор бэкенда ---
+
+    def tiers(self):
+        return [tier for tier in (self.main, self.fast) if tier]
+
+    def route(self, messages) -> Tier:
+        size = sum(len(m["content"]) for m in messages if isinstance(m.get("content"), str))
+        if self.fast and size < AI_SHORT_PROMPT_CHARS:
+            return self.fast
+        return self.main
+
+    def pick(self, tier: Tier, exclude=()):
+        """Случайный по весу бэкенд яруса с рабочим предохранителем; если таких нет — из другого яруса."""
+        for candidates in (tier.backends, *(t.backends for t in self.tiers() if t is not tier)):
+            available = [b for b in candidates if b not in exclude and b.breaker.available()]
+            if available:
+                backend = random.choices(available, weights=[b.weight for b in available])[0]
+                # Пробу занимаем сразу: иначе после cooldown её выберут все одновременные запросы
+                backend.breaker.begin()
+                return backend
+        return None
+
+    @asynccontextmanager
+    async def _slot(self, backend):
+        """Место в общем лимите параллельности. Отмена в ожидании возвращает пробу, занятую в pick()."""
+        try:
+            await self._semaphore.acquire()
+        except asyncio.CancelledError:
+            backend.breaker.cancelled()
+            raise
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    # --- Вызовы ---
+
+    async def complete(self, messages, **kwargs):
+        tier = self.route(messages)
+        tried, last_error = set(), None
+        for _ in range(AI_MAX_ATTEMPTS):
+            primary = self.pick(tier, tried)
+            if primary is None:
+                break
+            tried.add(primary)
+            try:
+                return await self._hedged_complete(tier, primary, tried, messages, kwargs)
+            except Exception as e:
+                last_error = e
+                logging.warning(f"ИИ: {primary.name} не ответил ({type(e).__name__}: {e}), пробуем другой бэкенд")
+        raise last_error or AIUnavailableError("Нет доступных бэкендов ИИ")
+
+    async def _hedged_complete(self, tier, primary, tried, messages, kwargs):
+        tasks = [asyncio.create_task(self._complete(primary, messages, kwargs))]
+        try:
+            if self.hedge:
+                done, _ = await asyncio.wait(tasks, timeout=primary.hedge_delay("complete"))
+                secondary = None if done or self._semaphore.locked() else self.pick(tier, tried)
+                if secondary is not None:
+                    tried.add(secondary)
+                    tasks.append(asyncio.create_task(self._complete(secondary, messages, kwargs)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if len(tasks) > 1:
+                            AI_HEDGES.inc(result="primary" if task is tasks[0] else "secondary")
+                        return task.result()
+            raise tasks[0].exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _complete(self, backend, messages, kwargs):
+        async with self._slot(backend):
+            backend.requests += 1
+            started = time.perf_counter()
+            status = "error"
+            try:
+                async with async_timeout.timeout(AI_TIMEOUT):
+                    response = await backend.client.complete(model=backend.model, messages=messages, **kwargs)
+                backend.latencies["complete"].append(time.perf_counter() - started)
+                backend.breaker.success()
+                record_ai_usage(getattr(response, "usage", None))
+                status = "ok"
+                return response
+            except asyncio.CancelledError:
+                status = "cancelled"
+                backend.breaker.cancelled()
+                raise
+            except Exception:
+                backend.errors += 1
+                backend.breaker.failure()
+                raise
+            finally:
+                AI_SECONDS.observe(time.perf_counter() - started, method="complete", status=status)
+                AI_BACKEND_REQUESTS.inc(backend=backend.name, result=status)
+
+    async def stream(self, messages, **kwargs):
+        """Чанки ответа. Бэкенд меняем только до первого чанка: дальше текст уже у пользователя."""
+        tier = self.route(messages)
+        tried, last_error = set(), None
+        for _ in range(AI_MAX_ATTEMPTS):
+            primary = self.pick(tier, tried)
+            if primary is None:
+                break
+            tried.add(primary)
+            try:
+                stream, first = await self._open_stream(tier, primary, tried, messages, kwargs)
+            except Exception as e:
+                last_error = e
+                logging.warning(f"ИИ: {primary.name} не начал ответ ({type(e).__name__}: {e}), пробуем другой бэкенд")
+                continue
+            if stream is None:
+                return  # Пустой ответ
+            try:
+                yield first
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.aclose()
+            return
+        raise last_error or AIUnavailableError("Нет доступных бэкендов ИИ")
+
+    async def _open_stream(self, tier, primary, tried, messages, kwargs):
+        """Открывает поток и ждёт первый чанк (с хеджем). Возвращает (поток, первый чанк)."""
+        streams = {}  # задача первого чанка -> поток
+
+        def launch(backend):
+            stream = self._stream(backend, messages, kwargs)
+            task = asyncio.create_task(_next(stream))
+            streams[task] = stream
+            return task
+
+        first_task = launch(primary)
+        winner = None
+        try:
+            pending = {first_task}
+            hedge_at = primary.hedge_delay("stream") if self.hedge else None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, timeout=hedge_at, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    secondary = None if self._semaphore.locked() else self.pick(tier, tried)
+                    if secondary is not None:
+                        tried.add(secondary)
+                        pending.add(launch(secondary))
+                    continue
+                for task in done:
+                    if task.exception() is None or isinstance(task.exception(), StopAsyncIteration):
+                        winner = task
+                        break
+
+            if winner is None:
+                raise first_task.exception()
+            if len(streams) > 1:
+                AI_HEDGES.inc(result="primary" if winner is first_task else "secondary")
+            if isinstance(winner.exception(), StopAsyncIteration):
+                return None, None
+            return streams[winner], winner.result()
+        finally:
+            for task, stream in streams.items():
+                if task is not winner:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    await stream.aclose()
+
+    async def _stream(self, backend, messages, kwargs):
+        async with self._slot(backend):
+            backend.requests += 1
+            started = time.perf_counter()
+            status = "error"
+            stream = backend.client.stream(model=backend.model, messages=messages, **kwargs)
+            try:
+                first = True
+                while True:
+                    try:
+                        async with async_timeout.timeout(AI_FIRST_TOKEN_TIMEOUT if first else AI_STREAM_IDLE_TIMEOUT):
+                            chunk = await stream.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    if first:
+                        backend.latencies["stream"].append(time.perf_counter() - started)
+                        first = False
+                    # usage приходит в последнем чанке потока
+                    record_ai_usage(getattr(chunk, "usage", None))
+                    yield chunk
+                backend.breaker.success()
+                status = "ok"
+            except (asyncio.CancelledError, GeneratorExit):
+                status = "cancelled"
+                backend.breaker.cancelled()
+                raise
+            except Exception:
+                backend.errors += 1
+                backend.breaker.failure()
+                raise
+            finally:
+                await stream.aclose()
+                AI_SECONDS.observe(time.perf_counter() - started, method="stream", status=status)
+                AI_BACKEND_REQUESTS.inc(backend=backend.name, result=status)
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "backends": [
+                {
+                    "name": backend.name,
+                    "tier": tier.name,
+                    "requests": backend.requests,
+                    "errors": backend.errors,
+                    "p95_complete": backend.p95("complete"),
+                    "p95_first_token": backend.p95("stream"),
+                    "state": backend.breaker.state,
+                }
+                for tier in self.tiers() for backend in tier.backends
+            ],
+        }
+
+
+ai_client = None  # Глобальный роутер ИИ
+
+
+def init_ai_client():
+    global ai_client
+    if ai_client is None:
+        ai_client = AIRouter.from_env()
+        logging.info("Клиент ИИ создан!")
+    return ai_client
+
+
+async def start_ai_client():
+    """Создаёт роутер, загружает пул ключей и запускает его периодическое обновление."""
+    client = init_ai_client()
+    await client.reload_keys()
+    client.start()
+    return client
+
+
+async def close_ai_client():
+    global ai_client
+    if ai_client:
+        try:
+            await ai_client.close()
+            ai_client = None
+            logging.info("Клиент ИИ закрыт.")
+        except Exception as e:
+            logging.error(f"Ошибка при закрытии клиента ИИ: {e}")
+
+
+def _open_breakers():
+    if ai_client is None:
+        return 0
+    return sum(1 for tier in ai_client.tiers() for backend in tier.backends if backend.breaker.state != "closed")
+
+
+Gauge("ai_backends_unavailable", "Бэкенды ИИ, выключенные предохранителем", _open_breakers)
@@ -0,0 +1,60 @@
+"""Пул API-ключей провайдеров ИИ.
+
+Ключи из окружения (AI_TOKEN и AI_KEYS_<ПРОВАЙДЕР> через запятую) плюс ключи, которые админ
+добавил через бота, — они лежат в Redis и общие для всех процессов. .env бот больше не переписывает.
+"""
+from dotenv import load_dotenv
+
+from app.redis_client import init_redis
+
+import hashlib
+import os
+
+load_dotenv()
+
+AI_KEYS_KEY = "ai:keys:{provider}"  # hash: id ключа -> ключ
+
+
+def key_id(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()[:10]
+
+
+def mask(api_key: str) -> str:
+    return f"…{api_key[-4:]}"
+
+
+def env_keys(provider: str):
+    raw = os.getenv(f"AI_KEYS_{provider.upper()}", "")
+    if provider == "mistral" and os.getenv("AI_TOKEN"):
+        raw = f"{os.getenv('AI_TOKEN')},{raw}"
+    return [key.strip() for key in raw.split(",") if key.strip()]
+
+
+async def load_keys(provider: str):
+    """Список (id, ключ, откуда) без повторов: сначала из окружения, потом добавленные админом."""
+    keys, seen = [], set()
+    for api_key in env_keys(provider):
+        if key_id(api_key) not in seen:
+            seen.add(key_id(api_key))
+            keys.append((key_id(api_key), api_key, "env"))
+
+    redis = await init_redis()
+    stored = await redis.hgetall(AI_KEYS_KEY.format(provider=provider))
+    for kid, api_key in sorted(stored.items()):
+        if kid not in seen:
+            seen.add(kid)
+            keys.append((kid, api_key, "redis"))
+    return keys
+
+
+async def add_key(provider: str, api_key: str) -> str:
+    redis = await init_redis()
+    kid = key_id(api_key)
+    await redis.hset(AI_KEYS_KEY.format(provider=provider), kid, api_key)
+    return kid
+
+
+async def remove_key(provider: str, kid: str) -> bool:
+    """Удаляет ключ, добавленный админом. Ключи из окружения так не удалить."""
+    redis = await init_redis()
+    return bool(await redis.hdel(AI_KEYS_KEY.format(provider=provider), kid))
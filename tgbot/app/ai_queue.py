@@ -0,0 +1,204 @@
+from collections import deque
+from dotenv import load_dotenv
+
+from app.metrics import Gauge
+
+import asyncio
+import logging
+import os
+import time
+
+load_dotenv()
+
+AI_WORKERS = int(os.getenv("AI_WORKERS", "16"))  # Сколько пользователей обслуживаем одновременно
+AI_USER_QUEUE_DEPTH = int(os.getenv("AI_USER_QUEUE_DEPTH", "2"))  # Сколько вопросов пользователя ждут в очереди
+AI_QUEUE_POLICY = os.getenv("AI_QUEUE_POLICY", "merge")  # merge, drop или latest — что делать с лишними вопросами
+AI_QUEUE_WAIT_SAMPLES = 1000  # Сколько последних ожиданий храним для перцентилей
+
+QUEUED, MERGED, DROPPED, SUPERSEDED = "queued", "merged", "dropped", "superseded"
+
+
+class AIJob:
+    def __init__(self, user_id, text, run):
+        self.user_id = user_id
+        self.text = text
+        self.run = run  # run(text) -> корутина с ответом пользователю
+        self.enqueued_at = time.monotonic()
+        self.task = None
+
+
+class AIRequestQueue:
+    """Очередь вопросов к ИИ: у каждого пользователя не больше одного запроса в работе.
+
+    Вопросы пользователя ждут в его собственной очереди глубиной depth. Что делать, когда она полна:
+    merge — дописать текст к последнему ждущему вопросу, drop — отказать, latest — новый вопрос
+    отменяет старые, включая тот, что уже выполняется. Общий пул воркеров берёт пользователей
+    по кругу, поэтому тот, кто шлёт много, не задерживает остальных.
+    """
+
+    def __init__(self, workers=AI_WORKERS, depth=AI_USER_QUEUE_DEPTH, policy=AI_QUEUE_POLICY):
+        self.workers = workers
+        self.depth = depth
+        self.policy = policy
+
+        self._queues = {}  # user_id -> deque[AIJob]
+        self._ready = deque()  # Пользователи с ждущими вопросами и без запроса в работе, по кругу
+        self._active = {}  # user_id -> AIJob в работе
+        self._wakeup = None
+        self._tasks = []
+        self._closing = False
+        self._drained = None  # Событие: при остановке в работе и в очередях ничего не осталось
+
+        self.submitted = 0
+        self.merged = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.failed = 0
+        self.completed = 0
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waits = deque(maxlen=AI_QUEUE_WAIT_SAMPLES)
+
+    def start(self):
+        if not self._tasks:
+            self._closing = False
+            self._drained = None
+            self._wakeup = asyncio.Condition()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=25):
+        """Новые вопросы не принимаем; ждём и те, что в работе, и те, что в очереди, но не дольше timeout.
+
+        Что не успело — отбрасывается: ответы в работе отменяются, ждущие вопросы теряются.
+        """
+        self._closing = True
+        self._drained = asyncio.Event()
+        if self._tasks and (self._active or self._queues):
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Очередь ИИ не разобрана за {timeout:.0f} с: в работе {len(self._active)}, "
+                                f"ждут {self.stats()['waiting']}")
+
+        for queue in self._queues.values():
+            self.dropped += len(queue)
+        self._queues.clear()
+        self._ready.clear()
+
+        running = [job.task for job in self._active.values() if job.task]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, user_id, text, run):
+        """Ставит вопрос в очередь пользователя. Возвращает queued, merged, dropped или superseded."""
+        if self._closing:
+            self.dropped += 1
+            return DROPPED
+        self.start()
+
+        self.submitted += 1
+        queue = self._queues.setdefault(user_id, deque())
+        result = QUEUED
+
+        if self.policy == "latest":
+            if queue or user_id in self._active:
+                result = SUPERSEDED
+            self.superseded += len(queue)
+            queue.clear()
+            active = self._active.get(user_id)
+            if active is not None and active.task is not None:
+                self.superseded += 1
+                active.task.cancel()
+        elif len(queue) >= self.depth:
+            if self.policy == "drop":
+                self.dropped += 1
+                return DROPPED
+            # merge: склеиваем с последним ждущим вопросом, отвечаем на самое новое сообщение
+            last = queue[-1]
+            last.text = f"{last.text}\n\n{text}"
+            last.run = run
+            self.merged += 1
+            return MERGED
+
+        queue.append(AIJob(user_id, text, run))
+        if user_id not in self._active and user_id not in self._ready:
+            self._ready.append(user_id)
+            async with self._wakeup:
+                self._wakeup.notify()
+        return result
+
+    async def _next_job(self):
+        async with self._wakeup:
+            await self._wakeup.wait_for(lambda: self._ready)
+            user_id = self._ready.popleft()
+        job = self._queues[user_id].popleft()
+        self._active[user_id] = job
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            wait = time.monotonic() - job.enqueued_at
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._waits.append(wait)
+
+            job.task = asyncio.create_task(job.run(job.text))
+            try:
+                await asyncio.wait([job.task])
+                if job.task.cancelled():
+                    pass  # Вытеснен более новым вопросом или остановкой
+                elif job.task.exception() is not None:
+                    self.failed += 1
+                    logging.error(f"Ошибка ответа ИИ пользователю {job.user_id}: {job.task.exception()}")
+                else:
+                    self.completed += 1
+            finally:
+                self._release(job.user_id)
+
+    def _release(self, user_id):
+        del self._active[user_id]
+        queue = self._queues.get(user_id)
+        if queue:
+            self._ready.append(user_id)  # В конец круга: сначала обслужим остальных
+        elif queue is not None:
+            del self._queues[user_id]
+        if self._drained is not None and not self._active and not self._queues:
+            self._drained.set()
+
+    def wait_percentile(self, q):
+        if not self._waits:
+            return 0.0
+        ordered = sorted(self._waits)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self):
+        return {
+            "active": len(self._active),
+            "waiting": sum(len(queue) for queue in self._queues.values()),
+            "submitted": self.submitted,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "superseded": self.superseded,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait": self.total_wait / self.started if self.started else 0.0,
+            "p50_wait": self.wait_percentile(0.5),
+            "p95_wait": self.wait_percentile(0.95),
+            "max_wait": self.max_wait,
+        }
+
+
+ai_queue = AIRequestQueue()
+
+Gauge("ai_queue_active", "Пользователи, чей вопрос сейчас в работе", lambda: len(ai_queue._active))
+Gauge("ai_queue_waiting", "Вопросы, ждущие в очередях пользователей", lambda: ai_queue.stats()["waiting"])
+Gauge("ai_queue_wait_p95_seconds", "95-й перцентиль ожидания в очереди", lambda: ai_queue.wait_percentile(0.95))
@@ -0,0 +1,72 @@
+from aiogram import Bot
+from dotenv import load_dotenv
+
+from app.metrics import ALERTS
+from app.sender import send_lane, NOTIFY
+
+import logging
+import os
+import time
+
+load_dotenv()
+
+ALERT_DEDUP_WINDOW = float(os.getenv("ALERT_DEDUP_WINDOW", "600"))  # Одна и та же ошибка — не чаще раза за столько секунд
+ALERT_MAX_PER_MINUTE = int(os.getenv("ALERT_MAX_PER_MINUTE", "5"))  # Общий потолок оповещений в минуту
+
+
+class AdminAlerter:
+    """Оповещения админу об ошибках без шторма во время аварии.
+
+    Одинаковые ошибки (тип + текст) склеиваются: первая уходит сразу, повторы в пределах окна
+    только считаются, и их число приходит вместе со следующим оповещением. Сверху — общий лимит в минуту.
+    """
+
+    def __init__(self, dedup_window=ALERT_DEDUP_WINDOW, max_per_minute=ALERT_MAX_PER_MINUTE):
+        self.dedup_window = dedup_window
+        self.max_per_minute = max_per_minute
+        self._last_sent = {}  # подпись ошибки -> когда отправляли
+        self._suppressed = {}  # подпись ошибки -> сколько повторов не отправили
+        self._sent_times = []
+
+    @staticmethod
+    def signature(error: BaseException) -> str:
+        first_line = str(error).splitlines()[0] if str(error) else ""
+        return f"{type(error).__name__}: {first_line[:200]}"
+
+    def should_send(self, key: str, now: float) -> bool:
+        last = self._last_sent.get(key)
+        if last is not None and now - last < self.dedup_window:
+            return False
+        self._sent_times = [t for t in self._sent_times if now - t < 60]
+        return len(self._sent_times) < self.max_per_minute
+
+    async def alert(self, bot: Bot, admin_id: int, error: BaseException, context: str = "Бот упал!"):
+        logging.error(f"{context} {error}")
+        key = self.signature(error)
+        now = time.monotonic()
+        if not self.should_send(key, now):
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            ALERTS.inc(result="suppressed")
+            return False
+
+        self._last_sent[key] = now
+        self._sent_times.append(now)
+        if len(self._last_sent) > 1000:  # Старые подписи больше не нужны
+            self._last_sent = {k: t for k, t in self._last_sent.items() if now - t < self.dedup_window}
+
+        text = f"⚠️ {context} Ошибка: {error}"
+        repeats = self._suppressed.pop(key, 0)
+        if repeats:
+            text += f"\n(повторялась ещё {repeats} раз с прошлого оповещения)"
+        try:
+            with send_lane(NOTIFY):
+                await bot.send_message(admin_id, text[:4096])
+            ALERTS.inc(result="sent")
+            return True
+        except Exception as e:
+            logging.error(f"Не удалось отправить оповещение админу: {e}")
+            ALERTS.inc(result="failed")
+            return False
+
+
+admin_alerter = AdminAlerter()
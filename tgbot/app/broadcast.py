@@ -0,0 +1,273 @@
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from dotenv import load_dotenv
+
+from app.database.requests import fetch_user_ids_after, count_reachable_users, mark_users_blocked
+from app.redis_client import init_redis
+from app.locks import singleton_lock, is_locked
+from app.sender import send_lane, BULK
+from app.tasks import supervisor
+from redis.exceptions import LockError, RedisError
+
+import asyncio
+import logging
+import os
+import time
+
+load_dotenv()
+
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))  # Сколько user_id читаем из БД за раз
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "25"))  # Сколько отправок идёт параллельно между чекпоинтами
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # Как часто обновляем прогресс админу
+
+JOB_KEY = "broadcast:job"  # Состояние и чекпоинт рассылки (hash)
+LOCK_NAME = "broadcast"  # Распределённый замок: рассылку ведёт только один процесс
+LOCK_TTL = 60  # Если процесс упал, через минуту рассылку можно продолжить
+LOCK_RENEW_INTERVAL = LOCK_TTL / 3  # Продлеваем замок из отдельной задачи, а не между чанками
+BROADCAST_RESUME_INTERVAL = float(os.getenv("BROADCAST_RESUME_INTERVAL", "30"))  # Как часто сторож ищет прерванную рассылку
+BROADCAST_MAX_RESUMES = int(os.getenv("BROADCAST_MAX_RESUMES", "5"))  # Продолжений подряд без продвижения, потом рассылка снимается
+
+
+async def is_broadcast_running() -> bool:
+    """Рассылка идёт или прервана и ждёт продолжения: в обоих случаях новую начинать нельзя."""
+    if await is_locked(LOCK_NAME):
+        return True
+    redis = await init_redis()
+    return await redis.hget(JOB_KEY, "status") == "running"
+
+
+async def _release(lock):
+    try:
+        await lock.release()
+    except LockError:
+        pass  # Замок уже истёк
+
+
+async def launch_broadcast(bot: Bot, from_chat_id: int, message_id: int, admin_chat_id: int):
+    """Создаёт задание рассылки и запускает его в фоне. Возвращает число получателей или None, если рассылка уже идёт."""
+    redis = await init_redis()
+    lock = await singleton_lock(LOCK_NAME, LOCK_TTL)
+    if not await lock.acquire():
+        return None
+
+    try:
+        if await redis.hget(JOB_KEY, "status") == "running":
+            # Прерванную рассылку продолжит сторож: её чекпоинт не затираем
+            await _release(lock)
+            return None
+
+        total = await count_reachable_users()
+        progress = await bot.send_message(admin_chat_id, f"📤 Рассылка началась! Всего {total} пользователей.")
+
+        # Сообщение не храним: при повторе делаем copy_message из чата админа, так переживаем перезапуск
+        await redis.delete(JOB_KEY)
+        await redis.hset(JOB_KEY, mapping={
+            "status": "running",
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress.message_id,
+            "cursor": 0,
+            "total": total,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "resumes": 0,
+            "started_at": time.time(),
+        })
+    except BaseException:
+        await _release(lock)  # Иначе новые рассылки стоят до истечения замка, а админ не видит почему
+        raise
+    _spawn(bot, lock)
+    return total
+
+
+async def resume_broadcast(bot: Bot):
+    """Продолжает рассылку с последнего чекпоинта, если её процесс упал или потерял замок."""
+    if supervisor.stopping:
+        return False
+    redis = await init_redis()
+    if await redis.hget(JOB_KEY, "status") != "running":
+        return False
+
+    lock = await singleton_lock(LOCK_NAME, LOCK_TTL)
+    if not await lock.acquire():
+        return False  # Рассылку ведёт живой процесс, или замок упавшего ещё не истёк — сторож зайдёт позже
+
+    try:
+        job = await redis.hgetall(JOB_KEY)
+        admin_chat_id = int(job["admin_chat_id"])
+        # Счётчик сбрасывает каждый чекпоинт: растёт, только если продолжения ничего не отправляют
+        resumes = await redis.hincrby(JOB_KEY, "resumes", 1)
+        if resumes > BROADCAST_MAX_RESUMES:
+            await redis.hset(JOB_KEY, "status", "failed")
+            logging.error(f"Рассылка снята: {BROADCAST_MAX_RESUMES} продолжений подряд без продвижения")
+            await bot.send_message(admin_chat_id, f"⛔ Рассылка остановлена: не удаётся продолжить "
+                                                  f"({job['sent']}/{job['total']}). Подробности в логах.")
+            await _release(lock)
+            return False
+
+        logging.info(f"Продолжаем рассылку с user_id > {job['cursor']}")
+        await bot.send_message(admin_chat_id, f"🔄 Продолжаем прерванную рассылку ({job['sent']}/{job['total']}).")
+    except BaseException:
+        await _release(lock)
+        raise
+    _spawn(bot, lock)
+    return True
+
+
+class BroadcastWatchdog:
+    """Подхватывает прерванную рассылку без перезапуска бота.
+
+    Замок упавшего процесса живёт ещё до LOCK_TTL, поэтому проверка при старте его не застаёт;
+    рассылка, потерявшая замок, тоже ждёт здесь. Обращение — один HGET в BROADCAST_RESUME_INTERVAL.
+    """
+
+    def __init__(self, interval=BROADCAST_RESUME_INTERVAL):
+        self.interval = interval
+        self._task = None
+        self._stopping = None
+        self.resumed = 0
+
+    async def _run(self, bot):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if await resume_broadcast(bot):
+                    self.resumed += 1
+            except Exception as e:
+                logging.error(f"Сторож рассылки: {e}")
+
+    def start(self, bot: Bot):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run(bot), name="broadcast-watchdog")
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+
+broadcast_watchdog = BroadcastWatchdog()
+
+
+async def _keep_lock(lock, job: asyncio.Task):
+    """Продлевает замок, пока идёт рассылка: чанк может ждать Telegram (429, очередь отправок) дольше LOCK_TTL."""
+    while True:
+        await asyncio.sleep(LOCK_RENEW_INTERVAL)
+        try:
+            await lock.extend(LOCK_TTL, replace_ttl=True)
+        except LockError as e:
+            # Замок истёк и мог достаться другому процессу: две рассылки сразу — дубли у пользователей
+            logging.error(f"Рассылка потеряла замок, останавливаемся на чекпоинте: {e}")
+            job.cancel()
+            return
+        except RedisError as e:
+            logging.warning(f"Не удалось продлить замок рассылки: {e}")
+
+
+def _spawn(bot: Bot, lock):
+    with send_lane(BULK):  # Задача наследует полосу: рассылка уступает ответам пользователям
+        supervisor.spawn(_run_broadcast(bot, lock), name="broadcast", group="broadcast")
+
+
+async def _run_broadcast(bot: Bot, lock):
+    redis = await init_redis()
+    job = await redis.hgetall(JOB_KEY)
+
+    from_chat_id = int(job["from_chat_id"])
+    message_id = int(job["message_id"])
+    admin_chat_id = int(job["admin_chat_id"])
+    progress_message_id = int(job["progress_message_id"])
+    cursor = int(job["cursor"])
+    total = int(job["total"])
+    counters = {name: int(job[name]) for name in ("sent", "blocked", "failed")}
+
+    last_progress = time.monotonic()
+
+    async def send(user_id):
+        # Темп и повторы после 429 — в SendScheduler (полоса BULK), здесь только итог отправки
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+            return "sent"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            logging.warning(f"Рассылка: не удалось отправить {user_id}: {e}")
+            return "failed"
+        except TelegramRetryAfter as e:
+            logging.warning(f"Рассылка: {user_id} пропущен, планировщик исчерпал повторы (retry_after {e.retry_after} с)")
+            return "failed"
+        except Exception as e:
+            logging.warning(f"Рассылка: ошибка отправки {user_id}: {e}")
+            return "failed"
+
+    keeper = asyncio.create_task(_keep_lock(lock, asyncio.current_task()))
+    try:
+        while True:
+            page = await fetch_user_ids_after(cursor, BROADCAST_PAGE_SIZE)
+            if not page:
+                break
+
+            for i in range(0, len(page), BROADCAST_CHUNK_SIZE):
+                chunk = page[i:i + BROADCAST_CHUNK_SIZE]
+                results = await asyncio.gather(*(send(user_id) for user_id in chunk))
+
+                blocked_ids = [user_id for user_id, result in zip(chunk, results) if result == "blocked"]
+                await mark_users_blocked(blocked_ids)
+                for result in results:
+                    counters[result] += 1
+
+                # Чекпоинт: всё до cursor включительно уже обработано
+                cursor = chunk[-1]
+                await redis.hset(JOB_KEY, mapping={"cursor": cursor, "resumes": 0, **counters})
+
+                if supervisor.stopping:
+                    # Остановка процесса: выходим на чекпоинте, замок снимется в finally,
+                    # и следующий процесс сразу продолжит рассылку через resume_broadcast
+                    logging.info(f"Рассылка приостановлена на user_id {cursor} до перезапуска")
+                    return
+
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await _report(bot, admin_chat_id, progress_message_id, _progress_text(counters, total))
+
+        await redis.hset(JOB_KEY, "status", "done")
+        text = (
+            f"📤 Рассылка завершена!\n✅ Отправлено: {counters['sent']}\n"
+            f"❌ Недоступны: {counters['blocked']}\n⚠️ Ошибки: {counters['failed']}"
+        )
+        await _report(bot, admin_chat_id, progress_message_id, text)
+        await bot.send_message(admin_chat_id, text)
+    except Exception as e:
+        # Статус остаётся running: сторож (или следующий запуск) продолжит с чекпоинта
+        logging.error(f"Рассылка прервана на user_id {cursor}: {e}")
+        raise
+    finally:
+        keeper.cancel()
+        await asyncio.gather(keeper, return_exceptions=True)
+        await _release(lock)
+
+
+def _progress_text(counters, total):
+    done = sum(counters.values())
+    percent = done * 100 // total if total else 100
+    return (
+        f"📤 Рассылка: {done}/{total} ({percent}%)\n"
+        f"✅ Отправлено: {counters['sent']}\n❌ Недоступны: {counters['blocked']}\n⚠️ Ошибки: {counters['failed']}"
+    )
+
+
+async def _report(bot: Bot, chat_id: int, message_id: int, text: str):
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+    except Exception as e:
+        logging.warning(f"Не удалось обновить прогресс рассылки: {e}")
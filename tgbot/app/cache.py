@@ -0,0 +1,204 @@
+"""Кеш первого уровня (L1) в памяти процесса перед Redis (L2).
+
+Горячие факты о пользователе — число рефералов и флаг первого вопроса — меняются редко,
+а читаются на каждом сообщении. L1 — словарь с TTL и вытеснением давно не читанных записей
+(LRU), размер ограничен числом записей. Redis остаётся общим источником для всех процессов.
+
+Кто меняет значение, пишет его в Redis, обновляет свой L1 и публикует ключ в канал
+CACHE_INVALIDATE_CHANNEL — остальные процессы выбрасывают ключ из L1 и перечитают его из Redis.
+Если сообщение pub/sub потеряно (например, при переподключении), запись всё равно проживёт
+не дольше CACHE_L1_TTL; после переподключения L1 очищается целиком.
+"""
+from collections import OrderedDict
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+
+from app.metrics import CACHE_REQUESTS
+from app.redis_client import init_redis
+
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+load_dotenv()
+
+CACHE_L1_MAX_ENTRIES = int(os.getenv("CACHE_L1_MAX_ENTRIES", "100000"))  # Записей в одном кеше L1, дальше вытесняем давно не читанные
+CACHE_L1_TTL = float(os.getenv("CACHE_L1_TTL", "300"))  # Секунды жизни записи L1, если инвалидация не дошла
+CACHE_INVALIDATE_CHANNEL = "cache:invalidate"
+
+_origin = uuid.uuid4().hex  # Метка процесса: свои сообщения об инвалидации пропускаем
+_caches = {}  # имя -> LocalCache
+
+
+def _reset_after_fork():
+    # Кластер запускает воркеры через spawn, это страховка для форка вне него (как у пулов БД и Redis):
+    # с меткой родителя дочерний процесс пропускал бы его инвалидации как свои
+    global _origin
+    _origin = uuid.uuid4().hex
+    for cache in _caches.values():
+        cache.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class LocalCache:
+    """L1 с TTL и LRU. Ключи приводятся к строке, чтобы совпадать с ключами из сообщений pub/sub."""
+
+    def __init__(self, name, max_entries=CACHE_L1_MAX_ENTRIES, ttl=CACHE_L1_TTL):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # ключ -> (истекает в, значение)
+        self.hits = 0
+        self.misses = 0
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.evictions = 0
+        _caches[name] = self
+
+    def get(self, key, default=None):
+        key = str(key)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache=self.name, tier="l1", result="hit")
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self.misses += 1
+        CACHE_REQUESTS.inc(cache=self.name, tier="l1", result="miss")
+        return default
+
+    def set(self, key, value, ttl=None):
+        """ttl сокращает срок записи, если источник истекает раньше L1 (длиннее self.ttl не бывает)."""
+        key = str(key)
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def record_l2(self, hit: bool):
+        """Учёт обращения к Redis после промаха L1 — для доли попаданий по уровням."""
+        if hit:
+            self.l2_hits += 1
+        else:
+            self.l2_misses += 1
+        CACHE_REQUESTS.inc(cache=self.name, tier="l2", result="hit" if hit else "miss")
+
+    def drop(self, *keys):
+        for key in keys:
+            self._entries.pop(str(key), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def invalidate(self, *keys):
+        """Убирает ключи из своего L1 и просит остальные процессы сделать то же."""
+        self.drop(*keys)
+        await self.invalidate_others(*keys)
+
+    async def invalidate_others(self, *keys):
+        """Только рассылка: свой L1 уже обновлён новым значением."""
+        await publish_invalidation(self.name, keys)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "l2_hits": self.l2_hits,
+            "l2_misses": self.l2_misses,
+            "evictions": self.evictions,
+        }
+
+
+async def publish_invalidation(name, keys):
+    if not keys:
+        return
+    try:
+        redis = await init_redis()
+        await redis.publish(CACHE_INVALIDATE_CHANNEL, json.dumps(
+            {"origin": _origin, "cache": name, "keys": [str(key) for key in keys]}
+        ))
+    except RedisError as e:
+        # Другие процессы увидят новое значение не позже, чем истечёт TTL их L1
+        logging.warning(f"Не удалось разослать инвалидацию кеша {name}: {e}")
+
+
+def _apply_invalidation(raw):
+    try:
+        message = json.loads(raw)
+    except ValueError:
+        return
+    if message.get("origin") == _origin:
+        return
+    cache = _caches.get(message.get("cache"))
+    if cache is not None:
+        cache.drop(*message.get("keys", ()))
+
+
+class CacheInvalidator:
+    """Фоновая подписка на канал инвалидации. Один экземпляр на процесс."""
+
+    def __init__(self, channel=CACHE_INVALIDATE_CHANNEL):
+        self.channel = channel
+        self._task = None
+        self._stopping = None
+        self.received = 0
+        self.reconnects = 0
+
+    async def _listen(self):
+        redis = await init_redis()
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(self.channel)
+            # Пока подписки не было, сообщения могли пройти мимо: начинаем с чистого L1
+            for cache in _caches.values():
+                cache.clear()
+            while not self._stopping.is_set():
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    self.received += 1
+                    _apply_invalidation(message["data"])
+        finally:
+            await pubsub.aclose()
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self._listen()
+            except (RedisError, OSError) as e:
+                self.reconnects += 1
+                logging.warning(f"Подписка на инвалидацию кеша прервалась: {e}")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+
+def cache_stats():
+    return [cache.stats() for cache in _caches.values()]
+
+
+referral_counts = LocalCache("referral_count")
+first_questions = LocalCache("first_question")  # Только «уже спросил», не дольше остатка TTL ключа в Redis
+cache_invalidator = CacheInvalidator()
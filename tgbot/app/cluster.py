@@ -0,0 +1,174 @@
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import Update
+from dotenv import load_dotenv
+
+from app.logs import setup_logging, stop_logging
+from app.redis_client import init_redis, close_redis
+from app.tasks import SHUTDOWN_TIMEOUT, drain_polling
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+load_dotenv()
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "32"))  # Сколько апдейтов воркер обрабатывает одновременно
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "25"))  # Сколько воркер дорабатывает при остановке
+
+SHARD_QUEUE_KEY = "updates:shard:{shard}"  # Очередь апдейтов шарда
+SHARD_PROCESSING_KEY = "updates:processing:{shard}"  # Взятые воркером, но ещё не обработанные
+
+
+def update_user_id(update: dict):
+    """Достаёт id пользователя (или чата) из сырого апдейта."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+def shard_for(update: dict, shards: int) -> int:
+    user_id = update_user_id(update)
+    return user_id % shards if user_id is not None else 0
+
+
+class ShardForwarderMiddleware(BaseMiddleware):
+    """Приёмник апдейтов: вместо обработки кладёт апдейт в очередь шарда по user_id.
+
+    Все апдейты одного пользователя попадают в один шард, поэтому идут строго по порядку.
+    """
+
+    def __init__(self, shards: int):
+        self.shards = shards
+        super().__init__()
+
+    async def __call__(self, handler, event: Update, data):
+        raw = event.model_dump(mode="json", exclude_none=True, by_alias=True)
+        redis = await init_redis()
+        await redis.rpush(
+            SHARD_QUEUE_KEY.format(shard=shard_for(raw, self.shards)),
+            json.dumps(raw, ensure_ascii=False),
+        )
+
+
+async def consume_shard(dp: Dispatcher, bot: Bot, shard: int, stop: asyncio.Event,
+                        concurrency=WORKER_CONCURRENCY, drain_timeout=WORKER_DRAIN_TIMEOUT):
+    """Обрабатывает очередь шарда: разные пользователи параллельно, один пользователь — по порядку.
+
+    Апдейт переносится в список processing атомарно (BLMOVE) и удаляется оттуда только после
+    обработки, поэтому при падении воркера ничего не теряется: следующий запуск вернёт его в очередь.
+    """
+    redis = await init_redis()
+    queue = SHARD_QUEUE_KEY.format(shard=shard)
+    processing = SHARD_PROCESSING_KEY.format(shard=shard)
+
+    # Возвращаем в начало очереди то, что прошлый воркер взял, но не успел обработать
+    while await redis.lmove(processing, queue, "RIGHT", "LEFT"):
+        pass
+
+    slots = asyncio.Semaphore(concurrency)
+    tails = {}  # user_id -> последняя задача этого пользователя
+    tasks = set()
+
+    async def process(raw, update, previous):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logging.error(f"Шард {shard}: ошибка обработки апдейта {update.get('update_id')}: {e}")
+        finally:
+            await redis.lrem(processing, 1, raw)
+            slots.release()
+
+    def forget_tail(user_id, task):
+        if tails.get(user_id) is task:
+            del tails[user_id]
+
+    while not stop.is_set():
+        await slots.acquire()
+        raw = await redis.blmove(queue, processing, 1, "LEFT", "RIGHT")
+        if raw is None:
+            slots.release()
+            continue
+
+        update = json.loads(raw)
+        user_id = update_user_id(update)
+        task = asyncio.create_task(process(raw, update, tails.get(user_id)))
+        tails[user_id] = task
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda t, u=user_id: forget_tail(u, t))
+
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()  # Останутся в processing и будут обработаны после перезапуска
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def worker_process(shard: int, shards: int):
+    """Точка входа процесса-воркера (multiprocessing, spawn)."""
+    setup_logging(f"w{shard + 1}")  # Свой файл логов: ротация из нескольких процессов в один файл ломается
+    try:
+        asyncio.run(_worker_main(shard, shards))
+    finally:
+        stop_logging()
+
+
+async def _worker_main(shard: int, shards: int):
+    # Импортируем здесь: в новом процессе всё создаётся заново — свои пулы Redis, Postgres и HTTP
+    from run import create_bot, create_dispatcher, startup, shutdown
+    from app.metrics import METRICS_PORT
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    bot = create_bot()
+    dp = create_dispatcher()
+    # У каждого воркера свой /metrics: METRICS_PORT + 1 + номер шарда
+    await startup(bot, init_schema=False, metrics_port=METRICS_PORT + 1 + shard if METRICS_PORT else 0)
+    logging.info(f"Воркер {shard + 1}/{shards} запущен")
+    try:
+        await consume_shard(dp, bot, shard, stop)
+    finally:
+        await shutdown(dp, bot)
+
+
+async def run_cluster(bot: Bot, workers: int, receive_updates):
+    """Главный процесс: принимает апдейты (polling или webhook) и раздаёт их воркерам по шардам."""
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=worker_process, args=(shard, workers), name=f"worker-{shard}")
+        for shard in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    dp = Dispatcher()
+    dp.update.outer_middleware(ShardForwarderMiddleware(workers))
+    try:
+        await receive_updates(dp, bot)
+    finally:
+        await drain_polling(dp, WORKER_DRAIN_TIMEOUT)  # Апдейты, полученные polling, должны успеть лечь в очереди шардов
+        # SIGTERM: воркеры перестают брать новые апдейты, дорабатывают текущие и проходят shutdown
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join, WORKER_DRAIN_TIMEOUT + SHUTDOWN_TIMEOUT + 5)
+        await bot.session.close()
+        await close_redis()
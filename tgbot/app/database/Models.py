@@ -1,16 +1,28 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import BigInteger, String, ForeignKey, Integer, UniqueConstraint, DateTime, Boolean, func, text, Index
-from datetime import datetime
+from sqlalchemy import BigInteger, String, ForeignKey, Integer, DateTime, Date, Boolean, Column, Table, func, text, Index
+from datetime import date, datetime
 from dotenv import load_dotenv
+from app.database.engine import create_engine, register_pool_metrics
+from app.metrics import instrument_engine
 import os
 
 load_dotenv()
 
 # Подключение к PostgreSQL
 DATABASE_URL = os.getenv("SQL_ALCHEMY_URL")
-engine = create_async_engine(DATABASE_URL, pool_pre_ping=True, future=True)
+engine = create_engine(DATABASE_URL)  # Пул и кеш запросов настраиваются в app/database/engine.py
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+instrument_engine(engine)  # Гистограмма времени SQL-запросов
+register_pool_metrics(engine)
+
+
+def _reset_pool_after_fork():
+    # Дочерний процесс не должен трогать соединения родителя: забываем их, не закрывая
+    engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
 
 class Base(DeclarativeBase):
     pass
@@ -24,6 +36,7 @@ class User(Base):
     referral_count: Mapped[int] = mapped_column(Integer, default=0)
     access_granted: Mapped[bool] = mapped_column(Boolean, default=False)
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
+    is_blocked: Mapped[bool] = mapped_column(Boolean, default=False, server_default=text("false"))  # Пользователь заблокировал бота
     last_activity: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
@@ -35,7 +48,6 @@ class User(Base):
     )
 
     __table_args__ = (
-        Index('ix_user_user_id', 'user_id'),
         Index('ix_user_invited_by', 'invited_by'),
         Index('ix_user_referral_count', 'referral_count'),  # Добавлен индекс на referral_count
         Index('ix_user_last_activity', 'last_activity'),
@@ -45,39 +57,54 @@ class User(Base):
 class Referral(Base):
     __tablename__ = "referrals"
 
-    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    # В SQLite автоинкремент работает только у INTEGER PRIMARY KEY (локальные бенчмарки)
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
     inviter_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"))
     invited_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), unique=True)
 
     inviter = relationship("User", back_populates="referrals", foreign_keys=[inviter_id])
 
     __table_args__ = (
-        UniqueConstraint('inviter_id', 'invited_id', name='unique_referral_pair'),
         Index('ix_referral_inviter_id', 'inviter_id'),  # Добавлен индекс на inviter_id
-        Index('ix_referral_invited_id', 'invited_id'),  # Добавлен индекс на invited_id
     )
 
-async def migrate_db():
-    async with engine.begin() as conn:
-        # Преобразуем поле access_granted в BOOLEAN для корректной работы с PostgreSQL
-        await conn.execute(text(
-            "ALTER TABLE users ALTER COLUMN access_granted TYPE BOOLEAN USING access_granted::BOOLEAN;"
-        ))
-        await conn.execute(text(
-            "ALTER TABLE users ALTER COLUMN is_admin TYPE BOOLEAN USING is_admin::BOOLEAN;"
-        ))
-
-        # Установим значение по умолчанию для created_at, чтобы избежать ошибок при вставке
-        await conn.execute(text(
-            "ALTER TABLE users ALTER COLUMN created_at SET DEFAULT NOW();"
-        ))
-        # Убедимся, что поле не принимает NULL значения
-        await conn.execute(text(
-            "ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;"
-        ))
-
-
-async def init_db():
-    async with engine.begin() as conn:
-        await migrate_db()
-        await conn.run_sync(Base.metadata.create_all)  # Создаём таблицы, если их нет
\ No newline at end of file
+
+class SchemaVersion(Base):
+    """Применённые миграции (app/database/migrations.py)."""
+    __tablename__ = "schema_version"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    description: Mapped[str] = mapped_column(String(200))
+    applied_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+# Журнал событий активности (app/events.py): только дописывается, в Postgres секционирован по дням.
+# Первичного ключа и индексов нет — их не читают точечно, только сворачивают в activity_daily целыми днями.
+# Секции activity_events_YYYYMMDD создаёт и удаляет app/database/analytics.py.
+activity_events = Table(
+    "activity_events",
+    Base.metadata,
+    Column("ts", DateTime(timezone=True), nullable=False),
+    Column("user_id", BigInteger, nullable=False),
+    Column("kind", String(16), nullable=False),  # message, callback, ai, signup
+    Column("handler", String(64), nullable=True),
+    Column("value", Integer, nullable=False, server_default=text("0")),  # Для ai — токены ответа
+    postgresql_partition_by="RANGE (ts)",
+)
+
+
+class ActivityDaily(Base):
+    """Свёртка activity_events по пользователю за день. Аналитика читает только её."""
+    __tablename__ = "activity_daily"
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    messages: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    callbacks: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    ai_requests: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    ai_tokens: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    signups: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+
+
+async def close_db():
+    await engine.dispose()  # Закрываем соединения пула, иначе процесс ждёт их при выходе
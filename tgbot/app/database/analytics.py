@@ -0,0 +1,214 @@
+"""Секции журнала activity_events, свёртка в activity_daily и запросы аналитики для админа.
+
+Журнал секционирован по дням: запись попадает в секцию своего дня, свёртка читает ровно одну секцию,
+а хранение ограничивается удалением целых секций — без DELETE по миллионам строк и без VACUUM после.
+Аналитика (когорты удержания, использование ИИ) читает только свёртку, журнал и users не трогает.
+
+SQLite (бенчмарки): секций нет, старые события удаляются DELETE.
+"""
+from sqlalchemy import Date, and_, cast, delete, distinct, func, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import date, datetime, time, timedelta, timezone
+
+from app.database.Models import ActivityDaily, activity_events, engine
+
+import logging
+import re
+
+PARTITION_PREFIX = "activity_events_"
+PARTITION_LOCK_TIMEOUT = "2s"  # DROP секции на миг блокирует родителя: запись ждёт в буфере, а не висит
+
+EVENT_COLUMNS = ("ts", "user_id", "kind", "handler", "value")
+
+
+def _postgres():
+    return engine.dialect.name == "postgresql"
+
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+async def ensure_partitions(days_ahead: int, start: date = None):
+    """Создаёт секции с start (по умолчанию сегодня) на days_ahead дней вперёд."""
+    if not _postgres():
+        return
+    start = start or datetime.now(timezone.utc).date()
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for offset in range(days_ahead + 1):
+            day = start + timedelta(days=offset)
+            await conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF activity_events "
+                f"FOR VALUES FROM ('{_day_start(day).isoformat()}') TO ('{_day_start(day + timedelta(days=1)).isoformat()}')"
+            ))
+
+
+async def drop_partitions_before(cutoff: date) -> int:
+    """Хранение: удаляет секции (в SQLite — строки) старше cutoff. Возвращает число удалённых секций."""
+    if not _postgres():
+        async with engine.begin() as conn:
+            await conn.execute(delete(activity_events).where(activity_events.c.ts < _day_start(cutoff)))
+        return 0
+
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        result = await conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'activity_events'::regclass"
+        ))
+        dropped = 0
+        for (name,) in result.all():
+            match = re.fullmatch(rf"{PARTITION_PREFIX}(\d{{8}})", name)
+            if not match or datetime.strptime(match.group(1), "%Y%m%d").date() >= cutoff:
+                continue
+            await conn.execute(text(f"SET lock_timeout = '{PARTITION_LOCK_TIMEOUT}'"))
+            await conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            dropped += 1
+        if dropped:
+            logging.info(f"Журнал событий: удалено секций {dropped} (старше {cutoff})")
+        return dropped
+
+
+async def insert_events(rows):
+    """Пачка кортежей (ts, user_id, kind, handler, value). В Postgres — COPY, он сам раскладывает по секциям."""
+    if not rows:
+        return
+    async with engine.begin() as conn:
+        if _postgres():
+            driver = (await conn.get_raw_connection()).driver_connection
+            await driver.copy_records_to_table("activity_events", records=rows, columns=EVENT_COLUMNS)
+        else:
+            await conn.execute(insert(activity_events), [dict(zip(EVENT_COLUMNS, row)) for row in rows])
+
+
+ROLLUP_COLUMNS = ("day", "user_id", "messages", "callbacks", "ai_requests", "ai_tokens", "signups")
+
+
+async def rollup_days(first: date, last: date):
+    """Пересчитывает activity_daily за дни first..last целиком: повторный запуск даёт тот же результат.
+
+    Может идти одновременно из фоновой задачи и из админки: вставка — upsert, поэтому строки,
+    которые параллельная транзакция успела вставить после нашего DELETE, просто перезаписываются.
+    """
+    if _postgres():
+        # День по UTC, как у секций и окна ts, а не по TimeZone сессии сервера
+        day = cast(func.timezone("UTC", activity_events.c.ts), Date)
+    else:
+        day = func.date(activity_events.c.ts)
+    kind = activity_events.c.kind
+    aggregate = (
+        select(
+            day,
+            activity_events.c.user_id,
+            func.count().filter(kind == "message"),
+            func.count().filter(kind == "callback"),
+            func.count().filter(kind == "ai"),
+            func.coalesce(func.sum(activity_events.c.value).filter(kind == "ai"), 0),
+            func.count().filter(kind == "signup"),
+        )
+        # Границы по ts, а не по date(ts): так Postgres читает только секции этих дней
+        .where(activity_events.c.ts >= _day_start(first), activity_events.c.ts < _day_start(last + timedelta(days=1)))
+        .group_by(day, activity_events.c.user_id)
+    )
+    upsert = (pg_insert if _postgres() else sqlite_insert)(ActivityDaily).from_select(ROLLUP_COLUMNS, aggregate)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=["day", "user_id"],
+        set_={column: upsert.excluded[column] for column in ROLLUP_COLUMNS[2:]},
+    )
+    async with engine.begin() as conn:
+        await conn.execute(delete(ActivityDaily).where(ActivityDaily.day >= first, ActivityDaily.day <= last))
+        await conn.execute(upsert)
+
+
+async def last_rollup_day():
+    async with engine.connect() as conn:
+        value = await conn.scalar(select(func.max(ActivityDaily.day)))
+    return _as_date(value) if value is not None else None
+
+
+def _as_date(value) -> date:
+    # SQLite отдаёт даты строками
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _week(column):
+    """Понедельник недели для даты."""
+    if _postgres():
+        return cast(func.date_trunc("week", column), Date)
+    return func.date(column, "-6 days", "weekday 1")
+
+
+async def retention_cohorts(weeks: int):
+    """Когорты по неделе регистрации: [(неделя, размер, [доля активных на неделе 0, 1, ...])]."""
+    since = datetime.now(timezone.utc).date() - timedelta(weeks=weeks)
+    since -= timedelta(days=since.weekday())
+    signup_week = _week(ActivityDaily.day)
+    cohort = (
+        select(ActivityDaily.user_id, func.min(signup_week).label("cohort"))
+        .where(ActivityDaily.day >= since, ActivityDaily.signups > 0)
+        .group_by(ActivityDaily.user_id)
+        .subquery()
+    )
+    active = (
+        select(ActivityDaily.user_id, _week(ActivityDaily.day).label("week"))
+        .where(ActivityDaily.day >= since)
+        .distinct()
+        .subquery()
+    )
+    async with engine.connect() as conn:
+        sizes = (await conn.execute(
+            select(cohort.c.cohort, func.count()).group_by(cohort.c.cohort).order_by(cohort.c.cohort)
+        )).all()
+        retained = (await conn.execute(
+            select(cohort.c.cohort, active.c.week, func.count())
+            .join(active, and_(active.c.user_id == cohort.c.user_id, active.c.week >= cohort.c.cohort))
+            .group_by(cohort.c.cohort, active.c.week)
+        )).all()
+
+    counts = {}
+    for cohort_week, week, count in retained:
+        offset = (_as_date(week) - _as_date(cohort_week)).days // 7
+        counts[(_as_date(cohort_week), offset)] = count
+    result = []
+    for cohort_week, size in sizes:
+        cohort_week = _as_date(cohort_week)
+        offsets = (datetime.now(timezone.utc).date() - cohort_week).days // 7 + 1
+        result.append((cohort_week, size, [counts.get((cohort_week, i), 0) / size for i in range(offsets)]))
+    return result
+
+
+async def ai_usage(days: int, limit: int):
+    """Итог за days дней и самые активные пользователи ИИ: (итог, [(user_id, запросов, токенов, активных дней)])."""
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    async with engine.connect() as conn:
+        totals = (await conn.execute(
+            select(
+                func.coalesce(func.sum(ActivityDaily.ai_requests), 0),
+                func.coalesce(func.sum(ActivityDaily.ai_tokens), 0),
+                func.count(distinct(ActivityDaily.user_id)).filter(ActivityDaily.ai_requests > 0),
+            ).where(ActivityDaily.day >= since)
+        )).one()
+        top = (await conn.execute(
+            select(
+                ActivityDaily.user_id,
+                func.sum(ActivityDaily.ai_requests).label("requests"),
+                func.sum(ActivityDaily.ai_tokens),
+                func.count().filter(ActivityDaily.ai_requests > 0),
+            )
+            .where(ActivityDaily.day >= since)
+            .group_by(ActivityDaily.user_id)
+            .having(func.sum(ActivityDaily.ai_requests) > 0)
+            .order_by(text("requests DESC"))
+            .limit(limit)
+        )).all()
+    return {"requests": totals[0], "tokens": totals[1], "users": totals[2]}, [tuple(row) for row in top]
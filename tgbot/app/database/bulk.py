@@ -0,0 +1,328 @@
+"""Массовые выгрузка, загрузка и чистка users и referrals (CLI — manage.py).
+
+Postgres: CSV идёт через COPY ... TO STDOUT / FROM STDIN прямо из файла в сокет и обратно,
+строки не собираются в памяти. Загрузка сначала копирует файл во временную таблицу, потом
+одним INSERT ... SELECT ... ON CONFLICT DO NOTHING переносит в рабочую: повторная загрузка
+того же файла ничего не дублирует, а ссылки на несуществующих пользователей отбрасываются.
+Parquet читается и пишется пачками через pyarrow (необязательная зависимость).
+
+Чистка идёт страницами по user_id: пачка строк архивируется в CSV того же формата, что у выгрузки
+(архив можно загрузить обратно), и удаляется в той же транзакции.
+
+SQLite (локальные бенчмарки) — без COPY, те же операции пачками через SQLAlchemy.
+"""
+from sqlalchemy import Boolean, DateTime, Integer, BigInteger, delete, exists, or_, select
+from datetime import datetime, timedelta, timezone
+
+from app.database.Models import User, Referral, engine
+
+import csv
+import gzip
+import io
+import os
+import sys
+
+BULK_BATCH_SIZE = 5000  # Строк в одной пачке: столько держим в памяти одновременно
+
+TABLES = {"users": User.__table__, "referrals": Referral.__table__}
+
+
+def detect_format(path: str, fmt: str = None) -> str:
+    if fmt:
+        return fmt
+    return "parquet" if path.endswith(".parquet") else "csv"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise RuntimeError("Для Parquet нужен pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+def _open(path: str, mode: str):
+    """Файл, .gz или «-» (stdin/stdout) в двоичном режиме."""
+    if path == "-":
+        return os.fdopen(os.dup((sys.stdout if "w" in mode else sys.stdin).fileno()), mode)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _postgres():
+    return engine.dialect.name == "postgresql"
+
+
+async def _driver_connection(conn):
+    # asyncpg-соединение под AsyncConnection: у SQLAlchemy нет своего API для COPY
+    return (await conn.get_raw_connection()).driver_connection
+
+
+def _csv_value(value):
+    # Как пишет COPY ... CSV: NULL — пустое поле, логические — t/f
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return value
+
+
+def _parse_value(column, value: str):
+    if value == "":
+        return None
+    if isinstance(column.type, Boolean):
+        return value.lower() in ("t", "true", "1")
+    if isinstance(column.type, (Integer, BigInteger)):
+        return int(value)
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class CsvSink:
+    """Пишет строки таблицы в CSV пачками; заголовок — имена колонок."""
+
+    def __init__(self, binary, columns):
+        self.binary = binary
+        self.text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        self.writer = csv.writer(self.text)
+        self.writer.writerow([column.name for column in columns])
+        self.columns = columns
+
+    def write(self, rows):
+        self.writer.writerows([[_csv_value(row[column.name]) for column in self.columns] for row in rows])
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+
+
+class ParquetSink:
+    def __init__(self, binary, columns):
+        pa = _pyarrow()
+        self.pa = pa
+        types = {Boolean: pa.bool_(), DateTime: pa.timestamp("us", tz="UTC"), Integer: pa.int64(), BigInteger: pa.int64()}
+        self.schema = pa.schema([
+            (column.name, next((t for cls, t in types.items() if isinstance(column.type, cls)), pa.string()))
+            for column in columns
+        ])
+        self.writer = pa.parquet.ParquetWriter(binary, self.schema)
+
+    def write(self, rows):
+        self.writer.write_batch(self.pa.RecordBatch.from_pylist([dict(row) for row in rows], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def _sink(fmt, binary, columns):
+    return ParquetSink(binary, columns) if fmt == "parquet" else CsvSink(binary, columns)
+
+
+async def _pages(conn, table, batch_size):
+    """Страницы строк по первичному ключу — без OFFSET и без чтения всей таблицы разом."""
+    key = table.primary_key.columns[0]
+    cursor = None
+    while True:
+        query = select(table).order_by(key).limit(batch_size)
+        if cursor is not None:
+            query = query.where(key > cursor)
+        rows = (await conn.execute(query)).mappings().all()
+        if not rows:
+            return
+        yield rows
+        cursor = rows[-1][key.name]
+
+
+async def export_table(name: str, path: str, fmt: str = None, batch_size=BULK_BATCH_SIZE) -> int:
+    """Выгружает таблицу в файл. Возвращает число строк (для COPY — по ответу сервера)."""
+    table = TABLES[name]
+    fmt = detect_format(path, fmt)
+    with _open(path, "wb") as binary:
+        async with engine.connect() as conn:
+            if fmt == "csv" and _postgres():
+                driver = await _driver_connection(conn)
+                status = await driver.copy_from_table(
+                    table.name, columns=[column.name for column in table.columns],
+                    output=binary, format="csv", header=True,
+                )
+                return int(status.split()[-1])  # "COPY 12345"
+
+            sink = _sink(fmt, binary, list(table.columns))
+            total = 0
+            async for rows in _pages(conn, table, batch_size):
+                sink.write(rows)
+                total += len(rows)
+            sink.close()
+            return total
+
+
+def _read_csv_header(binary):
+    return next(csv.reader([binary.readline().decode("utf-8")]))
+
+
+def _read_batches(fmt, binary, table, batch_size):
+    """(колонки, итератор пачек кортежей) из CSV или Parquet."""
+    if fmt == "parquet":
+        pa = _pyarrow()
+        parquet = pa.parquet.ParquetFile(binary)
+        names = [name for name in parquet.schema_arrow.names if name in table.columns]
+        batches = (
+            list(zip(*(batch.column(name).to_pylist() for name in names)))
+            for batch in parquet.iter_batches(batch_size=batch_size, columns=names)
+        )
+        return names, batches
+
+    text = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+    reader = csv.reader(text)
+    names = next(reader)
+    columns = [table.columns[name] for name in names]
+
+    def batches():
+        batch = []
+        for row in reader:
+            batch.append(tuple(_parse_value(column, value) for column, value in zip(columns, row)))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    return names, batches()
+
+
+def _insertable(table, names):
+    # Суррогатный id рефералов не переносим: его выдаст последовательность, иначе она отстанет от данных
+    return [name for name in names if not (table.columns[name].primary_key and table.columns[name].autoincrement is True)]
+
+
+def _insert_from_staging(table, staging, names):
+    """INSERT ... SELECT из временной таблицы с отбрасыванием висячих ссылок."""
+    names = _insertable(table, names)
+    values = [f"s.{name}" for name in names]
+    where = ""
+    if table is User.__table__ and "invited_by" in names:
+        # Пригласивший может быть в этом же файле: ограничения FK проверяются в конце оператора
+        values[names.index("invited_by")] = (
+            f"CASE WHEN s.invited_by IN (SELECT user_id FROM users UNION ALL SELECT user_id FROM {staging}) "
+            f"THEN s.invited_by END"
+        )
+    if table is Referral.__table__:
+        where = ("WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = s.inviter_id) "
+                 "AND EXISTS (SELECT 1 FROM users u WHERE u.user_id = s.invited_id)")
+    return (f"INSERT INTO {table.name} ({', '.join(names)}) SELECT {', '.join(values)} "
+            f"FROM {staging} s {where} ON CONFLICT DO NOTHING")
+
+
+async def import_table(name: str, path: str, fmt: str = None, batch_size=BULK_BATCH_SIZE):
+    """Загружает файл в таблицу. Возвращает (строк в файле, из них добавлено)."""
+    table = TABLES[name]
+    fmt = detect_format(path, fmt)
+    with _open(path, "rb") as binary:
+        if not _postgres():
+            return await _import_batches(table, fmt, binary, batch_size)
+
+        staging = f"import_{table.name}"
+        async with engine.begin() as conn:
+            driver = await _driver_connection(conn)
+            await driver.execute(f"CREATE TEMP TABLE {staging} (LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP")
+            if fmt == "csv":
+                names = _read_csv_header(binary)
+                status = await driver.copy_to_table(staging, source=binary, columns=names, format="csv")
+                loaded = int(status.split()[-1])
+            else:
+                names, batches = _read_batches(fmt, binary, table, batch_size)
+                loaded = 0
+                for batch in batches:
+                    await driver.copy_records_to_table(staging, records=batch, columns=names)
+                    loaded += len(batch)
+            status = await driver.execute(_insert_from_staging(table, staging, names))
+            return loaded, int(status.split()[-1])  # "INSERT 0 12345"
+
+
+async def _import_batches(table, fmt, binary, batch_size):
+    from app.database.requests import upsert
+
+    names, batches = _read_batches(fmt, binary, table, batch_size)
+    insertable = _insertable(table, names)
+    loaded = inserted = 0
+    async with engine.begin() as conn:
+        for batch in batches:
+            rows = [{name: value for name, value in zip(names, row) if name in insertable} for row in batch]
+            result = await conn.execute(upsert(table).on_conflict_do_nothing(), rows)
+            loaded += len(rows)
+            inserted += max(result.rowcount, 0)
+    return loaded, inserted
+
+
+def prune_condition(inactive_days: int = None, blocked=False, include_referred=False, keep=()):
+    """Кого чистим: давно неактивных и/или заблокировавших бота.
+
+    Приглашённых по умолчанию не трогаем: удаление строки в referrals уменьшит счётчик
+    пригласившего при сверке, и он может потерять доступ.
+    """
+    reasons = []
+    if inactive_days is not None:
+        reasons.append(User.last_activity < datetime.now(timezone.utc) - timedelta(days=inactive_days))
+    if blocked:
+        reasons.append(User.is_blocked.is_(True))
+    if not reasons:
+        raise ValueError("Нужен хотя бы один критерий: inactive_days или blocked")
+    condition = or_(*reasons) & User.is_admin.isnot(True)
+    if keep:
+        condition &= User.user_id.not_in(list(keep))
+    if not include_referred:
+        condition &= ~exists().where(Referral.invited_id == User.user_id)
+    return condition
+
+
+async def prune_users(condition, archive_dir: str = None, batch_size=BULK_BATCH_SIZE, dry_run=False, on_batch=None):
+    """Архивирует и удаляет пользователей по condition пачками. Возвращает число удалённых (или найденных при dry_run).
+
+    on_batch(user_ids) вызывается после коммита каждой пачки — чистка кешей и счётчиков.
+    """
+    sinks = {}
+    if archive_dir and not dry_run:
+        os.makedirs(archive_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        for name, table in TABLES.items():
+            binary = gzip.open(os.path.join(archive_dir, f"{name}-{stamp}.csv.gz"), "wb")
+            sinks[name] = (binary, CsvSink(binary, list(table.columns)))
+
+    total, cursor = 0, None
+    try:
+        while True:
+            async with engine.begin() as conn:
+                query = select(User.__table__).where(condition).order_by(User.user_id).limit(batch_size)
+                if cursor is not None:
+                    query = query.where(User.user_id > cursor)
+                if _postgres():
+                    query = query.with_for_update(skip_locked=True)  # Строки, которые сейчас пишет бот, пропускаем
+                users = (await conn.execute(query)).mappings().all()
+                if not users:
+                    break
+                user_ids = [row["user_id"] for row in users]
+                cursor = user_ids[-1]
+                total += len(user_ids)
+                if dry_run:
+                    continue
+
+                touches = or_(Referral.inviter_id.in_(user_ids), Referral.invited_id.in_(user_ids))
+                if sinks:
+                    referrals = (await conn.execute(select(Referral.__table__).where(touches))).mappings().all()
+                    sinks["users"][1].write(users)
+                    sinks["referrals"][1].write(referrals)
+                # В Postgres рефералы удалит ON DELETE CASCADE, в SQLite внешние ключи выключены
+                await conn.execute(delete(Referral).where(touches))
+                await conn.execute(delete(User).where(User.user_id.in_(user_ids)))
+            if on_batch is not None:
+                await on_batch(user_ids)
+    finally:
+        for binary, sink in sinks.values():
+            sink.close()
+            binary.close()
+    return total
@@ -0,0 +1,100 @@
+"""Движок SQLAlchemy с настраиваемым пулом соединений.
+
+Всё задаётся через окружение. Пул — на процесс: при WORKERS > 1 к Postgres (или pgbouncer)
+идёт до WORKERS × (DB_POOL_SIZE + DB_MAX_OVERFLOW) соединений.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from dotenv import load_dotenv
+
+from app.metrics import DB_CHECKOUT_SECONDS, DB_DISCONNECTS, Gauge
+
+import logging
+import os
+import time
+from uuid import uuid4
+
+load_dotenv()
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))  # Постоянных соединений в пуле
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))  # Временных сверх пула на пиках, закрываются после возврата
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # Сколько секунд хендлер ждёт свободное соединение
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Пересоздавать соединения старше стольких секунд, -1 — никогда
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"  # 0 — без лишнего запроса на каждую выдачу, обрыв ловим по ошибке
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))  # Таймаут установки соединения
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "0"))  # Таймаут одного запроса, 0 — без ограничения
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # Подготовленных запросов asyncpg на соединение
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"  # 1 — pgbouncer в режиме transaction: кеш подготовленных запросов выключен
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который меряет, сколько хендлер ждал соединение (вместе с pre-ping и подключением)."""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _asyncpg_connect_args(pgbouncer):
+    args = {"timeout": DB_CONNECT_TIMEOUT}
+    if DB_COMMAND_TIMEOUT:
+        args["command_timeout"] = DB_COMMAND_TIMEOUT
+    if pgbouncer:
+        # pgbouncer в режиме transaction отдаёт каждую транзакцию произвольному серверному соединению:
+        # подготовленный запрос может не найтись там, где его готовили. Выключаем оба кеша
+        # (asyncpg и SQLAlchemy) и даём запросам уникальные имена, чтобы они не конфликтовали.
+        args["statement_cache_size"] = 0
+        args["prepared_statement_cache_size"] = 0
+        args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+    else:
+        args["prepared_statement_cache_size"] = DB_STATEMENT_CACHE_SIZE
+    return args
+
+
+def engine_options(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                   pool_recycle=DB_POOL_RECYCLE, pre_ping=DB_POOL_PRE_PING, pgbouncer=DB_PGBOUNCER):
+    """Аргументы create_async_engine для этого URL."""
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}  # База в памяти живёт в одном соединении, пул ей не нужен
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pre_ping,
+    }
+    if url.get_driver_name() == "asyncpg":
+        options["connect_args"] = _asyncpg_connect_args(pgbouncer)
+    return options
+
+
+def create_engine(url, **overrides):
+    """Движок с пулом из окружения. overrides — для бенчмарков: pool_size=..., pre_ping=False и т.д."""
+    engine = create_async_engine(url, future=True, **engine_options(url, **overrides))
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _on_disconnect(context):
+        # Без pre-ping оборванное соединение всплывает ошибкой в запросе. SQLAlchemy сама
+        # помечает весь пул устаревшим, следующие выдачи открывают новые соединения.
+        if context.is_disconnect:
+            DB_DISCONNECTS.inc()
+            logging.warning(f"Соединение с БД оборвалось, пул будет переподключён: {context.original_exception}")
+
+    return engine
+
+
+def register_pool_metrics(engine):
+    """Загрузка пула для /metrics. Пул берём в момент сбора: после dispose() он новый."""
+    pool = lambda: engine.sync_engine.pool  # noqa: E731
+    Gauge("db_pool_size", "Постоянных соединений в пуле", lambda: pool().size())
+    Gauge("db_pool_checked_out", "Соединений выдано хендлерам", lambda: pool().checkedout())
+    Gauge("db_pool_checked_in", "Свободных соединений в пуле", lambda: pool().checkedin())
+    Gauge("db_pool_overflow", "Временных соединений сверх пула (отрицательное — пул ещё не заполнен)",
+          lambda: pool().overflow())
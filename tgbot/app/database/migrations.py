@@ -0,0 +1,221 @@
+"""Версионные миграции схемы.
+
+Применённые версии записываются в schema_version, при старте бот только сверяет номер
+с последним в MIGRATIONS. Новая миграция — новый элемент в конце списка, старые не меняются.
+
+Правила для Postgres:
+- индексы создаём и удаляем только CONCURRENTLY (поле concurrent): без блокировки записи в таблицу;
+- ALTER, переписывающие таблицу, оборачиваем в проверку, чтобы не повторять их на готовой схеме;
+- каждый DDL ждёт блокировку не дольше MIGRATION_LOCK_TIMEOUT, а не вешает всех, кто пишет в таблицу.
+
+SQLite используется только в бенчмарках: там схема создаётся из моделей и сразу помечается последней версией.
+
+Запуск вручную из папки tgbot: python -m app.database.migrations [status|upgrade]
+"""
+from sqlalchemy import func, inspect, insert, select, text
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+from app.database.Models import Base, SchemaVersion, engine
+
+import asyncio
+import logging
+import os
+import sys
+
+load_dotenv()
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"  # 0 — при отставании схемы бот не стартует, миграции запускают вручную
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")  # Сколько DDL ждёт блокировку таблицы, потом миграция падает
+MIGRATION_ADVISORY_LOCK = 7_240_001  # Ключ pg_advisory_lock: миграции выполняет только один процесс
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: tuple = ()  # Выполняются в одной транзакции
+    concurrent: tuple = ()  # CREATE/DROP INDEX CONCURRENTLY: вне транзакции, по одному, после statements
+
+
+def _column_type_is_not(column, sql_type):
+    return f"(SELECT data_type FROM information_schema.columns WHERE table_name = 'users' AND column_name = '{column}') <> '{sql_type}'"
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "Типы и значения по умолчанию users (раньше выполнялись на каждом старте)",
+        statements=(
+            # Переписывание таблицы под ACCESS EXCLUSIVE — только если тип ещё не тот
+            f"""DO $$ BEGIN
+                IF {_column_type_is_not('access_granted', 'boolean')} THEN
+                    ALTER TABLE users ALTER COLUMN access_granted TYPE BOOLEAN USING access_granted::BOOLEAN;
+                END IF;
+                IF {_column_type_is_not('is_admin', 'boolean')} THEN
+                    ALTER TABLE users ALTER COLUMN is_admin TYPE BOOLEAN USING is_admin::BOOLEAN;
+                END IF;
+                IF (SELECT is_nullable FROM information_schema.columns
+                    WHERE table_name = 'users' AND column_name = 'created_at') = 'YES' THEN
+                    UPDATE users SET created_at = NOW() WHERE created_at IS NULL;
+                    ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;
+                END IF;
+            END $$""",
+            "ALTER TABLE users ALTER COLUMN created_at SET DEFAULT NOW()",
+            # С Postgres 11 колонка с константным DEFAULT добавляется без переписывания таблицы
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT FALSE",
+        ),
+    ),
+    Migration(
+        2,
+        "Удалены индексы, дублирующие первичный ключ и уникальные ограничения",
+        # Пару (inviter_id, invited_id) и так делает уникальной unique на invited_id
+        statements=("ALTER TABLE referrals DROP CONSTRAINT IF EXISTS unique_referral_pair",),
+        concurrent=(
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_user_user_id",  # Дублирует первичный ключ users
+            "DROP INDEX CONCURRENTLY IF EXISTS ix_referral_invited_id",  # Дублирует уникальный индекс invited_id
+        ),
+    ),
+    Migration(
+        3,
+        "Журнал событий activity_events (секции по дням) и дневная свёртка activity_daily",
+        # Таблицы новые и пустые: блокировать некого, секции создаёт app/database/analytics.py
+        statements=(
+            """CREATE TABLE IF NOT EXISTS activity_events (
+                ts TIMESTAMPTZ NOT NULL,
+                user_id BIGINT NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                handler VARCHAR(64),
+                value INTEGER NOT NULL DEFAULT 0
+            ) PARTITION BY RANGE (ts)""",
+            """CREATE TABLE IF NOT EXISTS activity_daily (
+                day DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                messages INTEGER NOT NULL DEFAULT 0,
+                callbacks INTEGER NOT NULL DEFAULT 0,
+                ai_requests INTEGER NOT NULL DEFAULT 0,
+                ai_tokens INTEGER NOT NULL DEFAULT 0,
+                signups INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, user_id)
+            )""",
+        ),
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _read_version(sync_conn):
+    """Текущая версия схемы; None — таблицы schema_version ещё нет."""
+    if not inspect(sync_conn).has_table(SchemaVersion.__tablename__):
+        return None
+    return sync_conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def _has_users(sync_conn):
+    return inspect(sync_conn).has_table("users")
+
+
+async def current_version():
+    async with engine.connect() as conn:
+        return await conn.run_sync(_read_version)
+
+
+async def _drop_invalid_indexes(conn):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, и IF NOT EXISTS его пропустит
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE NOT i.indisvalid AND n.nspname = current_schema()"
+    ))
+    for (name,) in result:
+        logging.warning(f"Миграции: удаляем невалидный индекс {name}")
+        await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+
+
+async def _apply(migration: Migration, lock_conn):
+    logging.info(f"Миграция {migration.version}: {migration.description}")
+    async with engine.begin() as conn:
+        await conn.execute(text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+        for statement in migration.statements:
+            await conn.execute(text(statement))
+
+    if migration.concurrent:
+        await _drop_invalid_indexes(lock_conn)
+        for statement in migration.concurrent:
+            await lock_conn.execute(text(statement))
+
+    async with engine.begin() as conn:
+        await conn.execute(insert(SchemaVersion).values(version=migration.version, description=migration.description))
+
+
+async def _create_schema(lock_conn):
+    """Создаёт недостающие таблицы. Возвращает версию, с которой продолжать миграции."""
+    fresh = not await lock_conn.run_sync(_has_users)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    if fresh or engine.dialect.name != "postgresql":
+        # Таблицы созданы по актуальным моделям — догонять нечего
+        async with engine.begin() as conn:
+            await conn.execute(insert(SchemaVersion).values(version=LATEST_VERSION, description="Схема создана по моделям"))
+        return LATEST_VERSION
+    return 0  # База создана до появления миграций: применяем всё по порядку
+
+
+async def upgrade():
+    """Применяет недостающие миграции. Возвращает номера применённых."""
+    applied = []
+    async with engine.connect() as lock_conn:
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        postgres = engine.dialect.name == "postgresql"
+        if postgres:
+            await lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_ADVISORY_LOCK})
+            await lock_conn.execute(text(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+        try:
+            # Версию читаем уже под блокировкой: другой процесс мог всё применить, пока мы ждали
+            current = await lock_conn.run_sync(_read_version)
+            if current is None:
+                current = await _create_schema(lock_conn)
+            for migration in MIGRATIONS:
+                if migration.version > current:
+                    await _apply(migration, lock_conn)
+                    applied.append(migration.version)
+        finally:
+            if postgres:
+                await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_ADVISORY_LOCK})
+    return applied
+
+
+async def init_db():
+    """Проверка схемы при старте: один взгляд на schema_version, миграции — только если отстаём."""
+    current = await current_version()
+    if current == LATEST_VERSION:
+        return
+    if current is not None and current > LATEST_VERSION:
+        logging.warning(f"Схема БД новее кода: версия {current}, код знает до {LATEST_VERSION}")
+        return
+    if not MIGRATE_ON_STARTUP:
+        raise RuntimeError(
+            f"Схема БД устарела (версия {current}, нужна {LATEST_VERSION}): "
+            f"выполните python -m app.database.migrations upgrade"
+        )
+    applied = await upgrade()
+    if applied:
+        logging.info(f"Применены миграции: {applied}")
+
+
+async def _main(command):
+    try:
+        if command == "upgrade":
+            applied = await upgrade()
+            print(f"Применены миграции: {applied}" if applied else "Схема актуальна")
+        elif command == "status":
+            print(f"Версия схемы: {await current_version()}, последняя: {LATEST_VERSION}")
+        else:
+            print("Использование: python -m app.database.migrations [status|upgrade]")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else ""))
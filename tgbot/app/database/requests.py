@@ -0,0 +1,256 @@
+from sqlalchemy import func, literal, literal_column, select, update, text
+from sqlalchemy.dialects import postgresql, sqlite
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from app.database.Models import User, Referral, engine, async_session_maker
+
+
+def upsert(table):
+    # ON CONFLICT поддерживают и Postgres, и SQLite (его используем только в локальных бенчмарках)
+    if engine.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+async def touch_user(user_id: int):
+    """Создаёт пользователя или обновляет last_activity и сразу возвращает (referral_count, создан_ли_сейчас).
+
+    Раз пользователь пишет боту, значит он его не блокирует — сбрасываем is_blocked.
+    Один запрос в режиме AUTOCOMMIT: без отдельных BEGIN/COMMIT и без предварительного SELECT.
+    """
+    now = datetime.now(timezone.utc)
+    # xmax = 0 только у строки, которую этот запрос вставил, а не обновил
+    created = literal(False) if engine.dialect.name == "sqlite" else literal_column("xmax = 0")
+    stmt = (
+        upsert(User)
+        .values(user_id=user_id, last_activity=now)
+        .on_conflict_do_update(index_elements=[User.user_id], set_={"last_activity": now, "is_blocked": False})
+        .returning(User.referral_count, created)
+    )
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        result = await conn.execute(stmt)
+        referral_count, is_new = result.one()
+        return referral_count or 0, bool(is_new)
+
+
+async def bulk_update_last_activity(rows) -> int:
+    """Записывает пачку (user_id, last_activity) одним UPDATE ... FROM unnest(...)."""
+    if not rows:
+        return 0
+    user_ids = [user_id for user_id, _ in rows]
+    timestamps = [ts for _, ts in rows]
+
+    async with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # В SQLite нет массивов, для локальных бенчмарков хватит executemany
+            await conn.execute(
+                text("UPDATE users SET last_activity = :ts, is_blocked = false WHERE user_id = :user_id"),
+                [{"user_id": user_id, "ts": ts} for user_id, ts in rows],
+            )
+            return len(rows)
+
+        result = await conn.execute(
+            text(
+                "UPDATE users AS u SET last_activity = v.last_activity, is_blocked = false "
+                "FROM unnest(CAST(:user_ids AS BIGINT[]), CAST(:timestamps AS TIMESTAMPTZ[])) "
+                "AS v(user_id, last_activity) "
+                "WHERE u.user_id = v.user_id"
+            ),
+            {"user_ids": user_ids, "timestamps": timestamps},
+        )
+        return result.rowcount
+
+
+async def fetch_user_ids_after(cursor: int, limit: int):
+    """Следующая страница получателей рассылки по ключу user_id, без OFFSET и без загрузки всей таблицы."""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(User.user_id)
+            .where(User.user_id > cursor, User.is_blocked.is_(False))
+            .order_by(User.user_id)
+            .limit(limit)
+        )
+        return list(result.scalars())
+
+
+async def count_reachable_users() -> int:
+    async with async_session_maker() as session:
+        return await session.scalar(select(func.count(User.user_id)).where(User.is_blocked.is_(False))) or 0
+
+
+async def mark_users_blocked(user_ids):
+    """Помечает пользователей, заблокировавших бота, чтобы следующие рассылки их пропускали."""
+    if not user_ids:
+        return
+    async with async_session_maker() as session:
+        await session.execute(update(User).where(User.user_id.in_(user_ids)).values(is_blocked=True))
+        await session.commit()
+
+
+async def increment_referral_count(session, inviter_id: int):
+    """Атомарно +1 к счётчику пригласившего и выдача доступа одним UPDATE ... RETURNING.
+
+    Возвращает новое значение счётчика (None, если пользователя нет). Коммит — на вызывающем.
+    """
+    new_count = func.coalesce(User.referral_count, 0) + 1
+    result = await session.execute(
+        update(User)
+        .where(User.user_id == inviter_id)
+        .values(referral_count=new_count, access_granted=new_count >= 2)
+        .returning(User.referral_count)
+    )
+    return result.scalar_one_or_none()
+
+
+async def get_referral_count(session, user_id: int) -> int:
+    return await session.scalar(select(User.referral_count).where(User.user_id == user_id)) or 0
+
+
+async def reconcile_referral_counts_after(cursor: int, limit: int):
+    """Сверяет users.referral_count с таблицей referrals для следующей страницы пользователей.
+
+    Возвращает (новый курсор или None, если страниц больше нет, [(user_id, исправленный счётчик)]).
+
+    Исправление пишется с условием «счётчик всё ещё тот, что мы прочитали». Если между чтением и UPDATE
+    register_user успел сделать +1, строка пропускается: иначе сверка записала бы число рефералов
+    из старого снимка поверх свежего инкремента. Пропущенное поправит следующий проход.
+    """
+    async with async_session_maker() as session:
+        actual = select(func.count(Referral.id)).where(Referral.inviter_id == User.user_id).scalar_subquery()
+        rows = (await session.execute(
+            select(User.user_id, User.referral_count, actual)
+            .where(User.user_id > cursor).order_by(User.user_id).limit(limit)
+        )).all()
+        if not rows:
+            return None, []
+
+        fixed = []
+        for user_id, stored, count in rows:
+            if stored == count:
+                continue
+            result = await session.execute(
+                update(User)
+                .where(User.user_id == user_id, User.referral_count == stored)
+                .values(referral_count=count, access_granted=count >= 2)
+                .returning(User.user_id)
+            )
+            if result.scalar_one_or_none() is not None:
+                fixed.append((user_id, count))
+        await session.commit()
+        return rows[-1][0], fixed
+
+
+@dataclass
+class Registration:
+    created: bool  # Пользователь появился в базе только что
+    referral_count: int  # Сколько пригласил сам пользователь
+    previous_inviter: int = None  # Кто пригласил раньше, если пользователь уже чей-то реферал
+    previous_inviter_name: str = None
+    inviter_exists: bool = False
+    inviter_count: int = None  # Новый счётчик пригласившего; None — реферал не засчитан
+
+    @property
+    def referred(self) -> bool:
+        return self.inviter_count is not None
+
+
+# Регистрация целиком одним запросом: upsert пользователя, запись в referrals и +1 пригласившему.
+# before читает состояние до запроса; ON CONFLICT (invited_id) DO NOTHING делает повторные и
+# одновременные /start с одной ссылкой безопасными: реферал засчитывается ровно один раз.
+REGISTER_USER_SQL = """
+WITH before AS (
+    SELECT invited_by FROM users WHERE user_id = :user_id
+),
+inviter AS (
+    SELECT user_id FROM users
+    WHERE user_id = :inviter_id AND user_id <> :user_id
+      AND NOT EXISTS (SELECT 1 FROM referrals WHERE invited_id = :user_id)
+),
+upserted AS (
+    INSERT INTO users (user_id, invited_by, referral_count, access_granted, is_admin, is_blocked, last_activity)
+    VALUES (:user_id, (SELECT user_id FROM inviter), 0, false, false, false, now())
+    ON CONFLICT (user_id) DO UPDATE SET
+        invited_by = COALESCE(users.invited_by, EXCLUDED.invited_by),
+        last_activity = EXCLUDED.last_activity,
+        is_blocked = false
+    RETURNING user_id, invited_by, referral_count, (xmax = 0) AS created
+),
+referral AS (
+    INSERT INTO referrals (inviter_id, invited_id)
+    SELECT u.invited_by, u.user_id FROM upserted u
+    WHERE u.invited_by IN (SELECT user_id FROM inviter)
+      AND (SELECT invited_by FROM before) IS NULL
+    ON CONFLICT (invited_id) DO NOTHING
+    RETURNING inviter_id
+),
+bumped AS (
+    UPDATE users SET
+        referral_count = COALESCE(referral_count, 0) + 1,
+        access_granted = COALESCE(referral_count, 0) + 1 >= 2
+    WHERE user_id IN (SELECT inviter_id FROM referral)
+    RETURNING referral_count
+)
+SELECT
+    u.created,
+    COALESCE(u.referral_count, 0) AS referral_count,
+    b.invited_by AS previous_inviter,
+    p.username AS previous_inviter_name,
+    EXISTS (SELECT 1 FROM users WHERE user_id = :inviter_id) AS inviter_exists,
+    (SELECT referral_count FROM bumped) AS inviter_count
+FROM upserted u
+LEFT JOIN before b ON true
+LEFT JOIN users p ON p.user_id = b.invited_by
+"""
+
+
+async def register_user(user_id: int, inviter_id: int = None) -> Registration:
+    """Создаёт пользователя (или обновляет last_activity) и засчитывает реферала в одной транзакции.
+
+    Соединение занято только на время одного запроса: уведомления отправляются уже после коммита.
+    """
+    async with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            return await _register_user_sqlite(conn, user_id, inviter_id)
+        row = (await conn.execute(text(REGISTER_USER_SQL), {"user_id": user_id, "inviter_id": inviter_id})).one()
+        return Registration(**row._mapping)
+
+
+async def _register_user_sqlite(conn, user_id, inviter_id):
+    # SQLite (локальные бенчмарки) не умеет изменяющие CTE: те же шаги отдельными запросами
+    before = (await conn.execute(
+        select(User.invited_by, User.referral_count).where(User.user_id == user_id)
+    )).one_or_none()
+    previous_inviter = before.invited_by if before else None
+    previous_inviter_name = None
+    if previous_inviter is not None:
+        previous_inviter_name = await conn.scalar(select(User.username).where(User.user_id == previous_inviter))
+
+    inviter_exists = inviter_id is not None and bool(
+        await conn.scalar(select(func.count(User.user_id)).where(User.user_id == inviter_id))
+    )
+    now = datetime.now(timezone.utc)
+    if before is None:
+        await conn.execute(upsert(User).values(user_id=user_id, last_activity=now).on_conflict_do_nothing())
+    else:
+        await conn.execute(update(User).where(User.user_id == user_id).values(last_activity=now, is_blocked=False))
+
+    inviter_count = None
+    if inviter_exists and inviter_id != user_id and previous_inviter is None:
+        inserted = await conn.execute(
+            upsert(Referral).values(inviter_id=inviter_id, invited_id=user_id)
+            .on_conflict_do_nothing(index_elements=[Referral.invited_id])
+        )
+        if inserted.rowcount:
+            await conn.execute(update(User).where(User.user_id == user_id).values(invited_by=inviter_id))
+            inviter_count = await increment_referral_count(conn, inviter_id)
+
+    return Registration(
+        created=before is None,
+        referral_count=(before.referral_count or 0) if before else 0,
+        previous_inviter=previous_inviter,
+        previous_inviter_name=previous_inviter_name,
+        inviter_exists=inviter_exists,
+        inviter_count=inviter_count,
+    )
@@ -0,0 +1,212 @@
+"""Журнал событий для аналитики: кто, когда и что делал в боте.
+
+Хендлеры только кладут кортеж в буфер процесса. Фоновая задача пишет накопленное пачкой:
+в Postgres — COPY в секционированную по дням activity_events (без индексов, users и referrals не трогаются),
+либо Parquet-файлами по дням в EVENTS_DIR (нужен pyarrow; файлы читаются DuckDB/pandas с hive-разбиением).
+Раз в EVENTS_ROLLUP_INTERVAL один процесс кластера создаёт секции наперёд, пересчитывает дневную свёртку
+activity_daily и удаляет секции старше EVENTS_RETENTION_DAYS. Админские отчёты читают только свёртку.
+
+События: message и callback (с именем хендлера), ai (value — потраченные токены), signup.
+"""
+from aiogram import BaseMiddleware
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+from app.database.analytics import (
+    EVENT_COLUMNS, drop_partitions_before, ensure_partitions, insert_events, last_rollup_day, rollup_days,
+)
+from app.locks import singleton_lock
+from app.metrics import Gauge
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+load_dotenv()
+
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "postgres")  # postgres, file (Parquet, нужен pyarrow) или off
+EVENTS_DIR = os.getenv("EVENTS_DIR", "events")  # Папка для EVENTS_BACKEND=file
+EVENTS_FLUSH_INTERVAL = float(os.getenv("EVENTS_FLUSH_INTERVAL", "10"))  # Как часто сбрасываем буфер
+EVENTS_BATCH = int(os.getenv("EVENTS_BATCH", "10000"))  # Строк в одном COPY
+EVENTS_MAX_BUFFER = int(os.getenv("EVENTS_MAX_BUFFER", "200000"))  # Дальше события теряются, хендлеры не ждут
+EVENTS_RETENTION_DAYS = int(os.getenv("EVENTS_RETENTION_DAYS", "90"))  # Сырые события; свёртка хранится всегда
+EVENTS_PARTITIONS_AHEAD = int(os.getenv("EVENTS_PARTITIONS_AHEAD", "3"))  # Секции на столько дней вперёд
+EVENTS_ROLLUP_INTERVAL = float(os.getenv("EVENTS_ROLLUP_INTERVAL", "3600"))  # Обслуживание: секции, свёртка, хранение
+
+MAINTENANCE_LOCK = "events:maintenance"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise RuntimeError("Для EVENTS_BACKEND=file нужен pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+class EventLog:
+    """Буфер событий с отложенной записью пачками и периодическим обслуживанием журнала."""
+
+    def __init__(self, backend=EVENTS_BACKEND, directory=EVENTS_DIR, interval=EVENTS_FLUSH_INTERVAL,
+                 batch_size=EVENTS_BATCH, max_buffer=EVENTS_MAX_BUFFER, retention_days=EVENTS_RETENTION_DAYS,
+                 partitions_ahead=EVENTS_PARTITIONS_AHEAD, maintenance_interval=EVENTS_ROLLUP_INTERVAL):
+        self.backend = backend
+        self.directory = directory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.retention_days = retention_days
+        self.partitions_ahead = partitions_ahead
+        self.maintenance_interval = maintenance_interval
+        self.buffer = []  # (ts, user_id, kind, handler, value)
+        self._task = None
+        self._stopping = None
+        self._next_maintenance = 0.0
+
+        # Метрики
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.flushes = 0
+        self.maintenance_runs = 0
+
+    def record(self, user_id: int, kind: str, handler: str = None, value: int = 0):
+        if self.backend == "off":
+            return
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1  # База или диск не успевают: аналитика важнее не тормозить ответы
+            return
+        self.recorded += 1
+        self.buffer.append((datetime.now(timezone.utc), user_id, kind, handler, value))
+
+    async def _write_postgres(self, rows):
+        try:
+            await insert_events(rows)
+        except Exception:
+            # Чаще всего — нет секции (процесс проспал обслуживание или часы ушли вперёд): создаём и повторяем
+            first, last = rows[0][0].date(), rows[-1][0].date()
+            await ensure_partitions((last - first).days, start=first)
+            await insert_events(rows)
+
+    def _write_files(self, rows):
+        pyarrow = _pyarrow()
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row[0].date(), []).append(row)
+        for day, day_rows in by_day.items():
+            directory = os.path.join(self.directory, f"date={day.isoformat()}")
+            os.makedirs(directory, exist_ok=True)
+            table = pyarrow.table({column: [row[i] for row in day_rows] for i, column in enumerate(EVENT_COLUMNS)})
+            pyarrow.parquet.write_table(table, os.path.join(directory, f"part-{time.time_ns()}-{os.getpid()}.parquet"))
+
+    async def flush(self):
+        if not self.buffer:
+            return 0
+        rows, self.buffer = self.buffer, []
+
+        written = 0
+        try:
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                if self.backend == "file":
+                    await asyncio.to_thread(self._write_files, batch)
+                else:
+                    await self._write_postgres(batch)
+                written += len(batch)
+        except Exception as e:
+            logging.error(f"Не удалось записать журнал событий: {e}")
+            # Незаписанное возвращаем в начало буфера, сколько влезет
+            self.buffer = rows[written:][:self.max_buffer] + self.buffer
+            self.dropped += max(0, len(rows) - written - self.max_buffer)
+        self.written += written
+        self.flushes += 1
+        return written
+
+    def _drop_old_files(self, cutoff):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith("date=") and name[5:] < cutoff.isoformat():
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    async def run_maintenance(self):
+        """Секции наперёд, свёртка за дни с прошлой свёртки и удаление старых секций. Один процесс на кластер."""
+        lock = await singleton_lock(MAINTENANCE_LOCK, ttl=max(60, int(self.maintenance_interval)))
+        if not await lock.acquire():
+            return False
+        # Как у сверки рефералов: замок истечёт сам, другие процессы не повторят работу раньше
+        today = datetime.now(timezone.utc).date()
+        cutoff = today - timedelta(days=self.retention_days)
+        if self.backend == "file":
+            await asyncio.to_thread(self._drop_old_files, cutoff)
+        else:
+            await ensure_partitions(self.partitions_ahead)
+            # Вчерашний день пересчитываем всегда: другие процессы могли дописать его после полуночи
+            first = min(await last_rollup_day() or cutoff, today - timedelta(days=1))
+            await rollup_days(max(first, cutoff), today)
+            await drop_partitions_before(cutoff)
+        self.maintenance_runs += 1
+        return True
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+            if time.monotonic() >= self._next_maintenance and not self._stopping.is_set():
+                self._next_maintenance = time.monotonic() + self.maintenance_interval
+                try:
+                    await self.run_maintenance()
+                except Exception as e:
+                    logging.error(f"Ошибка обслуживания журнала событий: {e}")
+
+    def start(self):
+        if self.backend == "off":
+            return
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает буфер."""
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "pending": len(self.buffer),
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "maintenance_runs": self.maintenance_runs,
+        }
+
+
+event_log = EventLog()
+
+Gauge("events_buffer_pending", "События в буфере, ещё не записанные в журнал", lambda: len(event_log.buffer))
+
+
+class EventLogMiddleware(BaseMiddleware):
+    """Пишет в журнал каждое пропущенное гейтом сообщение или нажатие кнопки с именем хендлера."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        super().__init__()
+
+    async def __call__(self, handler, event, data):
+        if event.from_user:
+            handler_object = data.get("handler")
+            event_log.record(event.from_user.id, self.kind,
+                             handler_object.callback.__name__ if handler_object else None)
+        return await handler(event, data)
@@ -1,5 +1,4 @@
 
-from mistralai import Mistral
 import os
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database.Models import User, Referral
@@ -10,71 +9,70 @@ import logging
 
 from dotenv import load_dotenv
 from app.redis_client import init_redis
+from app.ai_client import init_ai_client
+from app.ai_cache import answer_cache
+from app.database.requests import get_referral_count
+from app.referrals import REFERRAL_COUNT_KEY, REFERRAL_CACHE_TTL
 
 load_dotenv()
 
 #logging.basicConfig(filename="admin_logs.log", level=logging.INFO, format="%(asctime)s - %(message)s")
 
-async def add_referral(session: AsyncSession, inviter_id: int, invited_id: int, bot: Bot):
-    inviter = await session.get(User, inviter_id)
-    invited = await session.get(User, invited_id)
-
-    if not inviter or not invited:
-        return
-
-    # Проверяем, не был ли пользователь уже засчитан как чей-то реферал
-    if invited.invited_by:
-        inviter_user = await session.get(User, invited.invited_by)
-        inviter_name = inviter_user.username if inviter_user and inviter_user.username else invited.invited_by
-        await bot.send_message(invited_id, f"⛔ Вы уже являетесь рефералом пользователя {inviter_name}!")
-        return
-
-    invited.invited_by = inviter_id
-    inviter.referral_count += 1
-    session.add(Referral(inviter_id=inviter_id, invited_id=invited_id))
-
-    await bot.send_message(invited_id, "✅ Вы были зарегистрированы как реферал!")
-    
-    if inviter.referral_count >= 2:
-        inviter.access_granted = 1  # Даем доступ
-        await bot.send_message(inviter_id, "🎉 Поздравляю! Вы пригласили 2-х друзей и теперь можете пользоваться ботом!")
-    else:
-        await bot.send_message(inviter_id, f"✅ {inviter.referral_count}/2 рефералов приглашены!")
-
-    await session.commit()
-
 async def check_referrals(session: AsyncSession, user_id: int) -> int:
     redis = await init_redis()
     
     # Проверяем кеш
-    referral_count = await redis.get(f"user:{user_id}:referral_count")
+    referral_count = await redis.get(REFERRAL_COUNT_KEY.format(user_id=user_id))
     if referral_count is not None:
         return int(referral_count)
     
-    # Если в кеше нет, запрашиваем из БД
-    result = await session.execute(
-        text("SELECT COUNT(*) FROM referrals WHERE inviter_id = :user_id"),
-        {"user_id": user_id}
-    )
-    referral_count = result.scalar() or 0
-
-    # Кешируем на 10 минут
-    await redis.setex(f"user:{user_id}:referral_count", 600, referral_count)
+    # Если в кеше нет, берём готовый счётчик из users, без COUNT(*) по referrals
+    referral_count = await get_referral_count(session, user_id)
+    await redis.set(REFERRAL_COUNT_KEY.format(user_id=user_id), referral_count, ex=REFERRAL_CACHE_TTL)
     return referral_count
 
 
 #async def log_action(message: Message, admin_id: int, action: str):
 #    logging.info(f"Админ {admin_id}: {action}")
 
-async def general(content):
-    s = Mistral(
-        api_key=os.getenv('AI_TOKEN'),
-    )
-    res = await s.chat.complete_async(model="mistral-small-latest", messages=[
+def _build_messages(content):
+    # Можно передать готовый список сообщений (например, окно истории диалога)
+    if isinstance(content, list):
+        return content
+    return [
         {
             "content": content,
             "role": "user",
         },
-    ])
-    if res is not None:
-        return res
\ No newline at end of file
+    ]
+
+async def general(content):
+    """Возвращает текст ответа ИИ. Повторы и одновременные одинаковые вопросы обслуживает кеш."""
+    messages = _build_messages(content)
+    tier = init_ai_client().route(messages)  # Ключ кеша — ярус моделей, а не конкретный бэкенд
+    return await answer_cache.get_or_call(tier.cache_key, messages, lambda: _complete(messages))
+
+async def _complete(messages):
+    client = init_ai_client()  # Общий роутер с пулом соединений, создаётся один раз в main()
+    res = await client.complete(messages)
+    if res is not None and res.choices:
+        return res.choices[0].message.content
+
+async def general_stream(content):
+    """Отдаёт ответ ИИ кусками по мере генерации (из кеша — одним куском)."""
+    messages = _build_messages(content)
+    tier = init_ai_client().route(messages)
+    async for delta in answer_cache.stream_through(tier.cache_key, messages, lambda: _stream(messages)):
+        yield delta
+
+async def _stream(messages):
+    client = init_ai_client()
+    async for chunk in client.stream(messages):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if isinstance(delta, str):
+            yield delta
+        elif delta:
+            # Ответ может прийти списком чанков, берём только текст
+            yield "".join(getattr(part, "text", "") or "" for part in delta)
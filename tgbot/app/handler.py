@@ -1,6 +1,6 @@
 from aiogram import F, Router, Bot
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.filters.state import StateFilter
@@ -18,31 +18,38 @@ import os
 import asyncio
 import logging
 import sys
-from logging.handlers import RotatingFileHandler
 
 import app.Keyboards as kb
 from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton)
 
 from app.Keyboards import get_referral_keyboard
-from app.Middleware import TestMiddleware
-from app.general import general, add_referral, check_referrals
-from app.database.Models import User, async_session_maker
+from app.Middleware import UserGate, FIRST_QUESTION_KEY
+from app.alerts import admin_alerter
+from app.cache import cache_stats, first_questions
+from app.database.requests import register_user
+from app.referrals import cache_referral_count
+from app.outbox import outbox
+from app.sender import send_scheduler
 from app.redis_client import init_redis
+from app.ai_client import init_ai_client
+from app.ai_keys import add_key, load_keys, mask, remove_key
+from app.streaming import answer_ai
+from app.history import start_turn, finish_turn, clear_history
+from app.broadcast import is_broadcast_running, launch_broadcast
+from app.stats import collect_stats, record_signup
+from app.ai_cache import answer_cache
+from app.ai_queue import ai_queue, DROPPED
+from app.logs import LogExport, logs_size
+from app.events import event_log
+from app.metrics import count_ai_tokens
+from app.database.analytics import ai_usage, retention_cohorts, rollup_days
 
 router = Router()
 
 load_dotenv()
 
-# Настройка ротации логов
-log_file = "admin_logs.log"
-log_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3)
-log_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
-
-# Применяем настройки ротации логов
-logging.basicConfig(handlers=[log_handler], level=logging.INFO)
-
-router.message.outer_middleware(TestMiddleware())
 ADMIN_ID = (os.getenv("ADMIN_ID"))  # Убедись, что ID задан в .env
+AI_KEYS_PROVIDER = "mistral"  # Чьи ключи управляются из админ-панели
 
 class BroadcastState(StatesGroup):
     waiting_for_message = State()
@@ -51,9 +58,6 @@ class Reg(StatesGroup):
     name = State()
     number = State()
 
-class Work(StatesGroup):
-    process = State()
-
 class APIKeyChange(StatesGroup):
     waiting_for_new_api = State()
 
@@ -61,74 +65,69 @@ class APIKeyChange(StatesGroup):
 async def cmd_start(message: Message, bot: Bot):
     user_id = message.from_user.id
     args = message.text.split()
+    inviter_id = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+
+    # Пользователь, реферал и счётчик пригласившего — одним запросом в одной транзакции
+    registration = await register_user(user_id, inviter_id)
+    if registration.created:
+        await record_signup()
+        event_log.record(user_id, "signup")
+
+    # Обработка реферального кода
+    if inviter_id is not None:
+        if inviter_id == user_id:
+            await message.answer("⛔ Нельзя приглашать самого себя!")
+            return
 
-    async with async_session_maker() as session:
-        user = await session.get(User, user_id)
-
-        if user is None:
-            user = User(user_id=user_id)
-            session.add(user)
-            await session.commit()
-
-        # Обработка реферального кода
-        if len(args) > 1 and args[1].isdigit():
-            inviter_id = int(args[1])
-            
-            if inviter_id == user_id:
-                await message.answer("⛔ Нельзя приглашать самого себя!")
-                return
-            
-            if user.invited_by is not None:
-                inviter = await session.get(User, user.invited_by)
-                inviter_name = inviter.username if inviter and inviter.username else user.invited_by
-                await message.answer(f"⛔ Вы уже зарегистрированы как реферал у {inviter_name}!")
-                return
-            
-            existing_referral = await session.execute(
-                text("SELECT 1 FROM referrals WHERE invited_id = :user_id"),
-                {"user_id": user_id}
-            )
-            if existing_referral.scalar():
-                await message.answer("⛔ Вы уже засчитаны как чей-то реферал!")
-                return
-
-            # Добавляем реферала
-            await add_referral(session, inviter_id, user_id, bot)
-
-        # Проверяем количество приглашенных рефералов
-        referral_count = await check_referrals(session, user_id)
-
-        start_keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="Начать диалог")]], resize_keyboard=True
-        )
+        if registration.previous_inviter is not None:
+            inviter_name = registration.previous_inviter_name or registration.previous_inviter
+            await message.answer(f"⛔ Вы уже зарегистрированы как реферал у {inviter_name}!")
+            return
 
-        if referral_count >= 2:
-            await message.answer(
-                "🎉 Поздравляю! Вы можете пользоваться ботом!\n"
-                "Нажмите 'Начать диалог', чтобы задать вопрос.", reply_markup=start_keyboard
-            )
-        else:
-            await message.reply(
-                "Добро пожаловать! 😊\n"
-                "🎁 Можете задать 1-й тестовый вопрос, чтобы убедиться в качестве ответов\n"
-                "Чтобы получить полный доступ, пригласите 2 друзей.\n"
-                "Используя бота, вы поддерживаете его бесплатность ❤️",
-                reply_markup=kb.get_referral_keyboard(user_id)
-            )
+        if registration.referred:
+            await cache_referral_count(inviter_id, registration.inviter_count)  # Сквозная запись в кеш
+            # Уведомления уходят после коммита, в фоне
+            outbox.send(user_id, "✅ Вы были зарегистрированы как реферал!")
+            # Прогресс пригласившего — одна тема: если прошлое уведомление ещё не ушло, шлём только свежее
+            if registration.inviter_count >= 2:
+                outbox.send(inviter_id, "🎉 Поздравляю! Вы пригласили 2-х друзей и теперь можете пользоваться ботом!", key="referrals")
+            else:
+                outbox.send(inviter_id, f"✅ {registration.inviter_count}/2 рефералов приглашены!", key="referrals")
+        elif registration.inviter_exists:
+            await message.answer("⛔ Вы уже засчитаны как чей-то реферал!")
+            return
+
+    referral_count = registration.referral_count
+    await cache_referral_count(user_id, referral_count)
+
+    start_keyboard = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text="Начать диалог")]], resize_keyboard=True
+    )
+
+    if referral_count >= 2:
+        await message.answer(
+            "🎉 Поздравляю! Вы можете пользоваться ботом!\n"
+            "Нажмите 'Начать диалог', чтобы задать вопрос.", reply_markup=start_keyboard
+        )
+    else:
+        await message.reply(
+            "Добро пожаловать! 😊\n"
+            "🎁 Можете задать 1-й тестовый вопрос, чтобы убедиться в качестве ответов\n"
+            "Чтобы получить полный доступ, пригласите 2 друзей.\n"
+            "Используя бота, вы поддерживаете его бесплатность ❤️",
+            reply_markup=kb.get_referral_keyboard(user_id)
+        )
 
 @router.message(F.text == "Начать диалог")
-async def start_dialog(message: Message):
+async def start_dialog(message: Message, gate: UserGate):
     user_id = message.from_user.id
 
-    async with async_session_maker() as session:
-        referral_count = await check_referrals(session, user_id)
-
-        if referral_count < 2:
-            await message.answer(
-                "⛔ У вас недостаточно рефералов! Пригласите 2-х друзей, чтобы получить доступ.",
-                reply_markup=get_referral_keyboard(user_id)
-            )
-            return
+    if gate.referral_count < 2:
+        await message.answer(
+            "⛔ У вас недостаточно рефералов! Пригласите 2-х друзей, чтобы получить доступ.",
+            reply_markup=get_referral_keyboard(user_id)
+        )
+        return
 
     await message.answer(
         "Напишите мне любой вопрос — о учёбе, личной жизни, кулинарии или чем угодно. Я помогу! 😊"
@@ -147,7 +146,8 @@ async def admin_panel(message: Message, bot: Bot):
                          "1️⃣ Статистика\n"
                          "2️⃣ Рассылка\n"
                          "3️⃣ Логи\n"
-                         "4️⃣ Сменить API",
+                         "4️⃣ Сменить API\n"
+                         "5️⃣ Аналитика",
                          reply_markup=kb.admin_keyboard())
 
 @router.message(F.text == "📊 Статистика")
@@ -158,38 +158,93 @@ async def user_stats(message: Message):
         return
     #await log_action(message, message.chat.id, "Запросил статистику пользователей")  # Логируем действие
 
-    redis = await init_redis()  # Подключение к Redis
-    stats_cache = await redis.get("stats")
+    # Счётчики ведутся инкрементально в Redis, таблицу users не сканируем
+    stats = await collect_stats()
+
+    text = (
+        f"👥 Всего пользователей: {stats['total_users']}\n"
+        f"📅 Активных сегодня: {stats['active_today']}\n"
+        f"📆 Активных за неделю: {stats['active_week']}\n"
+        f"📅 Активных за месяц: {stats['active_month']}\n\n"
+        f"🆕 Новых сегодня: {stats['new_today']}\n"
+        f"🆕 Новых за неделю: {stats['new_week']}\n"
+        f"🆕 Новых за месяц: {stats['new_month']}"
+    )
 
-    if stats_cache:
-        await message.answer(stats_cache)  # Отправляем кэшированные данные и не нагружаем БД
-        return
+    cache = answer_cache.stats()
+    text += (
+        f"\n\n🧠 Кеш ИИ: попаданий {cache['hits'] + cache['near_hits']}, "
+        f"промахов {cache['misses']}, склеено запросов {cache['coalesced']}"
+    )
+
+    queue = ai_queue.stats()
+    text += (
+        f"\n⏱ Очередь ИИ: в работе {queue['active']}, ждут {queue['waiting']}, "
+        f"ожидание p50 {queue['p50_wait']:.1f} с / p95 {queue['p95_wait']:.1f} с, "
+        f"склеено {queue['merged']}, отклонено {queue['dropped']}, вытеснено {queue['superseded']}"
+    )
+
+    sending = send_scheduler.stats()
+    text += (
+        f"\n📨 Отправка: ждут {sending['waiting']}, темп {sending['rate']:.0f}/с, "
+        f"повторов после 429 {sending['retried']}, ожидание p95 {sending['p95_wait']['interactive']:.2f} с "
+        f"(рассылка {sending['p95_wait']['bulk']:.2f} с), склеено уведомлений {outbox.stats()['coalesced']}"
+    )
 
-    async with async_session_maker() as session:
-        total_users = await session.scalar(select(func.count(User.user_id)))
-        now = datetime.now(timezone.utc)
-        active_today = await session.scalar(select(func.count(User.user_id)).where(User.last_activity >= now - timedelta(days=1)))
-        active_week = await session.scalar(select(func.count(User.user_id)).where(User.last_activity >= now - timedelta(weeks=1)))
-        active_month = await session.scalar(select(func.count(User.user_id)).where(User.last_activity >= now - timedelta(days=30)))
-        new_today = await session.scalar(select(func.count(User.user_id)).where(User.created_at >= now - timedelta(days=1)))
-        new_week = await session.scalar(select(func.count(User.user_id)).where(User.created_at >= now - timedelta(weeks=1)))
-        new_month = await session.scalar(select(func.count(User.user_id)).where(User.created_at >= now - timedelta(days=30)))
-
-        total_users, active_today, active_week, active_month, new_today, new_week, new_month = map(lambda x: x or 0, [total_users, active_today, active_week, active_month, new_today, new_week, new_month])
-
-        text = (
-            f"👥 Всего пользователей: {total_users}\n"
-            f"📅 Активных сегодня: {active_today}\n"
-            f"📆 Активных за неделю: {active_week}\n"
-            f"📅 Активных за месяц: {active_month}\n\n"
-            f"🆕 Новых сегодня: {new_today}\n"
-            f"🆕 Новых за неделю: {new_week}\n"
-            f"🆕 Новых за месяц: {new_month}"
+    for cache in cache_stats():
+        l1_total = cache["hits"] + cache["misses"]
+        l2_total = cache["l2_hits"] + cache["l2_misses"]
+        text += (
+            f"\n🗂 Кеш {cache['name']}: L1 {cache['hits'] / l1_total if l1_total else 0:.0%} "
+            f"из {l1_total}, Redis {cache['l2_hits'] / l2_total if l2_total else 0:.0%} из {l2_total}, "
+            f"записей {cache['size']}"
         )
 
-        await redis.setex("stats", 600, text)  # Кэшируем статистику на 10 минут (600 секунд)
+    for backend in init_ai_client().stats()["backends"]:
+        p95 = backend["p95_first_token"] or backend["p95_complete"]
+        text += (
+            f"\n{'✅' if backend['state'] == 'closed' else '⛔'} {backend['name']}: "
+            f"запросов {backend['requests']}, ошибок {backend['errors']}"
+            + (f", p95 {p95:.1f} с" if p95 else "")
+        )
+
+    await message.answer(text)
+
+@router.message(F.text == "📈 Аналитика")
+async def analytics(message: Message):
+    if message.from_user.id != int(ADMIN_ID):
+        await message.answer("⛔ У вас нет доступа к админ-панели.")
+        return
+    if event_log.backend != "postgres":
+        await message.answer(f"⛔ Отчёты строятся по журналу в базе. Сейчас EVENTS_BACKEND={event_log.backend}: "
+                             f"Parquet-файлы из {event_log.directory} можно разобрать DuckDB.")
+        return
+
+    # Свёртку за сегодня досчитываем сразу (это одна секция); остальные дни готовит фоновая задача
+    await event_log.flush()
+    today = datetime.now(timezone.utc).date()
+    try:
+        await rollup_days(today, today)
+    except Exception as e:
+        logging.error(f"Не удалось обновить свёртку за сегодня: {e}")
+
+    cohorts = await retention_cohorts(8)
+    text = "📈 Удержание по неделе регистрации (доля активных на неделе 0, 1, 2...):\n"
+    for week, size, shares in cohorts:
+        text += f"\n{week:%d.%m} · {size}: " + " ".join(f"{share:.0%}" for share in shares)
+    if not cohorts:
+        text += "\nРегистраций в журнале пока нет"
+
+    totals, top = await ai_usage(30, 10)
+    text += (
+        f"\n\n🧠 ИИ за 30 дней: запросов {totals['requests']}, токенов {totals['tokens']}, "
+        f"пользователей {totals['users']}"
+    )
+    for user_id, requests, tokens, days in top:
+        text += f"\n{user_id}: запросов {requests}, токенов {tokens}, дней {days}"
+
+    await message.answer(text)
 
-        await message.answer(text)
 @router.message(F.text == "📢 Рассылка")
 async def start_broadcast(message: Message, state: FSMContext):
     user_id = message.from_user.id
@@ -201,193 +256,182 @@ async def start_broadcast(message: Message, state: FSMContext):
 
 @router.message(StateFilter(BroadcastState.waiting_for_message))
 async def send_broadcast(message: Message, bot: Bot, state: FSMContext):
-    redis = await init_redis()  # Получаем подключение к Redis
-
-    if await redis.get('broadcast_in_progress'):
-        # Проверяем, идет ли рассылка дольше 30 минут (1800 секунд)
-        last_update = await redis.get('broadcast_timestamp')
-    
-        if last_update and (datetime.now().timestamp() - float(last_update)) > 1800:
-            await redis.delete('broadcast_in_progress')  # Удаляем зависший флаг
-            await redis.delete('broadcast_timestamp')  # Удаляем устаревший таймстамп
-        else:
-            await message.answer("⏳ Рассылка уже выполняется. Подождите завершения.")
-            return
-
-        await redis.set('broadcast_in_progress', '1')
-        await redis.set('broadcast_timestamp', datetime.now().timestamp())  # Фиксируем время начала
-
-    async with async_session_maker() as session:
-        users = await session.execute(select(User.user_id))
-        users = [user[0] for user in users]
-
-    # Помечаем, что рассылка началась
-    await redis.set('broadcast_in_progress', '1')
+    if await is_broadcast_running():
+        await message.answer("⏳ Прошлая рассылка ещё не завершена (идёт или будет продолжена). Подождите завершения.")
+        return
 
-    await message.answer(f"📤 Рассылка началась! Всего {len(users)} пользователей.")
     await state.clear()
 
-    # Запускаем параллельную рассылку в фоне
-    asyncio.create_task(process_broadcast(bot, message, users))
-
-    # После завершения рассылки снимаем флаг
-    await redis.delete('broadcast_in_progress')
-
-
-async def process_broadcast(bot: Bot, message: Message, users: list):
-    sent, blocked = 0, 0
-
-    async def send_message(user_id):
-        nonlocal sent, blocked
-        try:
-            if message.photo:
-                await bot.send_photo(user_id, photo=message.photo[-1].file_id, caption=message.caption)
-            elif message.video:
-                await bot.send_video(user_id, video=message.video.file_id, caption=message.caption)
-            else:
-                await bot.send_message(user_id, text=message.text)
-            sent += 1
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)  # Ждем, если Telegram требует задержку
-            await send_message(user_id)  # Пробуем снова
-        except Exception:
-            blocked += 1
-
-    # Обрабатываем пользователей партиями по 20
-    for i in range(0, len(users), 20):  # Отправляем по 20 сообщений за раз
-        tasks = [send_message(user_id) for user_id in users[i:i + 20]]
-        await asyncio.gather(*tasks)
-        await asyncio.sleep(1)  # Лимитируем скорость рассылки
-
-    await message.answer(f"📤 Рассылка завершена!\n✅ Отправлено: {sent}\n❌ Недоступны: {blocked}")
+    # Рассылка идёт в фоне: копируем это сообщение пользователям страницами, с чекпоинтом в Redis
+    total = await launch_broadcast(bot, message.chat.id, message.message_id, message.chat.id)
+    if total is None:
+        await message.answer("⏳ Прошлая рассылка ещё не завершена (идёт или будет продолжена). Подождите завершения.")
 
 @router.message(F.text == "📜 Логи")
-async def send_logs(message: Message, bot: Bot):
+async def send_logs(message: Message):
     user_id = message.from_user.id
     if user_id != int(ADMIN_ID):
         await message.answer("⛔ У вас нет доступа к админ-панели.")
         return
 
-    if not os.path.exists(log_file):
+    size = logs_size()
+    if not size:
         await message.answer("⛔ Логи отсутствуют!")
         return
 
-    try:
-        # Закрываем обработчик логирования на время работы с файлом
-        logging.getLogger().removeHandler(log_handler)
-
-        # Создаем FSInputFile для отправки лога
-        document = FSInputFile(log_file)
+    await message.answer(f"📜 Логи занимают {size / 1024 / 1024:.1f} МБ. За какой период выгрузить?",
+                         reply_markup=kb.logs_keyboard())
 
-        # Отправляем лог-файл администратору
-        await bot.send_document(chat_id=user_id, document=document)
 
-        # Логируем успешную отправку
-        logging.info("Логи успешно отправлены администратору.")
+@router.callback_query(F.data.startswith("logs:"))
+async def export_logs(callback: CallbackQuery, bot: Bot):
+    if callback.from_user.id != int(ADMIN_ID):
+        await callback.answer("⛔ У вас нет доступа!")
+        return
 
-        # Закрытие файла перед его удалением
-        os.remove(log_file)  # Удаляем старый файл лога после отправки
-        await message.answer("✅ Логи отправлены и успешно удалены с сервера.")
+    # logs:<секунд назад>, 0 — всё, что хранится
+    seconds = int(callback.data.split(":", 1)[1])
+    since = datetime.now(timezone.utc) - timedelta(seconds=seconds) if seconds else None
+    await callback.answer("Готовлю архив...")
+    try:
+        # Архив сжимается и отправляется по кускам, запись логов при этом не останавливается
+        await bot.send_document(chat_id=callback.from_user.id, document=LogExport(since=since))
+        logging.info("Логи отправлены администратору.")
     except Exception as e:
         logging.error(f"Ошибка при отправке логов: {e}")
-        await message.answer("❌ Ошибка при отправке логов.")
-    finally:
-        # Включаем обработчик логирования снова после отправки и удаления
-        logging.getLogger().addHandler(log_handler)
-
-        # Создаём новый пустой лог-файл для продолжения работы
-        with open(log_file, "w"): pass  # Создаём новый файл для записи
+        await callback.message.answer("❌ Ошибка при отправке логов.")
 
 
 @router.message(F.text == "🔑 Сменить API")
-async def request_new_api_key(message: Message, state: FSMContext):
+async def request_new_api_key(message: Message):
     if message.from_user.id != int(ADMIN_ID):
         return await message.answer("⛔ У вас нет доступа!")
-    
-    await message.answer("🔑 Введите новый API-ключ:")
+
+    text, markup = await render_key_pool()
+    await message.answer(text, reply_markup=markup)
+
+
+async def render_key_pool():
+    """Список ключей пула с состоянием бэкендов и кнопки управления."""
+    keys = await load_keys(AI_KEYS_PROVIDER)
+    states = {}
+    for backend in init_ai_client().stats()["backends"]:
+        kid = backend["name"].rsplit(":", 1)[-1]
+        states[kid] = "⛔" if backend["state"] != "closed" or states.get(kid) == "⛔" else "✅"
+
+    lines = [f"🔑 Ключи {AI_KEYS_PROVIDER}: {len(keys)}"]
+    for kid, api_key, source in keys:
+        origin = "из .env" if source == "env" else "добавлен в боте"
+        lines.append(f"{states.get(kid, '⏳')} {mask(api_key)} — {origin}")
+    removable = [(kid, api_key) for kid, api_key, source in keys if source == "redis"]
+    return "\n".join(lines), kb.key_pool_keyboard(removable)
+
+
+@router.callback_query(F.data == "aikey:add")
+async def add_api_key(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != int(ADMIN_ID):
+        return await callback.answer("⛔ У вас нет доступа!")
+
+    await callback.answer()
+    await callback.message.answer("🔑 Введите новый API-ключ:")
     await state.set_state(APIKeyChange.waiting_for_new_api)
 
+
+@router.callback_query(F.data.startswith("aikey:del:"))
+async def delete_api_key(callback: CallbackQuery):
+    if callback.from_user.id != int(ADMIN_ID):
+        return await callback.answer("⛔ У вас нет доступа!")
+
+    removed = await remove_key(AI_KEYS_PROVIDER, callback.data.split(":", 2)[2])
+    await init_ai_client().reload_keys()  # Остальные процессы подхватят пул в течение AI_KEYS_REFRESH
+    await callback.answer("🗑 Ключ удалён" if removed else "Ключ уже удалён")
+    text, markup = await render_key_pool()
+    await callback.message.edit_text(text, reply_markup=markup)
+
+
 @router.message(StateFilter(APIKeyChange.waiting_for_new_api))
 async def update_api_key(message: Message, state: FSMContext):
-    new_api_key = message.text.strip()
+    new_api_key = (message.text or "").strip()
 
     if not new_api_key or len(new_api_key) < 20:  # Минимальная проверка ключа
         return await message.answer("⛔ Некорректный API-ключ! Попробуйте еще раз.")
 
-    # Читаем и обновляем файл .env
-    env_file = ".env"
-    with open(env_file, "r") as f:
-        lines = f.readlines()
-
-    with open(env_file, "w") as f:
-        for line in lines:
-            if line.startswith("AI_TOKEN="):
-                f.write(f"AI_TOKEN='{new_api_key}'\n")
-            else:
-                f.write(line)
-
-    # Перезагружаем переменные окружения без перезапуска бота
-    os.environ["AI_TOKEN"] = new_api_key
+    try:
+        await message.delete()  # Не оставляем ключ в истории чата
+    except TelegramBadRequest:
+        pass
 
-    await message.answer("✅ API-ключ успешно обновлен!")
+    # Ключ добавляется в пул в Redis: его видят все процессы, .env не переписываем
+    await add_key(AI_KEYS_PROVIDER, new_api_key)
+    await init_ai_client().reload_keys()
     await state.clear()
 
-@router.message(F.text)
-async def handle_message(message: Message, bot: Bot):
-    if message.from_user.id == (await bot.me()).id:
-        return
-    redis = await init_redis()
+    text, markup = await render_key_pool()
+    await message.answer(f"✅ Ключ {mask(new_api_key)} добавлен в пул!\n\n{text}", reply_markup=markup)
 
+async def reply_ai(message: Message, text: str):
+    """Отвечает с учётом истории диалога пользователя."""
     user_id = message.from_user.id
+    messages = await start_turn(user_id, text)
+    with count_ai_tokens() as used:
+        try:
+            answer = await answer_ai(message, messages)
+        except Exception as e:
+            # Ответ идёт в фоне, мимо ErrorHandlerMiddleware, поэтому сообщаем админу сами
+            await admin_alerter.alert(message.bot, int(ADMIN_ID), e)
+            raise
+        finally:
+            event_log.record(user_id, "ai", value=used[0])
+    await finish_turn(user_id, answer)
+
+async def ask_ai(message: Message):
+    """Ставит вопрос в очередь пользователя: у одного пользователя в работе не больше одного запроса к ИИ."""
+    result = await ai_queue.submit(message.from_user.id, message.text, lambda text: reply_ai(message, text))
+    if result == DROPPED:
+        await message.answer('Не спешите отправлять следующее сообщение, дождитесь ответа на ваше прошлое сообщение...')
+
+@router.message(Command("reset"))
+async def reset_dialog(message: Message):
+    await clear_history(message.from_user.id)
+    await message.answer("🧹 История диалога очищена. Можно начинать новый разговор!")
+
+@router.message(F.text, flags={"rate_limit": "ai"})
+async def handle_message(message: Message, bot: Bot, gate: UserGate):
+    if message.from_user.id == bot.id:  # id берётся из токена, без запроса к API
+        return
 
-    async with async_session_maker() as session:
-        user = await session.get(User, user_id)
-
-        if not user:
-            await message.answer("⛔️ Вас нет в пользователях! Введите /start")
-            return
+    user_id = message.from_user.id
 
-        # Проверяем наличие ключа в Redis для первого вопроса
-        redis_key = f"first_question:{user_id}"
-        if not await redis.exists(redis_key):
-            # Разрешаем задать первый вопрос
-            await redis.set(redis_key, "asked", ex=86400)  # Ключ действует 24 часа
-            response = await general(message.text)
-            response_text = response.choices[0].message.content if response and response.choices else "Ошибка: пустой ответ от ИИ."
-            await message.answer(response_text)
-            return
+    # Пользователь уже есть в базе: UserGateMiddleware создаёт его при первом сообщении.
+    # Флаг первого вопроса и число рефералов тоже пришли из гейта, в Redis ходить не нужно
+    if not gate.first_question_asked:
+        # Разрешаем задать первый вопрос
+        redis = await init_redis()
+        await redis.set(FIRST_QUESTION_KEY.format(user_id=user_id), "asked", ex=86400)  # Ключ действует 24 часа
+        first_questions.set(user_id, True)
+        await ask_ai(message)
+        return
 
-        # Проверяем количество рефералов
-        referral_count = await check_referrals(session, user_id)
-        if referral_count < 2:
-            await message.answer(
-                "⛔️ У вас недостаточно рефералов! Пригласите 2-х друзей, чтобы получить доступ.",
-                reply_markup=get_referral_keyboard(user_id)
-            )
-            return
+    # Проверяем количество рефералов
+    if gate.referral_count < 2:
+        await message.answer(
+            "⛔️ У вас недостаточно рефералов! Пригласите 2-х друзей, чтобы получить доступ.",
+            reply_markup=get_referral_keyboard(user_id)
+        )
+        return
 
-        # Получаем ответ от ИИ
-        response = await general(message.text)
-        response_text = response.choices[0].message.content if response and response.choices else "Ошибка: пустой ответ от ИИ."
-        await message.answer(response_text)
+    # Получаем ответ от ИИ (потоково, если включено)
+    await ask_ai(message)
 
 @router.callback_query(F.data == 'dialog')
 async def catalog(callback: CallbackQuery, state: FSMContext):
     await callback.answer('Искуственный Интеллект запущен')
     await callback.message.answer('Напиши сообщением всё, что вы хотите у меня спросить, будь то вопрос связанный с учёбой, личный вопрос, помочь с изобретением рецепта, или любой абсолютно другой вопрос который вас интересует', reply_markup=kb.menu)
 
-@router.message(Work.process)
-async def stop(message: Message):
-    await message.answer('Не спешите отправлять следующее сообщение, дождитесь ответа на ваше прошлое сообщение...')
-
-@router.message()
-async def ai(message: Message, state: FSMContext):
+@router.message(flags={"rate_limit": "ai"})
+async def ai(message: Message):
     if message.text:  # Проверяем, что это текстовое сообщение
-        await state.set_state(Work.process)
-        res = await general(message.text)
-        response_text = res.choices[0].message.content if res and res.choices else "Ошибка: пустой ответ от ИИ."
-        await message.answer(response_text)
-        await state.clear()
+        await ask_ai(message)
     else:
         await message.answer("⛔ Бот принимает только текстовые сообщения.")
 
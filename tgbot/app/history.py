@@ -0,0 +1,80 @@
+from dotenv import load_dotenv
+
+from app.redis_client import init_redis
+
+import json
+import os
+
+load_dotenv()
+
+HISTORY_MAX_CHARS = int(os.getenv("HISTORY_MAX_CHARS", "6000"))  # Бюджет контекста в символах (~4 символа на токен)
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", "20"))  # Сколько реплик храним в Redis
+HISTORY_TTL = int(os.getenv("HISTORY_TTL", "3600"))  # Через сколько секунд тишины диалог забывается
+
+ROLES = {"u": "user", "a": "assistant"}
+
+
+def _key(user_id: int) -> str:
+    return f"dialog:{user_id}"
+
+
+def _pack(role: str, content: str) -> str:
+    # Компактная запись: короткие ключи, без пробелов, длинные ответы обрезаем
+    return json.dumps({"r": role, "c": content[:HISTORY_MAX_CHARS]}, ensure_ascii=False, separators=(",", ":"))
+
+
+def build_window(raw_entries, max_chars=HISTORY_MAX_CHARS):
+    """Собирает сообщения для ИИ из конца истории, пока укладываемся в бюджет."""
+    window = []
+    used = 0
+    for raw in reversed(raw_entries):
+        entry = json.loads(raw)
+        content = entry["c"]
+        if window and used + len(content) > max_chars:
+            break
+        used += len(content)
+        role = ROLES[entry["r"]]
+        # Подряд идущие реплики одной роли склеиваем (например, если прошлый ответ ИИ не дошёл)
+        if window and window[0]["role"] == role:
+            window[0]["content"] = content + "\n\n" + window[0]["content"]
+        else:
+            window.insert(0, {"role": role, "content": content})
+
+    # Диалог должен начинаться с реплики пользователя
+    while window and window[0]["role"] != "user":
+        window.pop(0)
+    return window
+
+
+async def start_turn(user_id: int, text: str):
+    """Добавляет вопрос пользователя и возвращает окно диалога за один запрос к Redis."""
+    redis = await init_redis()
+    key = _key(user_id)
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.rpush(key, _pack("u", text))
+    pipe.ltrim(key, -HISTORY_MAX_ENTRIES, -1)
+    pipe.expire(key, HISTORY_TTL)
+    pipe.lrange(key, 0, -1)
+    *_, raw_entries = await pipe.execute()
+
+    return build_window(raw_entries)
+
+
+async def finish_turn(user_id: int, answer: str):
+    """Сохраняет ответ ИИ в историю."""
+    if not answer:
+        return
+    redis = await init_redis()
+    key = _key(user_id)
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.rpush(key, _pack("a", answer))
+    pipe.ltrim(key, -HISTORY_MAX_ENTRIES, -1)
+    pipe.expire(key, HISTORY_TTL)
+    await pipe.execute()
+
+
+async def clear_history(user_id: int):
+    redis = await init_redis()
+    await redis.delete(_key(user_id))
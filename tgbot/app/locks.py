@@ -0,0 +1,16 @@
+from app.redis_client import init_redis
+
+
+async def singleton_lock(name: str, ttl: int = 60):
+    """Распределённый замок для задач, которые должны идти в одном экземпляре на весь кластер.
+
+    Используем Lock из redis-py: токен владельца, атомарные release/extend на Lua.
+    ttl — страховка на случай падения процесса; долгие задачи продлевают замок через extend().
+    """
+    redis = await init_redis()
+    return redis.lock(f"lock:{name}", timeout=ttl, blocking=False, thread_local=False)
+
+
+async def is_locked(name: str) -> bool:
+    redis = await init_redis()
+    return bool(await redis.exists(f"lock:{name}"))
@@ -0,0 +1,269 @@
+"""Логи, которые не блокируют event loop.
+
+Хендлеры только кладут запись в очередь (QueueHandler), в файл её пишет отдельный поток
+(QueueListener). Файл дорастает до LOG_SEGMENT_BYTES и сжимается в сегмент с меткой времени,
+старые сегменты удаляются, когда все вместе занимают больше LOG_TOTAL_BYTES.
+Экспорт для админа читает сегменты и текущий файл, не останавливая запись.
+"""
+from aiogram.types import InputFile
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+import shutil
+import zlib
+
+load_dotenv()
+
+LOG_FILE = os.getenv("LOG_FILE", "admin_logs.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json — запись на строку, text — «время - сообщение», как раньше
+LOG_SEGMENT_BYTES = int(os.getenv("LOG_SEGMENT_BYTES", str(5 * 1024 * 1024)))  # Размер файла, после которого он уходит в сегмент
+LOG_TOTAL_BYTES = int(os.getenv("LOG_TOTAL_BYTES", str(40 * 1024 * 1024)))  # Потолок для всех сжатых сегментов; так полный экспорт влезает в лимит Telegram 50 МБ
+
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S-%f"
+TEXT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"  # %(asctime)s у logging.Formatter, локальное время
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+_listener = None
+_file_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON. Поля из extra=... попадают в запись как есть."""
+
+    _reserved = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in self._reserved and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class StructuredQueueHandler(QueueHandler):
+    """QueueHandler по умолчанию склеивает трейсбек с текстом — оставляем его отдельным полем для JSON."""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SegmentedFileHandler(RotatingFileHandler):
+    """Ротация в сжатые сегменты <файл>.<время>.gz; хранение ограничено суммарным размером, а не числом файлов.
+
+    Работает в потоке QueueListener, поэтому сжатие и удаление не задерживают event loop.
+    """
+
+    def __init__(self, filename, segment_bytes=LOG_SEGMENT_BYTES, total_bytes=LOG_TOTAL_BYTES):
+        super().__init__(filename, maxBytes=segment_bytes, backupCount=0, encoding="utf-8", delay=True)
+        self.total_bytes = total_bytes
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            segment = f"{self.baseFilename}.{datetime.now(timezone.utc).strftime(SEGMENT_TIME_FORMAT)}.gz"
+            with open(self.baseFilename, "rb") as src, gzip.open(segment, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.baseFilename)
+            enforce_retention(self.total_bytes)
+        self.stream = self._open()
+
+
+def _log_path(suffix=""):
+    # Воркеры пишут каждый в свой файл: admin_logs.w1.log, admin_logs.w2.log...
+    if not suffix:
+        return os.path.abspath(LOG_FILE)
+    root, ext = os.path.splitext(LOG_FILE)
+    return os.path.abspath(f"{root}.{suffix}{ext}")
+
+
+def _segment_end(path):
+    try:
+        return datetime.strptime(path.rsplit(".", 2)[-2], SEGMENT_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def log_files():
+    """(сегменты от старых к новым, текущие файлы всех процессов)."""
+    root, ext = os.path.splitext(os.path.abspath(LOG_FILE))
+    segments, active = [], []
+    for path in glob.glob(f"{glob.escape(root)}*{ext}*"):
+        if path.endswith(".gz") and _segment_end(path):
+            segments.append(path)
+        elif path.endswith(ext):
+            active.append(path)
+    segments.sort(key=_segment_end)
+    return segments, sorted(active)
+
+
+def enforce_retention(total_bytes=LOG_TOTAL_BYTES):
+    """Удаляет самые старые сегменты, пока все вместе не уложатся в total_bytes."""
+    segments, _ = log_files()
+    sizes = {}
+    for path in segments:
+        try:
+            sizes[path] = os.path.getsize(path)
+        except FileNotFoundError:  # Удалил соседний процесс
+            pass
+    total = sum(sizes.values())
+    for path in segments:
+        if total <= total_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= sizes.get(path, 0)
+
+
+def setup_logging(suffix=""):
+    """Настраивает корневой логгер. Вызывается один раз на процесс, до запуска бота."""
+    global _listener, _file_handler
+    if _listener is not None:
+        return
+    _file_handler = SegmentedFileHandler(_log_path(suffix))
+    _file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s - %(message)s"))
+    queue = SimpleQueue()
+    _listener = QueueListener(queue, _file_handler)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(StructuredQueueHandler(queue))
+    root.setLevel(LOG_LEVEL)
+    _listener.start()
+
+
+def stop_logging():
+    """Дописывает всё, что осталось в очереди, и закрывает файл."""
+    global _listener, _file_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    _file_handler.close()
+    _listener = _file_handler = None
+
+
+def _select_files(since, until):
+    segments, active = log_files()
+    selected, previous_end = [], {}
+    for path in segments:
+        base = path.rsplit(".", 2)[0]
+        start, end = previous_end.get(base), _segment_end(path)
+        previous_end[base] = end
+        if since and end < since:
+            continue  # Сегмент закончился раньше начала диапазона
+        if until and start and start > until:
+            continue  # Сегмент начался уже после конца диапазона
+        selected.append(path)
+    return selected + active
+
+
+def _line_time(line):
+    """Время записи из начала строки в любом из форматов: файлы могли писаться и до смены LOG_FORMAT."""
+    try:
+        if line.startswith(b'{"ts": "'):
+            # ts — первое поле JSON-записи: берём его срезом, не разбирая всю строку
+            return datetime.fromisoformat(line[8:line.index(b'"', 8)].decode())
+        if line[23:26] == b" - ":
+            return datetime.strptime(line[:23].decode(), TEXT_TIME_FORMAT).astimezone()
+    except ValueError:
+        pass
+    return None
+
+
+def _read_lines(path):
+    try:
+        if path.endswith(".gz"):
+            with gzip.open(path, "rb") as f:
+                yield from f
+            return
+        # Текущий файл дописывается прямо сейчас: читаем до размера на момент начала экспорта
+        with open(path, "rb") as f:
+            remaining = os.fstat(f.fileno()).st_size
+            for line in f:
+                if remaining <= 0:
+                    break
+                remaining -= len(line)
+                yield line
+    except FileNotFoundError:  # Сегмент удалила ротация, пока мы читали предыдущие
+        return
+
+
+def _export_chunks(since, until):
+    """Синхронный генератор кусков gzip.
+
+    Строка без метки времени (продолжение трейсбека в текстовом формате) идёт за своей записью.
+    """
+    compressor = zlib.compressobj(wbits=31)  # 31 — формат gzip
+    for path in _select_files(since, until):
+        ts = None
+        for line in _read_lines(path):
+            if since or until:
+                ts = _line_time(line) or ts
+                if ts is None or (since and ts < since) or (until and ts > until):
+                    continue
+            chunk = compressor.compress(line)
+            if chunk:
+                yield chunk
+    yield compressor.flush()
+
+
+class LogExport(InputFile):
+    """Логи за диапазон времени как gzip-файл для send_document.
+
+    Сжатие идёт по кускам в потоке и сразу уходит в запрос к Telegram: ни временного файла,
+    ни всего архива в памяти.
+    """
+
+    def __init__(self, since: datetime = None, until: datetime = None, filename=None):
+        if filename is None:
+            extension = "jsonl" if LOG_FORMAT == "json" else "log"
+            filename = f"logs-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M')}.{extension}.gz"
+        super().__init__(filename=filename, chunk_size=EXPORT_CHUNK_SIZE)
+        self.since = since
+        self.until = until
+
+    async def read(self, bot):
+        chunks = _export_chunks(self.since, self.until)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            if chunk:
+                yield chunk
+
+
+def logs_size():
+    """Сколько байт занимают все файлы логов."""
+    total = 0
+    for path in sum(log_files(), []):
+        try:
+            total += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    return total
@@ -0,0 +1,241 @@
+"""Метрики процесса в формате Prometheus без внешних зависимостей.
+
+Гистограммы задержек хендлеров, запросов к Postgres, Redis и Mistral, счётчики токенов ИИ.
+Эндпоинт /metrics поднимается, только если задан METRICS_PORT.
+"""
+from aiogram import BaseMiddleware
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+
+import logging
+import os
+import time
+
+load_dotenv()
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — эндпоинт /metrics выключен
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [счётчики по корзинам..., сумма, количество]
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def percentile(self, q, **labels):
+        """Грубая оценка перцентиля по корзинам — для админ-панели."""
+        series = self._series.get(tuple(labels.get(name, "") for name in self.labelnames))
+        if not series or not series[-1]:
+            return 0.0
+        target, seen = q * series[-1], 0
+        for bound, count in zip(self.buckets, series):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Значение снимается функцией в момент сбора: очереди, пулы, буферы."""
+
+    def __init__(self, name, documentation, collect):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.collect()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ["event", "handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ["event", "handler"])
+DB_SECONDS = Histogram("db_query_seconds", "Время SQL-запросов к Postgres", ["statement"])
+DB_CHECKOUT_SECONDS = Histogram("db_pool_checkout_seconds", "Ожидание соединения из пула",
+                                buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5))
+DB_DISCONNECTS = Counter("db_disconnects_total", "Обрывы соединений с БД, замеченные по ошибке запроса")
+REDIS_SECONDS = Histogram("redis_command_seconds", "Время команд и пайплайнов Redis", ["command"])
+AI_SECONDS = Histogram("ai_request_seconds", "Время запросов к Mistral (поток — до последнего токена)",
+                       ["method", "status"], buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120))
+AI_TOKENS = Counter("ai_tokens_total", "Токены Mistral", ["kind"])
+AI_BACKEND_REQUESTS = Counter("ai_backend_requests_total", "Запросы к бэкендам ИИ (модель и ключ)", ["backend", "result"])
+AI_HEDGES = Counter("ai_hedged_requests_total", "Хеджированные запросы: кто ответил первым", ["result"])
+CACHE_REQUESTS = Counter("cache_requests_total", "Обращения к кешу горячих данных по уровням: l1 — память процесса, l2 — Redis",
+                         ["cache", "tier", "result"])
+SEND_REQUESTS = Counter("telegram_send_total", "Исходящие сообщения Bot API по полосам приоритета", ["lane", "result"])
+SEND_WAIT = Histogram("telegram_send_wait_seconds", "Ожидание слота на отправку в Bot API", ["lane"],
+                      buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+ALERTS = Counter("admin_alerts_total", "Оповещения админу об ошибках", ["result"])
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Гистограмма задержек по хендлерам. Регистрируется первым из внутренних middleware."""
+
+    def __init__(self, event_type: str):
+        self.event_type = event_type
+        super().__init__()
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(event=self.event_type, handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, event=self.event_type, handler=name)
+
+
+def instrument_engine(engine):
+    """Таймер SQL-запросов через события SQLAlchemy."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_started"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("query_started", None)
+        if started is not None:
+            # Метка — первое слово запроса (SELECT, UPDATE, WITH...), чтобы не плодить серии
+            DB_SECONDS.observe(time.perf_counter() - started, statement=statement.split(None, 1)[0].upper())
+
+
+_ai_tokens = ContextVar("ai_tokens", default=None)
+
+
+@contextmanager
+def count_ai_tokens():
+    """Токены ИИ, потраченные внутри блока, включая хедж-запросы: with count_ai_tokens() as used: ... used[0]"""
+    used = [0]  # Изменяемый: задачи, созданные внутри блока, получают копию контекста с тем же списком
+    token = _ai_tokens.set(used)
+    try:
+        yield used
+    finally:
+        _ai_tokens.reset(token)
+
+
+def record_ai_usage(usage):
+    if usage is None:
+        return
+    AI_TOKENS.inc(usage.prompt_tokens or 0, kind="prompt")
+    AI_TOKENS.inc(usage.completion_tokens or 0, kind="completion")
+    used = _ai_tokens.get()
+    if used is not None:
+        used[0] += (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+
+
+async def _metrics_view(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Поднимает /metrics на отдельном порту. Возвращает runner для cleanup() или None, если выключено."""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики: http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,118 @@
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from dotenv import load_dotenv
+
+from app.metrics import Gauge
+from app.sender import send_lane, NOTIFY
+
+import asyncio
+import logging
+import os
+
+load_dotenv()
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))  # Сколько уведомлений отправляем параллельно
+OUTBOX_MAX_SIZE = int(os.getenv("OUTBOX_MAX_SIZE", "10000"))  # Больше не копим: лишнее отбрасываем с записью в лог
+OUTBOX_MAX_ATTEMPTS = 3
+
+
+class Outbox:
+    """Очередь уведомлений, которые отправляются после коммита, в фоне.
+
+    Хендлер кладёт сообщение и сразу идёт дальше: транзакция и соединение с базой
+    не ждут сетевых вызовов к Telegram, а флуд регистраций не превращается во флуд отправок.
+    Уведомления с одним ключом склеиваются, пока ждут в очереди: уходит только последнее.
+    Темп отправки задаёт SendScheduler, уведомления идут в полосе NOTIFY.
+    """
+
+    def __init__(self, workers=OUTBOX_WORKERS, max_size=OUTBOX_MAX_SIZE):
+        self.workers = workers
+        self.max_size = max_size
+        self._queue = None
+        self._pending = {}  # (chat_id, ключ) -> (chat_id, текст, kwargs) последнего уведомления
+        self._tasks = []
+        self.bot = None
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self, bot: Bot):
+        if not self._tasks:
+            self.bot = bot
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        """Дожидается отправки накопленного (не дольше timeout) и останавливает воркеры."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Outbox: не успели отправить {self._queue.qsize()} уведомлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def send(self, chat_id: int, text: str, key: str = None, **kwargs):
+        """Ставит сообщение в очередь, не дожидаясь отправки.
+
+        key — тема уведомления: если уведомление с той же темой этому чату ещё не ушло, оно заменяется
+        новым. Без key темой считается сам текст, так что одинаковые уведомления не дублируются.
+        """
+        if self._queue is None:
+            raise RuntimeError("Outbox не запущен: вызовите outbox.start(bot)")
+        pending_key = (chat_id, key if key is not None else text)
+        if pending_key in self._pending:
+            self._pending[pending_key] = (chat_id, text, kwargs)
+            self.coalesced += 1
+            return
+        try:
+            self._queue.put_nowait(pending_key)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning(f"Outbox переполнен, уведомление для {chat_id} отброшено")
+            return
+        self._pending[pending_key] = (chat_id, text, kwargs)
+
+    async def _worker(self):
+        with send_lane(NOTIFY):
+            while True:
+                pending_key = await self._queue.get()
+                chat_id, text, kwargs = self._pending.pop(pending_key)
+                try:
+                    await self._deliver(chat_id, text, kwargs)
+                finally:
+                    self._queue.task_done()
+
+    async def _deliver(self, chat_id, text, kwargs):
+        for _ in range(OUTBOX_MAX_ATTEMPTS):
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+                return
+            except (TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest):
+                # Бот заблокирован или чат не найден — повтор не поможет; RetryAfter доходит сюда,
+                # только когда SendScheduler уже исчерпал свои повторы
+                break
+            except Exception as e:
+                logging.warning(f"Outbox: ошибка отправки {chat_id}: {e}")
+                await asyncio.sleep(1)
+        self.failed += 1
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
+
+outbox = Outbox()
+
+Gauge("outbox_queued", "Уведомления, ждущие отправки", lambda: outbox.stats()["queued"])
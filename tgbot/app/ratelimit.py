@@ -0,0 +1,154 @@
+from dataclasses import dataclass
+from dotenv import load_dotenv
+from redis.exceptions import RedisError
+
+from app.redis_client import init_redis
+
+import logging
+import os
+import time
+
+load_dotenv()
+
+# Бюджеты: сколько действий в минуту и сколько можно сделать подряд без паузы
+RATE_COMMAND_PER_MINUTE = float(os.getenv("RATE_COMMAND_PER_MINUTE", "30"))  # Команды и кнопки меню
+RATE_COMMAND_BURST = int(os.getenv("RATE_COMMAND_BURST", "5"))
+RATE_AI_PER_MINUTE = float(os.getenv("RATE_AI_PER_MINUTE", "10"))  # Вопросы к ИИ
+RATE_AI_BURST = int(os.getenv("RATE_AI_BURST", "3"))
+RATE_CALLBACK_PER_MINUTE = float(os.getenv("RATE_CALLBACK_PER_MINUTE", "30"))  # Нажатия inline-кнопок
+RATE_CALLBACK_BURST = int(os.getenv("RATE_CALLBACK_BURST", "5"))
+# local — лимиты в памяти процесса, без запроса к Redis. Только если апдейты одного пользователя всегда
+# попадают в один процесс: один процесс или WORKERS с шардированием по user_id
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "redis")
+
+RATE_KEY = "ratelimit:{bucket}:{user_id}"  # Теоретическое время прихода (TAT) в мс
+RATE_WARNED_KEY = "ratelimit:{bucket}:{user_id}:warned"  # Предупреждение уже отправлено в этом окне
+
+# GCRA (ведро токенов через одно число): в Redis хранится только TAT — момент, когда ведро опустеет.
+# Время берём из Redis (TIME), чтобы процессы с разными часами считали одинаково.
+# Возвращает {разрешено, через сколько мс можно снова, нужно ли предупредить}.
+GCRA_LUA = """
+local function gcra(key, warned_key, interval, burst)
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    local tat = tonumber(redis.call('GET', key)) or now
+    if tat < now then
+        tat = now
+    end
+    local new_tat = tat + interval
+    local allow_at = new_tat - interval * burst
+    if allow_at > now then
+        local warn = 0
+        if redis.call('SET', warned_key, '1', 'PX', interval * burst, 'NX') then
+            warn = 1
+        end
+        return {0, allow_at - now, warn}
+    end
+    redis.call('SET', key, new_tat, 'PX', new_tat - now)
+    return {1, 0, 0}
+end
+"""
+
+RATE_LIMIT_SCRIPT = GCRA_LUA + """
+return gcra(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]))
+"""
+
+
+@dataclass
+class Limit:
+    per_minute: float
+    burst: int
+
+    @property
+    def interval_ms(self) -> int:
+        return max(1, int(60000 / self.per_minute))
+
+
+@dataclass
+class Verdict:
+    allowed: bool
+    retry_after: float  # Секунды до следующего разрешённого действия
+    warn: bool  # Первое отклонение в окне — стоит один раз предупредить пользователя
+
+
+LIMITS = {
+    "command": Limit(RATE_COMMAND_PER_MINUTE, RATE_COMMAND_BURST),
+    "ai": Limit(RATE_AI_PER_MINUTE, RATE_AI_BURST),
+    "callback": Limit(RATE_CALLBACK_PER_MINUTE, RATE_CALLBACK_BURST),
+}
+
+
+class LocalLimiter:
+    """Тот же GCRA в памяти процесса: основной при RATE_LIMIT_BACKEND=local, иначе запасной, пока Redis недоступен."""
+
+    MAX_KEYS = 100_000
+
+    def __init__(self):
+        self._tat = {}  # (bucket, user_id) -> TAT в мс
+        self._warned = {}  # (bucket, user_id) -> до какого момента не предупреждаем
+
+    def hit(self, user_id, bucket, limit: Limit) -> Verdict:
+        now = time.monotonic() * 1000
+        key = (bucket, user_id)
+        interval = limit.interval_ms
+        tat = max(self._tat.get(key, now), now)
+        new_tat = tat + interval
+        allow_at = new_tat - interval * limit.burst
+        if allow_at > now:
+            warn = self._warned.get(key, 0) <= now
+            if warn:
+                self._warned[key] = now + interval * limit.burst
+            return Verdict(False, (allow_at - now) / 1000, warn)
+
+        if len(self._tat) >= self.MAX_KEYS:
+            self._prune(now)
+        self._tat[key] = new_tat
+        return Verdict(True, 0.0, False)
+
+    def _prune(self, now):
+        self._tat = {key: tat for key, tat in self._tat.items() if tat > now}
+        self._warned = {key: until for key, until in self._warned.items() if until > now}
+
+
+class RateLimiter:
+    """Ограничитель частоты с отдельными бюджетами на команды, вопросы к ИИ и callback-кнопки."""
+
+    def __init__(self, limits=None, backend=RATE_LIMIT_BACKEND):
+        self.limits = limits or LIMITS
+        self.local = LocalLimiter()
+        self.local_only = backend == "local"
+        self.script = None
+        self.fallbacks = 0
+        self._last_warning = 0.0
+
+    def keys(self, user_id, bucket):
+        return [RATE_KEY.format(bucket=bucket, user_id=user_id), RATE_WARNED_KEY.format(bucket=bucket, user_id=user_id)]
+
+    def args(self, bucket):
+        limit = self.limits[bucket]
+        return [limit.interval_ms, limit.burst]
+
+    @staticmethod
+    def verdict(allowed, retry_after_ms, warn) -> Verdict:
+        return Verdict(bool(allowed), int(retry_after_ms) / 1000, bool(warn))
+
+    async def hit(self, user_id, bucket) -> Verdict:
+        if self.local_only:
+            return self.local.hit(user_id, bucket, self.limits[bucket])
+        try:
+            redis = await init_redis()
+            if self.script is None:
+                self.script = redis.register_script(RATE_LIMIT_SCRIPT)
+            return self.verdict(*await self.script(keys=self.keys(user_id, bucket), args=self.args(bucket)))
+        except RedisError as e:
+            return self.hit_local(user_id, bucket, e)
+
+    def hit_local(self, user_id, bucket, error=None) -> Verdict:
+        self.fallbacks += 1
+        if error is not None and time.monotonic() - self._last_warning > 60:  # Не засоряем лог на каждом сообщении
+            self._last_warning = time.monotonic()
+            logging.warning(f"Redis недоступен, лимиты считаем в памяти процесса: {error}")
+        return self.local.hit(user_id, bucket, self.limits[bucket])
+
+
+rate_limiter = RateLimiter()
@@ -1,16 +1,58 @@
-import aioredis
+from redis import asyncio as aioredis
+from redis import exceptions as redis_exceptions
+from app.metrics import REDIS_SECONDS
 import logging
 import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
 
 redis = None  # Глобальный объект Redis
 
+
+class InstrumentedPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - started, command="PIPELINE")
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """Redis с таймером на каждую команду (скрипты — как EVALSHA) и на пайплайн целиком."""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - started, command=str(args[0]).upper())
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def _reset_after_fork():
+    # Соединения родителя нельзя использовать в дочернем процессе: создадим свои при первом init_redis()
+    global redis
+    redis = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 async def init_redis():
     global redis
     if redis is None:
         try:
-            redis = await aioredis.from_url("redis://localhost", decode_responses=True)
+            redis = await InstrumentedRedis.from_url(REDIS_URL, decode_responses=True)
             logging.info("Redis подключен!")
-        except aioredis.exceptions.ConnectionError as e:
+        except redis_exceptions.ConnectionError as e:
             logging.error(f"Ошибка подключения к Redis: {e}. Повторная попытка подключения...")
             await asyncio.sleep(5)  # Пауза перед повторной попыткой
             return await init_redis()  # Рекурсивный вызов для повторного подключения
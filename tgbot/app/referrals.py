@@ -0,0 +1,119 @@
+"""Счётчик рефералов: источник правды — users.referral_count, Redis — кеш со сквозной записью.
+
+Счётчик увеличивается атомарным UPDATE ... RETURNING (см. register_user), и в том же месте
+новое значение пишется в Redis и в L1 этого процесса, а другим процессам уходит инвалидация
+их L1 (app.cache). Фоновая сверка с таблицей referrals чинит расхождения,
+не нагружая горячий путь.
+
+Разовая сверка вручную: python -m app.referrals reconcile
+"""
+from dotenv import load_dotenv
+
+from app.database.requests import reconcile_referral_counts_after
+from app.redis_client import init_redis, close_redis
+from app.locks import singleton_lock
+from app.cache import referral_counts
+
+import asyncio
+import logging
+import os
+import sys
+
+load_dotenv()
+
+REFERRAL_COUNT_KEY = "user:{user_id}:referral_count"
+REFERRAL_CACHE_TTL = int(os.getenv("REFERRAL_CACHE_TTL", "86400"))  # Кеш обновляется при записи, TTL — только страховка
+REFERRAL_RECONCILE_INTERVAL = float(os.getenv("REFERRAL_RECONCILE_INTERVAL", "3600"))  # Как часто сверяем счётчики
+REFERRAL_RECONCILE_BATCH = 1000  # Пользователей за один UPDATE
+RECONCILE_LOCK = "referral-reconcile"
+
+
+async def cache_referral_count(user_id: int, referral_count: int):
+    redis = await init_redis()
+    await redis.set(REFERRAL_COUNT_KEY.format(user_id=user_id), referral_count, ex=REFERRAL_CACHE_TTL)
+    referral_counts.set(user_id, referral_count)
+    await referral_counts.invalidate_others(user_id)
+
+
+async def reconcile_referrals(batch_size=REFERRAL_RECONCILE_BATCH):
+    """Проходит по всем пользователям страницами и исправляет счётчики, разошедшиеся с таблицей referrals."""
+    redis = await init_redis()
+    cursor, fixed = 0, 0
+    while True:
+        next_cursor, rows = await reconcile_referral_counts_after(cursor, batch_size)
+        if next_cursor is None:
+            break
+        if rows:
+            pipe = redis.pipeline(transaction=False)
+            for user_id, referral_count in rows:
+                pipe.set(REFERRAL_COUNT_KEY.format(user_id=user_id), referral_count, ex=REFERRAL_CACHE_TTL)
+            await pipe.execute()
+            await referral_counts.invalidate(*(user_id for user_id, _ in rows))
+        fixed += len(rows)
+        cursor = next_cursor
+        await asyncio.sleep(0)  # Не держим цикл событий на больших таблицах
+    if fixed:
+        logging.warning(f"Сверка рефералов: исправлено {fixed} счётчиков")
+    return fixed
+
+
+class ReferralReconciler:
+    """Периодическая сверка счётчиков. В кластере её выполняет один процесс за раз."""
+
+    def __init__(self, interval=REFERRAL_RECONCILE_INTERVAL):
+        self.interval = interval
+        self._task = None
+        self._stopping = None
+        self.runs = 0
+        self.fixed = 0
+
+    async def run_once(self):
+        lock = await singleton_lock(RECONCILE_LOCK, ttl=int(self.interval))
+        if not await lock.acquire():
+            return 0  # Сверку уже делает другой процесс
+        # Замок не снимаем: он истечёт сам через interval, и другие процессы не повторят сверку раньше
+        fixed = await reconcile_referrals()
+        self.runs += 1
+        self.fixed += fixed
+        return fixed
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.interval)
+                break
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.run_once()
+            except Exception as e:
+                logging.error(f"Ошибка сверки рефералов: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            await self._task
+            self._task = None
+
+
+referral_reconciler = ReferralReconciler()
+
+
+async def _main(command):
+    try:
+        if command == "reconcile":
+            fixed = await reconcile_referrals()
+            print(f"Готово: исправлено счётчиков {fixed}")
+        else:
+            print("Использование: python -m app.referrals reconcile")
+    finally:
+        await close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else ""))
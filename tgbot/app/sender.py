@@ -0,0 +1,186 @@
+"""Планировщик исходящих вызовов Bot API.
+
+Все отправки бота проходят через middleware сессии aiogram: ответы в хендлерах, уведомления
+outbox, оповещения админу и рассылка. Планировщик держит общий темп (Telegram начинает отвечать
+429 примерно после 30 сообщений в секунду на бота) и темп в одном чате (около одного в секунду).
+Свободные слоты он раздаёт по полосам приоритета: сначала ответы пользователям, потом уведомления,
+последней идёт рассылка. На TelegramRetryAfter чат встаёт на паузу, общий темп снижается,
+и запрос повторяется сам.
+
+Полоса задаётся контекстом: with send_lane(BULK): ... — она наследуется задачами, созданными внутри.
+"""
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+
+from app.metrics import Gauge, SEND_REQUESTS, SEND_WAIT
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+
+load_dotenv()
+
+# Лимит Telegram — на токен бота, поэтому в кластере темп делится поровну между воркерами
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30")) / max(1, int(os.getenv("WORKERS", "1")))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # Сообщений в секунду в один чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))  # Сколько можно отправить в чат подряд без паузы (ответ + правки)
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))  # Повторы после TelegramRetryAfter, потом ошибка уходит вызывающему
+SEND_MAX_RETRY_WAIT = float(os.getenv("SEND_MAX_RETRY_WAIT", "60"))  # Если Telegram просит ждать дольше — не ждём, отдаём ошибку
+
+INTERACTIVE, NOTIFY, BULK = 0, 1, 2
+LANE_NAMES = {INTERACTIVE: "interactive", NOTIFY: "notify", BULK: "bulk"}
+
+# Методы, которые отправляют или меняют сообщения; остальные (getMe, answerCallbackQuery...) идут без очереди
+THROTTLED_PREFIXES = ("send", "copy", "forward", "edit")
+UNTHROTTLED_METHODS = {"sendChatAction"}
+
+_lane = ContextVar("send_lane", default=INTERACTIVE)
+
+
+@contextmanager
+def send_lane(lane: int):
+    """Отправки внутри блока (и в задачах, созданных внутри) идут в полосе lane."""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота: bot.session.middleware(send_scheduler).
+
+    Общий темп — ведро на один токен; ждущие выстраиваются в кучу по (полоса, порядок прихода), так что
+    ответ пользователю обгоняет рассылку, но внутри полосы порядок сохраняется.
+    Темп в чате — GCRA: у каждого чата только момент, когда его «ведро» опустеет.
+    """
+
+    MAX_CHATS = 100_000
+
+    def __init__(self, rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST,
+                 max_retries=SEND_MAX_RETRIES, max_retry_wait=SEND_MAX_RETRY_WAIT):
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = 1.0  # Ведро на один токен: ровный темп без всплесков, Telegram считает окнами в секунду
+        self.updated = time.monotonic()
+        self.chat_interval = 1 / chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+
+        self._waiters = []  # куча (полоса, номер, future)
+        self._order = itertools.count()
+        self._pump = None
+        self._chat_tat = {}  # chat_id -> когда опустеет ведро чата (time.monotonic)
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _take_token(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def _run_pump(self):
+        # Один раздатчик на процесс: отдаёт токены ждущим строго по приоритету
+        try:
+            while self._waiters:
+                future = self._waiters[0][2]
+                if future.done():  # Отправку отменили, пока она ждала
+                    heapq.heappop(self._waiters)
+                elif self._take_token():
+                    heapq.heappop(self._waiters)
+                    future.set_result(None)
+                else:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self._pump = None
+
+    async def _global_slot(self, lane):
+        if not self._waiters and self._take_token():
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._order), future))
+        if self._pump is None:
+            self._pump = asyncio.create_task(self._run_pump())
+        await future
+
+    async def _chat_slot(self, chat_id):
+        now = time.monotonic()
+        tat = max(self._chat_tat.get(chat_id, now), now)
+        allow_at = max(now, tat - self.chat_interval * (self.chat_burst - 1))
+        if len(self._chat_tat) >= self.MAX_CHATS:
+            self._chat_tat = {chat: t for chat, t in self._chat_tat.items() if t > now}
+        # Место занимаем сразу, до сна: следующая отправка в этот чат встанет за нами
+        self._chat_tat[chat_id] = max(tat, allow_at) + self.chat_interval
+        if allow_at > now:
+            await asyncio.sleep(allow_at - now)
+
+    def _on_retry_after(self, chat_id, retry_after):
+        # Чат молчит, сколько просит Telegram. Общий темп только слегка снижаем: по ответу не понять,
+        # чей это лимит — чата или бота, а остальные чаты не должны ждать из-за одного
+        if chat_id is not None:
+            self._chat_tat[chat_id] = time.monotonic() + retry_after + self.chat_interval * (self.chat_burst - 1)
+        self.rate = max(1.0, self.rate * 0.75)
+
+    def _on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.01)
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        if not name.startswith(THROTTLED_PREFIXES) or name in UNTHROTTLED_METHODS:
+            return await make_request(bot, method)
+
+        lane = _lane.get()
+        lane_name = LANE_NAMES[lane]
+        chat_id = getattr(method, "chat_id", None)
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if chat_id is not None:
+                await self._chat_slot(chat_id)
+            await self._global_slot(lane)
+            SEND_WAIT.observe(time.monotonic() - started, lane=lane_name)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                SEND_REQUESTS.inc(lane=lane_name, result="retry_after")
+                self._on_retry_after(chat_id, e.retry_after)
+                if attempt == self.max_retries or e.retry_after > self.max_retry_wait:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                if chat_id is None:
+                    await asyncio.sleep(e.retry_after)
+                continue
+            self._on_success()
+            self.sent += 1
+            SEND_REQUESTS.inc(lane=lane_name, result="sent")
+            return response
+
+    def stats(self):
+        return {
+            "waiting": len(self._waiters),
+            "rate": self.rate,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "p95_wait": {name: SEND_WAIT.percentile(0.95, lane=name) for name in LANE_NAMES.values()},
+        }
+
+
+send_scheduler = SendScheduler()
+
+Gauge("telegram_send_waiting", "Отправки, ждущие слота общего темпа", lambda: len(send_scheduler._waiters))
@@ -0,0 +1,136 @@
+"""Инкрементальная статистика пользователей в Redis.
+
+Активные за день — HyperLogLog на каждый день (PFADD пишет UserGateMiddleware тем же Lua-скриптом),
+новые за день — счётчик INCR при регистрации. Неделя и месяц — PFCOUNT по 7/30 ключам и сумма счётчиков,
+то есть O(дней), без сканирования таблицы users.
+
+Разовое заполнение из существующей таблицы: python -m app.stats backfill
+"""
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+from sqlalchemy import func, select
+
+from app.database.Models import User, async_session_maker
+from app.redis_client import init_redis, close_redis
+
+import asyncio
+import logging
+import sys
+
+load_dotenv()
+
+STATS_RETENTION_DAYS = 40  # Дневные ключи живут чуть дольше месяца
+TOTAL_USERS_KEY = "stats:users_total"
+
+
+def day_key(prefix: str, day) -> str:
+    return f"stats:{prefix}:{day.strftime('%Y%m%d')}"
+
+
+def dau_key(day=None) -> str:
+    return day_key("dau", day or datetime.now(timezone.utc))
+
+
+def signups_key(day=None) -> str:
+    return day_key("signups", day or datetime.now(timezone.utc))
+
+
+def _last_days(days: int):
+    today = datetime.now(timezone.utc)
+    return [today - timedelta(days=i) for i in range(days)]
+
+
+async def record_signup():
+    """Вызывается при создании пользователя."""
+    redis = await init_redis()
+    key = signups_key()
+    pipe = redis.pipeline(transaction=False)
+    pipe.incr(key)
+    pipe.expire(key, STATS_RETENTION_DAYS * 86400)
+    pipe.incr(TOTAL_USERS_KEY)
+    await pipe.execute()
+
+
+async def collect_stats():
+    """Все цифры для админ-панели за один запрос к Redis."""
+    redis = await init_redis()
+    month = _last_days(30)
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.get(TOTAL_USERS_KEY)
+    pipe.pfcount(dau_key(month[0]))
+    pipe.pfcount(*[dau_key(day) for day in month[:7]])  # PFCOUNT по нескольким ключам считает объединение
+    pipe.pfcount(*[dau_key(day) for day in month])
+    pipe.mget([signups_key(day) for day in month])
+    total, active_today, active_week, active_month, signups = await pipe.execute()
+
+    signups = [int(value or 0) for value in signups]
+    return {
+        "total_users": int(total or 0),
+        "active_today": active_today,
+        "active_week": active_week,
+        "active_month": active_month,
+        "new_today": signups[0],
+        "new_week": sum(signups[:7]),
+        "new_month": sum(signups),
+    }
+
+
+async def backfill_stats(batch_size=5000):
+    """Заполняет счётчики по таблице users. Повторный запуск перезаписывает счётчики регистраций.
+
+    Для активности известна только последняя дата, поэтому каждый пользователь попадает
+    в HyperLogLog одного дня — дневные цифры прошлых дней будут занижены, неделя и месяц близки к правде.
+    """
+    redis = await init_redis()
+    since = datetime.now(timezone.utc) - timedelta(days=30)
+
+    async with async_session_maker() as session:
+        total = await session.scalar(select(func.count(User.user_id))) or 0
+
+        signup_day = func.date(User.created_at)
+        signups = await session.execute(
+            select(signup_day, func.count(User.user_id)).where(User.created_at >= since).group_by(signup_day)
+        )
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(TOTAL_USERS_KEY, total)
+        for day, count in signups:
+            if isinstance(day, str):
+                day = datetime.strptime(day, "%Y-%m-%d")
+            pipe.set(signups_key(day), count, ex=STATS_RETENTION_DAYS * 86400)
+        await pipe.execute()
+
+        # Активных читаем потоком, чтобы не держать всю выборку в памяти
+        result = await session.stream(
+            select(User.user_id, User.last_activity).where(User.last_activity >= since)
+            .execution_options(yield_per=batch_size)
+        )
+        added = 0
+        async for rows in result.partitions(batch_size):
+            by_day = {}
+            for user_id, last_activity in rows:
+                by_day.setdefault(dau_key(last_activity), []).append(user_id)
+            pipe = redis.pipeline(transaction=False)
+            for key, user_ids in by_day.items():
+                pipe.pfadd(key, *user_ids)
+                pipe.expire(key, STATS_RETENTION_DAYS * 86400)
+            await pipe.execute()
+            added += len(rows)
+
+    logging.info(f"Статистика заполнена: всего {total}, активных за месяц {added}")
+    return total, added
+
+
+async def _main(command):
+    try:
+        if command == "backfill":
+            total, added = await backfill_stats()
+            print(f"Готово: всего пользователей {total}, активностей за 30 дней {added}")
+        else:
+            print("Использование: python -m app.stats backfill")
+    finally:
+        await close_redis()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else ""))
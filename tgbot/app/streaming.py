@@ -0,0 +1,132 @@
+from aiogram.types import Message
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from dotenv import load_dotenv
+
+from app.general import general, general_stream
+
+import asyncio
+import logging
+import os
+import time
+
+load_dotenv()
+
+TELEGRAM_TEXT_LIMIT = 4096  # Максимальная длина одного сообщения в Telegram
+AI_STREAMING = os.getenv("AI_STREAMING", "1") == "1"  # Включить потоковые ответы
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # Не чаще одного редактирования за столько секунд
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", "50"))  # Минимум новых символов для редактирования
+
+PLACEHOLDER = "⏳ Думаю..."
+EMPTY_ANSWER = "Ошибка: пустой ответ от ИИ."
+
+
+def split_text(text, limit=TELEGRAM_TEXT_LIMIT):
+    """Режет длинный текст на части не длиннее limit, по возможности по переносу строки или пробелу."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+class StreamingReply:
+    """Сообщение, которое дописывается по мере прихода токенов.
+
+    Редактирования склеиваются по времени и объёму, чтобы не упираться в лимиты Telegram.
+    Когда текст перерастает 4096 символов, начинается новое сообщение.
+    """
+
+    def __init__(self, message: Message, interval=STREAM_EDIT_INTERVAL, min_chars=STREAM_EDIT_MIN_CHARS):
+        self.message = message
+        self.interval = interval
+        self.min_chars = min_chars
+        self.current = None  # Сообщение, которое сейчас редактируем
+        self.text = ""  # Текст текущего сообщения
+        self.full_text = ""  # Весь ответ целиком
+        self.shown = ""  # Что уже видит пользователь
+        self.last_edit = 0.0
+        self.next_allowed = 0.0  # Пауза после TelegramRetryAfter
+
+    async def start(self):
+        self.current = await self.message.answer(PLACEHOLDER)
+        self.last_edit = time.monotonic()
+
+    async def feed(self, delta):
+        self.text += delta
+        self.full_text += delta
+
+        # Переносим излишек в новое сообщение
+        while len(self.text) > TELEGRAM_TEXT_LIMIT:
+            head = split_text(self.text)[0]
+            await self._edit(head, force=True)
+            # Хвост берём из исходного текста: склейка остальных частей split_text слепила бы слова на стыках
+            self.text = self.text[len(head):].lstrip()
+            self.current = await self.message.answer(self.text[:TELEGRAM_TEXT_LIMIT] or PLACEHOLDER)
+            self.shown = self.text[:TELEGRAM_TEXT_LIMIT]
+            self.last_edit = time.monotonic()
+
+        now = time.monotonic()
+        if now - self.last_edit >= self.interval and len(self.text) - len(self.shown) >= self.min_chars:
+            await self._edit(self.text)
+
+    async def finish(self):
+        if not self.text.strip():
+            self.text = EMPTY_ANSWER
+        await self._edit(self.text, force=True)
+
+    async def _edit(self, text, force=False):
+        if text == self.shown:
+            return
+        now = time.monotonic()
+        if now < self.next_allowed:
+            if not force:
+                return
+            await asyncio.sleep(self.next_allowed - now)
+
+        try:
+            await self.message.bot.edit_message_text(
+                text, chat_id=self.current.chat.id, message_id=self.current.message_id
+            )
+            self.shown = text
+        except TelegramRetryAfter as e:
+            self.next_allowed = time.monotonic() + e.retry_after
+            if force:
+                await self._edit(text, force=True)
+        except TelegramBadRequest as e:
+            # "message is not modified" и подобное не критично
+            logging.warning(f"Не удалось отредактировать сообщение: {e}")
+        self.last_edit = time.monotonic()
+
+
+async def answer_ai(message: Message, content):
+    """Отвечает на сообщение ответом ИИ: потоково или одним сообщением, в зависимости от настроек."""
+    if not AI_STREAMING:
+        response_text = await general(content) or EMPTY_ANSWER
+        for part in split_text(response_text):
+            await message.answer(part)
+        return response_text
+
+    reply = StreamingReply(message)
+    await reply.start()
+    try:
+        async for delta in general_stream(content):
+            await reply.feed(delta)
+    except asyncio.CancelledError:
+        # Пользователь прислал новый вопрос (AI_QUEUE_POLICY=latest) или бот останавливается
+        reply.text += "\n\n⏹ Ответ прерван."
+        await reply.finish()
+        raise
+    except Exception:
+        if not reply.text:
+            reply.text = "❌ Ошибка при получении ответа от ИИ."
+        await reply.finish()
+        raise
+    await reply.finish()
+    return reply.full_text
@@ -0,0 +1,134 @@
+"""Фоновые задачи процесса под присмотром и общий дедлайн остановки.
+
+Задачи, которые живут дольше хендлера (рассылка и подобные), запускаются через supervisor.spawn:
+у них есть имя, на них держится ссылка (иначе сборщик мусора может удалить задачу посреди работы),
+ошибка попадает в лог, а число одновременно работающих задач одной группы ограничено.
+
+При остановке supervisor.stopping становится True: новые задачи не запускаются, долгие задачи
+проверяют флаг между шагами и выходят на чекпоинте. drain() ждёт их до дедлайна, остальные отменяет.
+"""
+from dotenv import load_dotenv
+
+from app.metrics import Gauge
+
+import asyncio
+import logging
+import os
+import time
+
+load_dotenv()
+
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))  # Сколько дорабатываем после остановки приёма апдейтов
+TASK_GROUP_LIMITS = {
+    "broadcast": 1,  # Рассылка одна на процесс (и одна на кластер — под замком)
+}
+
+
+class Deadline:
+    """Один дедлайн на все шаги остановки: каждый берёт столько, сколько осталось."""
+
+    def __init__(self, seconds):
+        self.until = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.until - time.monotonic())
+
+
+class TaskSupervisor:
+    def __init__(self, limits=None):
+        self.limits = dict(TASK_GROUP_LIMITS if limits is None else limits)  # группа -> задач одновременно
+        self._semaphores = {}
+        self._tasks = set()
+        self.stopping = False
+
+        self.spawned = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def _semaphore(self, group):
+        if group not in self.limits:
+            return None
+        if group not in self._semaphores:
+            self._semaphores[group] = asyncio.Semaphore(self.limits[group])
+        return self._semaphores[group]
+
+    async def _guarded(self, coro, group):
+        semaphore = self._semaphore(group)
+        if semaphore is None:
+            return await coro
+        try:
+            await semaphore.acquire()
+        except asyncio.CancelledError:
+            coro.close()  # Задачу отменили в очереди группы: корутина так и не стартовала
+            raise
+        try:
+            return await coro
+        finally:
+            semaphore.release()
+
+    def spawn(self, coro, name: str, group: str = None):
+        """Запускает корутину как задачу name. Во время остановки не запускает и возвращает None."""
+        if self.stopping:
+            coro.close()
+            self.rejected += 1
+            logging.warning(f"Задача {name} не запущена: процесс останавливается")
+            return None
+        task = asyncio.create_task(self._guarded(coro, group), name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_done)
+        self.spawned += 1
+        return task
+
+    def _on_done(self, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            self.cancelled += 1
+        elif task.exception() is not None:
+            self.failed += 1
+            logging.error(f"Фоновая задача {task.get_name()} упала: {task.exception()!r}")
+
+    def running(self):
+        return sorted(task.get_name() for task in self._tasks)
+
+    async def drain(self, timeout=SHUTDOWN_TIMEOUT):
+        """Больше не запускаем задачи, ждём текущие до timeout, остальные отменяем."""
+        self.stopping = True
+        tasks = set(self._tasks)
+        if not tasks:
+            return
+        logging.info(f"Ждём фоновые задачи: {', '.join(self.running())}")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logging.warning(f"Не дождались за {timeout:.0f} с, отменяем: {', '.join(t.get_name() for t in pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "running": len(self._tasks),
+            "spawned": self.spawned,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
+
+
+supervisor = TaskSupervisor()
+
+Gauge("background_tasks_running", "Фоновые задачи под присмотром supervisor", lambda: len(supervisor._tasks))
+
+
+async def drain_polling(dp, timeout):
+    """Ждёт хендлеры апдейтов, которые polling aiogram запустил задачами и не дожидается сам."""
+    tasks = set(dp._handle_update_tasks)  # aiogram 3.x хранит их здесь; после остановки polling новых не будет
+    if not tasks:
+        return
+    logging.info(f"Ждём завершения {len(tasks)} апдейтов...")
+    _, pending = await asyncio.wait(tasks, timeout=timeout)
+    if pending:
+        logging.warning(f"Не дождались {len(pending)} апдейтов за {timeout:.0f} с, отменяем.")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
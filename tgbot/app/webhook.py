@@ -0,0 +1,111 @@
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from dotenv import load_dotenv
+
+import asyncio
+import logging
+import os
+import signal
+
+load_dotenv()
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")  # Где слушает aiohttp
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес (https://example.com); пусто — вебхук не регистрируем
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Telegram присылает его в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))  # Сколько апдейтов обрабатываем одновременно
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))  # Сколько ждём текущие апдейты при остановке
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука с ограничением параллелизма и мягкой остановкой.
+
+    Telegram получает ответ сразу, апдейт обрабатывается в фоне. Когда все слоты заняты,
+    ответ задерживается — Telegram сам притормаживает отправку. При остановке новые
+    апдейты получают 503 (Telegram повторит их позже), а текущие дорабатывают до дедлайна.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, concurrency=WEBHOOK_CONCURRENCY,
+                 drain_timeout=WEBHOOK_DRAIN_TIMEOUT, **kwargs):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **kwargs)
+        self.concurrency = concurrency
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self._slots = asyncio.Semaphore(concurrency)
+
+    def register(self, app: web.Application, /, path: str, **kwargs):
+        # Сначала дожидаемся апдейтов, потом базовый класс закрывает сессию бота
+        app.on_shutdown.append(self._drain_on_shutdown)
+        super().register(app, path=path, **kwargs)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self.accepting:
+            return web.Response(status=503, text="Shutting down")
+        return await super().handle(request)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()  # Все слоты заняты — Telegram ждёт ответа и не шлёт новое
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    @property
+    def in_flight(self):
+        return len(self._background_feed_update_tasks)
+
+    async def drain(self):
+        self.accepting = False
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logging.info(f"Ждём завершения {len(tasks)} апдейтов...")
+        _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if pending:
+            logging.warning(f"Не дождались {len(pending)} апдейтов за {self.drain_timeout} с, отменяем.")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _drain_on_shutdown(self, app: web.Application):
+        await self.drain()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop: asyncio.Event = None):
+    """Поднимает aiohttp-сервер для вебхука и работает до SIGTERM/SIGINT (или до stop.set())."""
+    app = web.Application()
+    handler = BoundedRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET or None)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_CONCURRENCY, 100),  # Больше 100 Telegram не разрешает
+        )
+
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        await stop.wait()
+    finally:
+        # cleanup() перестаёт принимать соединения и вызывает on_shutdown: drain, затем закрытие сессии
+        await runner.cleanup()
@@ -0,0 +1,69 @@
+"""Хвост задержек ИИ с хеджированием и без.
+
+Два фейковых бэкенда (как два ключа одной модели): обычно отвечают за --latency, но с вероятностью
+--tail отвечают за --tail-latency. Хедж дублирует запрос на второй бэкенд, если первый не ответил
+за свой p95, — p99 падает ценой небольшого числа лишних запросов.
+
+Запуск из папки tgbot: python -m bench.ai_hedge [--requests 400] [--latency 0.2] [--tail 0.05] [--tail-latency 3]
+"""
+import argparse
+import asyncio
+import time
+
+import bench.common  # noqa: F401  Окружение для импорта app
+from bench.stubs import FakeMistral
+
+from app.ai_client import AIRouter, Backend
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run(router, method, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        messages = [{"role": "user", "content": f"Вопрос {i}"}]
+        async with semaphore:
+            started = time.perf_counter()
+            if method == "complete":
+                await router.complete(messages)
+            else:
+                async for _ in router.stream(messages):
+                    latencies.append(time.perf_counter() - started)  # Время до первого чанка
+                    break
+                return
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies
+
+
+async def main(requests, latency, tail, tail_latency, concurrency):
+    print(f"Запросов: {requests}, обычная задержка {latency} с, хвост {tail:.0%} по {tail_latency} с")
+    for method in ("complete", "stream"):
+        for hedge in (False, True):
+            fakes = [FakeMistral(latency=latency, tail_probability=tail, tail_latency=tail_latency) for _ in range(2)]
+            backends = [Backend(f"fake:{i}", "bench-model", fake) for i, fake in enumerate(fakes)]
+            router = AIRouter(backends, max_concurrency=concurrency * 2, hedge=hedge)
+            await run(router, method, 50, concurrency)  # Прогрев: набираем замеры для p95
+            sent_before = sum(fake.requests for fake in fakes)
+            latencies = await run(router, method, requests, concurrency)
+            extra = sum(fake.requests for fake in fakes) - sent_before - requests
+            print(f"{method:<9} хедж {'вкл ' if hedge else 'выкл'}  p50 {percentile(latencies, 0.5):.2f} с  "
+                  f"p95 {percentile(latencies, 0.95):.2f} с  p99 {percentile(latencies, 0.99):.2f} с  "
+                  f"лишних запросов {extra / requests:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tail", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=3.0)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.latency, args.tail, args.tail_latency, args.concurrency))
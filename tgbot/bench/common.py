@@ -0,0 +1,74 @@
+"""Общие заглушки для локальных бенчмарков: SQLite вместо Postgres, fakeredis вместо Redis.
+
+Импортировать до любых модулей `app`, потому что движок БД создаётся при импорте Models.
+Запуск из папки tgbot: python -m bench.<имя>
+"""
+import os
+import tempfile
+
+BENCH_DIR = tempfile.mkdtemp(prefix="tgbot-bench-")
+
+os.environ.setdefault("SQL_ALCHEMY_URL", f"sqlite+aiosqlite:///{BENCH_DIR}/bench.db")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("TOKEN", "42:BENCHMARK-TOKEN")
+os.environ.setdefault("AI_TOKEN", "bench")
+os.environ.setdefault("FSM_STORAGE", "memory")
+
+from fakeredis import FakeAsyncRedis  # noqa: E402
+from fakeredis._clients._async import FakeAsyncRedisConnection  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import app.redis_client as redis_client  # noqa: E402
+from app.database.Models import Base, engine  # noqa: E402
+
+
+class RoundTrips:
+    """Счётчик сетевых обращений к Redis и Postgres."""
+
+    def __init__(self):
+        self.redis = 0
+        self.db = 0
+
+    def reset(self):
+        self.redis = 0
+        self.db = 0
+
+
+round_trips = RoundTrips()
+
+
+class CountingConnection(FakeAsyncRedisConnection):
+    # Одна отправка = один сетевой круг: пайплайн уходит одним пакетом
+    async def send_packed_command(self, command, check_health=True):
+        round_trips.redis += 1
+        return await super().send_packed_command(command, check_health)
+
+
+def _autocommit(conn):
+    return conn.get_execution_options().get("isolation_level") == "AUTOCOMMIT"
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    round_trips.db += 1
+
+
+@event.listens_for(engine.sync_engine, "begin")
+def _count_begin(conn):
+    # asyncpg отправляет BEGIN отдельным запросом, в AUTOCOMMIT его нет
+    if not _autocommit(conn):
+        round_trips.db += 1
+
+
+@event.listens_for(engine.sync_engine, "commit")
+def _count_commit(conn):
+    if not _autocommit(conn):
+        round_trips.db += 1
+
+
+async def setup_stores():
+    """Создаёт таблицы в SQLite и подставляет fakeredis в app.redis_client."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    redis_client.redis = FakeAsyncRedis(decode_responses=True, connection_class=CountingConnection)
+    return redis_client.redis
@@ -0,0 +1,83 @@
+"""Фейковый Telegram для локальной проверки вебхука.
+
+Поднимает заглушку Bot API (отвечает ok на любой метод и запоминает вызовы),
+запускает бота в режиме webhook в этом же процессе (SQLite + fakeredis из bench.common)
+и отправляет ему апдейты POST-запросами, как это делает Telegram.
+
+Запуск из папки tgbot: python -m bench.fake_telegram
+"""
+import asyncio
+import os
+
+from aiohttp import ClientSession, web
+
+FAKE_API_PORT = 8081
+os.environ.setdefault("TELEGRAM_API_URL", f"http://127.0.0.1:{FAKE_API_PORT}")
+os.environ.setdefault("WEBHOOK_SECRET", "local-secret")
+os.environ.setdefault("WEBHOOK_HOST", "127.0.0.1")
+
+from bench.common import setup_stores  # noqa: E402
+from bench.stubs import make_update, telegram_result  # noqa: E402
+
+from app.database.Models import close_db  # noqa: E402
+
+
+class FakeTelegram:
+    """Заглушка Bot API: /bot<token>/<method>."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        payload = dict(await request.post()) if request.can_read_body else {}
+        self.calls.append((method, payload))
+        return web.json_response({"ok": True, "result": telegram_result(method, payload)})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+async def post_updates(url, secret, updates):
+    """Отправляет апдейты на вебхук так же, как Telegram, и возвращает коды ответов."""
+    async with ClientSession() as http:
+        async def post(update):
+            async with http.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}) as resp:
+                return resp.status
+        return await asyncio.gather(*(post(update) for update in updates))
+
+
+async def main():
+    await setup_stores()
+
+    fake = FakeTelegram()
+    fake_runner = web.AppRunner(fake.app())
+    await fake_runner.setup()
+    await web.TCPSite(fake_runner, "127.0.0.1", FAKE_API_PORT).start()
+
+    import run
+    from app.webhook import run_webhook, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+
+    stop = asyncio.Event()
+    server = asyncio.create_task(run_webhook(run.create_dispatcher(), run.create_bot(), stop=stop))
+    await asyncio.sleep(0.5)
+
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    updates = [make_update(i, 100 + i, "/start") for i in range(1, 51)]
+    statuses = await post_updates(url, WEBHOOK_SECRET, updates)
+    rejected = await post_updates(url, "wrong-secret", [make_update(999, 999, "/start")])
+
+    stop.set()  # Мягкая остановка: ждём все принятые апдейты
+    await server
+    await fake_runner.cleanup()
+    await close_db()
+
+    sent = sum(1 for method, _ in fake.calls if method == "sendMessage")
+    print(f"Ответы вебхука: {sorted(set(statuses))}, с неверным секретом: {rejected}")
+    print(f"Принято апдейтов: {len(updates)}, бот отправил сообщений: {sent}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
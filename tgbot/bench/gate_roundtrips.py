@@ -0,0 +1,94 @@
+"""Сколько раз одно сообщение ходит в Redis и Postgres до вызова ИИ: старая цепочка против UserGateMiddleware.
+
+«UserGate + L1» — тот же гейт с кешем в памяти процесса и RATE_LIMIT_BACKEND=local; первый вопрос
+все пользователи уже задали, как у большинства живых пользователей.
+
+Запуск из папки tgbot: python -m bench.gate_roundtrips
+"""
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from bench.common import round_trips, setup_stores
+
+from sqlalchemy import text
+
+from app.Middleware import UserGateMiddleware
+from app.cache import referral_counts
+from app.ratelimit import RateLimiter
+from app.database.Models import User, async_session_maker, close_db
+
+USERS = 200
+
+
+async def legacy_update(redis, user_id):
+    """Повторяет запросы старой цепочки AntiFlood -> UpdateLastActivity -> handle_message."""
+    # AntiFloodMiddleware
+    if not await redis.get(f"flood_{user_id}"):
+        await redis.setex(f"flood_{user_id}", 2, "1")
+
+    # UpdateLastActivityMiddleware
+    async with async_session_maker() as session:
+        user = await session.get(User, user_id)
+        if not user:
+            session.add(User(user_id=user_id, last_activity=datetime.now(timezone.utc)))
+        else:
+            user.last_activity = datetime.now(timezone.utc)
+        await session.commit()
+
+    # handle_message: пользователь, первый вопрос, check_referrals
+    async with async_session_maker() as session:
+        await session.get(User, user_id)
+        await redis.exists(f"first_question:{user_id}")
+        cached = await redis.get(f"user:{user_id}:referral_count")
+        if cached is None:
+            result = await session.execute(
+                text("SELECT COUNT(*) FROM referrals WHERE inviter_id = :user_id"), {"user_id": user_id}
+            )
+            await redis.setex(f"user:{user_id}:referral_count", 600, result.scalar() or 0)
+
+
+async def gate_update(gate, user_id):
+    async def answer(*args, **kwargs):
+        pass
+
+    async def handler(event, data):
+        return data["gate"]
+
+    event = SimpleNamespace(from_user=SimpleNamespace(id=user_id), answer=answer)
+    await gate(handler, event, {})
+
+
+async def measure(name, run, redis):
+    results = {}
+    for phase in ("холодный кеш", "тёплый кеш"):
+        await redis.delete(*[f"flood_{i}" for i in range(1, USERS + 1)])
+        round_trips.reset()
+        for user_id in range(1, USERS + 1):
+            await run(user_id)
+        results[phase] = (round_trips.redis / USERS, round_trips.db / USERS)
+
+    for phase, (redis_rt, db_rt) in results.items():
+        print(f"{name:<14} {phase:<13} Redis: {redis_rt:.1f}  Postgres: {db_rt:.1f}  всего: {redis_rt + db_rt:.1f}")
+
+
+async def main():
+    redis = await setup_stores()
+    gate = UserGateMiddleware()
+
+    print(f"Круги до сети на одно сообщение (среднее по {USERS} пользователям)")
+    await measure("до (3 шага)", lambda user_id: legacy_update(redis, user_id), redis)
+    await redis.flushall()
+    await measure("UserGate", lambda user_id: gate_update(gate, user_id), redis)
+
+    await redis.flushall()
+    referral_counts.clear()
+    for user_id in range(1, USERS + 1):
+        await redis.set(f"first_question:{user_id}", "asked")
+    local_gate = UserGateMiddleware(RateLimiter(backend="local"))
+    await measure("UserGate + L1", lambda user_id: gate_update(local_gate, user_id), redis)
+    await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,161 @@
+"""Нагрузочный прогон всего конвейера router без сети.
+
+Синтетические Update подаются прямо в Dispatcher (те же middleware и хендлеры, что в run.py),
+Bot работает через StubSession, Mistral заменён FakeMistral, Postgres — SQLite, Redis — fakeredis.
+Для каждого сценария печатает пропускную способность, p50/p99 и число обращений к БД, Redis
+и Bot API на один апдейт.
+
+Запуск из папки tgbot: python -m bench.load [--users 200] [--ai-latency 0.5] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import time
+
+os.environ.setdefault("BROADCAST_PROGRESS_INTERVAL", "3600")
+for _budget in ("COMMAND", "AI", "CALLBACK"):
+    os.environ.setdefault(f"RATE_{_budget}_BURST", "1000000")
+
+from bench.common import round_trips, setup_stores  # noqa: E402
+from bench.stubs import FakeMistral, StubSession, make_update  # noqa: E402
+
+from aiogram import Bot  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import app.ai_client  # noqa: E402
+from app.ai_client import AIRouter, Backend  # noqa: E402
+from app import broadcast  # noqa: E402
+from app.activity import activity_buffer  # noqa: E402
+from app.ai_queue import ai_queue  # noqa: E402
+from app.database.Models import close_db  # noqa: E402
+from app.events import event_log  # noqa: E402
+from app.outbox import outbox  # noqa: E402
+from app.tasks import supervisor  # noqa: E402
+
+ADMIN_ID = int(os.environ["ADMIN_ID"])
+_update_ids = itertools.count(1)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+class Scenario:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.updates = 0
+        self.elapsed = 0.0
+        self.db = self.redis = self.api = 0
+
+    def report(self):
+        n = self.updates or 1
+        return (
+            f"{self.name:<12} апдейтов {self.updates:>5}  {self.updates / self.elapsed:>8.1f}/с  "
+            f"p50 {percentile(self.latencies, 0.5) * 1000:>7.1f} мс  p99 {percentile(self.latencies, 0.99) * 1000:>7.1f} мс  "
+            f"БД {self.db / n:>5.2f}  Redis {self.redis / n:>5.2f}  Bot API {self.api / n:>5.2f}  на апдейт"
+        )
+
+
+class Harness:
+    def __init__(self, concurrency):
+        self.session = StubSession()
+        self.bot = Bot(token=os.environ["TOKEN"], session=self.session)
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.dp = None
+
+    async def setup(self):
+        await setup_stores()
+        import run  # Импортируем после подмены хранилищ: хендлеры и middleware — как в бою
+        self.dp = run.create_dispatcher()
+        activity_buffer.start()
+        ai_queue.start()
+        outbox.start(self.bot)
+        event_log.start()
+
+    async def teardown(self):
+        await ai_queue.stop()
+        await outbox.stop()
+        await activity_buffer.stop()
+        await event_log.stop()
+        await close_db()
+
+    async def feed(self, user_id, text):
+        update = Update.model_validate(make_update(next(_update_ids), user_id, text), context={"bot": self.bot})
+        async with self.concurrency:
+            started = time.perf_counter()
+            await self.dp.feed_update(self.bot, update)
+            return started, time.perf_counter() - started
+
+    async def settle(self):
+        """Ждём фоновую работу: очередь ИИ, outbox, рассылку."""
+        while ai_queue.stats()["active"] or ai_queue.stats()["waiting"] or outbox.stats()["queued"] or supervisor.running():
+            await asyncio.sleep(0.01)
+
+    async def run(self, name, messages, end_to_end=False):
+        """messages — список (user_id, text). end_to_end: задержка до последнего ответа в чат, а не до выхода из хендлера."""
+        scenario = Scenario(name)
+        round_trips.reset()
+        api_before = self.session.total_calls()
+        started = time.perf_counter()
+
+        results = await asyncio.gather(*(self.feed(user_id, text) for user_id, text in messages))
+        await self.settle()
+
+        scenario.elapsed = time.perf_counter() - started
+        scenario.updates = len(messages)
+        if end_to_end:
+            scenario.latencies = [
+                self.session.last_call.get(user_id, fed_at) - fed_at
+                for (user_id, _), (fed_at, _) in zip(messages, results)
+            ]
+        else:
+            scenario.latencies = [latency for _, latency in results]
+        scenario.db, scenario.redis = round_trips.db, round_trips.redis
+        scenario.api = self.session.total_calls() - api_before
+        return scenario
+
+
+async def main(users, ai_latency, concurrency):
+    app.ai_client.ai_client = AIRouter([Backend("fake:bench", "bench-model", FakeMistral(latency=ai_latency))])
+    harness = Harness(concurrency)
+    await harness.setup()
+
+    user_ids = list(range(1000, 1000 + users))
+    reports = []
+    try:
+        # Половина пользователей приходит по реферальной ссылке первой половины
+        start = [(user_id, "/start") for user_id in user_ids[:users // 2]]
+        start += [(user_id, f"/start {user_ids[i // 2]}") for i, user_id in enumerate(user_ids[users // 2:])]
+        reports.append(await harness.run("/start", start))
+
+        questions = [(user_id, f"Вопрос номер {user_id}: как приготовить борщ?") for user_id in user_ids]
+        reports.append(await harness.run("ИИ", questions, end_to_end=True))
+
+        await harness.run("подготовка", [(ADMIN_ID, "/start")])  # Админ в базе, кеш гейта тёплый
+        reports.append(await harness.run("статистика", [(ADMIN_ID, "📊 Статистика") for _ in range(50)]))
+        reports.append(await harness.run("аналитика", [(ADMIN_ID, "📈 Аналитика") for _ in range(10)]))
+
+        await harness.run("подготовка", [(ADMIN_ID, "📢 Рассылка")])
+        scenario = await harness.run("рассылка", [(ADMIN_ID, "Текст рассылки")])
+        copies = harness.session.calls["copyMessage"]
+        reports.append(scenario)
+    finally:
+        await harness.teardown()
+
+    print(f"Пользователей: {users}, задержка Mistral: {ai_latency} с, параллельно апдейтов: {concurrency}")
+    for report in reports:
+        print(report.report())
+    print(f"Рассылка: {copies} сообщений за {scenario.elapsed:.2f} с ({copies / scenario.elapsed:.0f}/с), "
+          f"БД {scenario.db / max(copies, 1):.3f} и Redis {scenario.redis / max(copies, 1):.3f} на получателя")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--ai-latency", type=float, default=0.5)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.users, args.ai_latency, args.concurrency))
@@ -0,0 +1,81 @@
+"""Задержка выдачи соединения из пула при конкурентных хендлерах.
+
+Каждый «хендлер» берёт соединение, делает один SELECT, держит соединение hold секунд (как хендлер,
+который между запросами ждёт Redis) и возвращает. Меряется ожидание от engine.connect() до готового
+соединения — при нехватке пула это очередь, при pre-ping ещё и лишний запрос на каждую выдачу.
+
+По умолчанию — SQLite из bench.common, на нём pre-ping почти бесплатен. Чтобы увидеть реальную цену
+круга до сервера, укажите Postgres или pgbouncer:
+    SQL_ALCHEMY_URL=postgresql+asyncpg://... python -m bench.pool_checkout
+
+Запуск из папки tgbot: python -m bench.pool_checkout [--checkouts 2000] [--hold 0.002]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import bench.common  # noqa: F401  SQLite во временной папке, если SQL_ALCHEMY_URL не задан
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database.engine import create_engine
+
+CONFIGS = [
+    # (название, фабрика движка). «По умолчанию» — как было до настройки: QueuePool 5+10 на Postgres, NullPool на SQLite
+    ("по умолчанию + pre-ping", lambda url: create_async_engine(url, pool_pre_ping=True)),
+    ("пул 5+10, без pre-ping", lambda url: create_engine(url, pool_size=5, max_overflow=10, pre_ping=False)),
+    ("пул 20+10, pre-ping", lambda url: create_engine(url, pool_size=20, max_overflow=10, pre_ping=True)),
+    ("пул 20+10, без pre-ping", lambda url: create_engine(url, pool_size=20, max_overflow=10, pre_ping=False)),
+]
+CONCURRENCY = (10, 50, 200)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def handler(engine, hold, waits):
+    started = time.perf_counter()
+    async with engine.connect() as conn:
+        waits.append(time.perf_counter() - started)
+        await conn.execute(text("SELECT 1"))
+        await asyncio.sleep(hold)
+
+
+async def run(engine, concurrency, checkouts, hold):
+    waits = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            await handler(engine, hold, waits)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited() for _ in range(checkouts)))
+    return waits, time.perf_counter() - started
+
+
+async def main(checkouts, hold):
+    url = os.environ["SQL_ALCHEMY_URL"]
+    print(f"БД: {url.split('://')[0]}, выдач на прогон: {checkouts}, удержание соединения: {hold * 1000:.1f} мс")
+    for name, factory in CONFIGS:
+        engine = factory(url)
+        try:
+            await run(engine, CONCURRENCY[0], CONCURRENCY[0], 0)  # Прогрев: пул открывает соединения
+            for concurrency in CONCURRENCY:
+                waits, elapsed = await run(engine, concurrency, checkouts, hold)
+                print(f"{name:<26} хендлеров {concurrency:>4}  выдача p50 {percentile(waits, 0.5) * 1000:>7.2f} мс  "
+                      f"p99 {percentile(waits, 0.99) * 1000:>7.2f} мс  {checkouts / elapsed:>7.0f} выдач/с")
+        finally:
+            await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--checkouts", type=int, default=2000)
+    parser.add_argument("--hold", type=float, default=0.002)
+    args = parser.parse_args()
+    asyncio.run(main(args.checkouts, args.hold))
@@ -0,0 +1,127 @@
+"""Ответы пользователям во время рассылки: прямые вызовы Bot API против SendScheduler.
+
+Заглушка Telegram отвечает 429, если бот шлёт больше --global-rate сообщений в секунду
+или больше одного в секунду в один чат (подряд можно три). Рассылка идёт параллельными пачками,
+как в app.broadcast; одновременно пользователи получают ответы из трёх сообщений.
+
+Запуск из папки tgbot: python -m bench.send_scheduler [--broadcast 300] [--chats 30]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+import bench.common  # noqa: F401  Окружение для импорта app
+from bench.stubs import StubSession, telegram_result
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.sender import BULK, SendScheduler, send_lane
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+class FloodingSession(StubSession):
+    """Telegram с лимитами: скользящее окно в секунду на бота и на каждый чат."""
+
+    def __init__(self, global_rate, chat_rate=1, chat_burst=3, **kwargs):
+        super().__init__(**kwargs)
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sent = deque()
+        self.per_chat = {}
+        self.flood_errors = 0
+
+    def _allowed(self, chat_id):
+        now = time.monotonic()
+        while self.sent and now - self.sent[0] > 1:
+            self.sent.popleft()
+        chat = self.per_chat.setdefault(chat_id, deque())
+        while chat and now - chat[0] > self.chat_burst / self.chat_rate:
+            chat.popleft()
+        if len(self.sent) >= self.global_rate or len(chat) >= self.chat_burst:
+            return False
+        self.sent.append(now)
+        chat.append(now)
+        return True
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        payload = method.model_dump(exclude_none=True)
+        self.calls[name] += 1
+        if "chat_id" in payload and not self._allowed(payload["chat_id"]):
+            self.flood_errors += 1
+            content = json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}})
+            return self.check_response(bot=bot, method=method, status_code=429, content=content).result
+        content = json.dumps({"ok": True, "result": telegram_result(name, payload)})
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+
+async def send_with_retry(coro_factory):
+    # Без планировщика каждый вызывающий сам спит на retry_after, как делали хендлеры раньше
+    for _ in range(10):
+        try:
+            return await coro_factory()
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def scenario(bot, broadcast, chats, scheduled):
+    async def broadcast_all():
+        with send_lane(BULK):
+            recipients = list(range(100_000, 100_000 + broadcast))
+            for i in range(0, len(recipients), 25):
+                chunk = recipients[i:i + 25]
+                await asyncio.gather(*(
+                    (bot.send_message(chat_id, "Рассылка") if scheduled
+                     else send_with_retry(lambda chat_id=chat_id: bot.send_message(chat_id, "Рассылка")))
+                    for chat_id in chunk
+                ))
+
+    reply_times = []
+
+    async def reply(chat_id):
+        await asyncio.sleep(random.uniform(0, 3))
+        started = time.perf_counter()
+        for part in range(3):
+            text = f"Ответ, часть {part + 1}"
+            if scheduled:
+                await bot.send_message(chat_id, text)
+            else:
+                await send_with_retry(lambda: bot.send_message(chat_id, text))
+        reply_times.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(broadcast_all(), *(reply(chat_id) for chat_id in range(1, chats + 1)))
+    return time.perf_counter() - started, reply_times
+
+
+async def main(broadcast, chats, global_rate):
+    print(f"Рассылка {broadcast} сообщений, одновременно ответы в {chats} чатов по 3 сообщения")
+    for scheduled in (False, True):
+        random.seed(1)
+        session = FloodingSession(global_rate)
+        bot = Bot(token="42:BENCHMARK-TOKEN", session=session)
+        if scheduled:
+            bot.session.middleware(SendScheduler(rate=global_rate))
+        total, reply_times = await scenario(bot, broadcast, chats, scheduled)
+        print(f"{'SendScheduler' if scheduled else 'напрямую':<14} всего {total:5.1f} с  "
+              f"ответ p50 {percentile(reply_times, 0.5):.2f} с  p95 {percentile(reply_times, 0.95):.2f} с  "
+              f"ответов 429: {session.flood_errors}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broadcast", type=int, default=300)
+    parser.add_argument("--chats", type=int, default=30)
+    parser.add_argument("--global-rate", type=int, default=30)
+    args = parser.parse_args()
+    asyncio.run(main(args.broadcast, args.chats, args.global_rate))
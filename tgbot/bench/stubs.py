@@ -0,0 +1,116 @@
+"""Заглушки внешних сервисов для бенчмарков: Bot API без сети и Mistral с настраиваемой задержкой."""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from aiogram.client.session.base import BaseSession
+
+BOT_ID = 42
+_message_ids = itertools.count(1000)
+
+
+def telegram_result(method, payload):
+    """Правдоподобный result для метода Bot API."""
+    if method == "getMe":
+        return {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+    if method in ("sendMessage", "editMessageText", "copyMessage", "sendDocument"):
+        chat_id = int(payload.get("chat_id", 0) or 0)
+        if method == "copyMessage":
+            return {"message_id": next(_message_ids)}
+        return {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": payload.get("text", ""),
+        }
+    return True
+
+
+def make_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        },
+    }
+
+
+class StubSession(BaseSession):
+    """Сессия бота без сети: запоминает исходящие вызовы и отвечает как Telegram."""
+
+    def __init__(self, latency=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.calls = Counter()  # метод -> сколько раз вызван
+        self.last_call = {}  # chat_id -> время последнего исходящего вызова в этот чат
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        payload = method.model_dump(exclude_none=True)
+        self.calls[name] += 1
+        if "chat_id" in payload:
+            self.last_call[payload["chat_id"]] = time.perf_counter()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = json.dumps({"ok": True, "result": telegram_result(name, payload)})
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeMistral:
+    """Провайдер для AIRouter вместо MistralProvider: тот же интерфейс complete/stream, ответ через latency секунд.
+
+    Поток отдаёт ответ chunks кусками равномерно за то же время, в последнем куске — usage.
+    С вероятностью tail_probability запрос отвечает за tail_latency — «хвост» медленных ответов.
+    """
+
+    def __init__(self, latency=0.5, chunks=8, answer="Это ответ для бенчмарка. " * 10,
+                 tail_probability=0.0, tail_latency=5.0):
+        self.latency = latency
+        self.chunks = chunks
+        self.answer = answer
+        self.tail_probability = tail_probability
+        self.tail_latency = tail_latency
+        self.requests = 0
+
+    def _latency(self):
+        return self.tail_latency if random.random() < self.tail_probability else self.latency
+
+    def _usage(self, messages):
+        prompt = sum(len(m["content"]) for m in messages) // 4
+        return SimpleNamespace(prompt_tokens=prompt, completion_tokens=len(self.answer) // 4)
+
+    async def complete(self, model, messages, **kwargs):
+        self.requests += 1
+        await asyncio.sleep(self._latency())
+        message = SimpleNamespace(content=self.answer)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=self._usage(messages))
+
+    async def stream(self, model, messages, **kwargs):
+        self.requests += 1
+        size = max(1, len(self.answer) // self.chunks)
+        parts = [self.answer[i:i + size] for i in range(0, len(self.answer), size)]
+        latency = self._latency()
+        if latency != self.latency:
+            await asyncio.sleep(latency)  # Медленный запрос долго стоит в очереди провайдера до первого токена
+            latency = self.latency
+        for i, part in enumerate(parts):
+            await asyncio.sleep(latency / len(parts))
+            usage = self._usage(messages) if i == len(parts) - 1 else None
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))], usage=usage)
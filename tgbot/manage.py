@@ -0,0 +1,112 @@
+"""Обслуживание базы из командной строки: выгрузка, загрузка и чистка users и referrals.
+
+    python manage.py export users users.csv.gz          # Postgres: COPY прямо в файл, .gz сжимается на лету
+    python manage.py export referrals - > referrals.csv
+    python manage.py import users users.parquet         # Parquet — нужен pyarrow
+    python manage.py prune --inactive-days 180 --blocked --archive archive/ [--dry-run]
+
+Загружать сначала users, потом referrals: рефералы на неизвестных пользователей отбрасываются.
+Архив чистки — те же CSV, что у export, их можно загрузить обратно через import.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from app.database.bulk import BULK_BATCH_SIZE, TABLES, export_table, import_table, prune_condition, prune_users
+from app.database.Models import close_db
+from app.redis_client import init_redis, close_redis
+from app.referrals import REFERRAL_COUNT_KEY, reconcile_referrals
+from app.cache import referral_counts
+from app.stats import TOTAL_USERS_KEY, backfill_stats
+
+load_dotenv()
+
+
+async def forget_users(user_ids):
+    """После удаления пачки: кеш рефералов в Redis и в L1 воркеров, общий счётчик пользователей."""
+    redis = await init_redis()
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(*[REFERRAL_COUNT_KEY.format(user_id=user_id) for user_id in user_ids])
+    pipe.decrby(TOTAL_USERS_KEY, len(user_ids))
+    await pipe.execute()
+    # Иначе гейт считал бы пользователя существующим; без кеша он пройдёт через upsert и создастся заново
+    await referral_counts.invalidate(*user_ids)
+
+
+async def export_command(args):
+    total = await export_table(args.table, args.path, args.format, args.batch_size)
+    print(f"Выгружено строк: {total}", file=sys.stderr)  # stdout может быть самим файлом выгрузки
+
+
+async def import_command(args):
+    loaded, inserted = await import_table(args.table, args.path, args.format, args.batch_size)
+    print(f"Прочитано строк: {loaded}, добавлено: {inserted}, пропущено (уже были или без пары): {loaded - inserted}")
+    if inserted and args.table == "users":
+        await backfill_stats()  # Общее число и регистрации по дням пересчитываются по таблице
+    if inserted and args.table == "referrals":
+        fixed = await reconcile_referrals()  # Счётчики пригласивших и их кеш
+        print(f"Исправлено счётчиков рефералов: {fixed}")
+
+
+async def prune_command(args):
+    keep = [int(os.getenv("ADMIN_ID"))] if os.getenv("ADMIN_ID") else []
+    condition = prune_condition(args.inactive_days, args.blocked, args.include_referred, keep)
+    total = await prune_users(condition, args.archive, args.batch_size, args.dry_run,
+                              on_batch=None if args.dry_run else forget_users)
+    if args.dry_run:
+        # Приглашённые удалённых пригласивших перестают быть чьими-то рефералами и тоже попадут под чистку
+        print(f"Под чистку попадает пользователей: не меньше {total}")
+        return
+    print(f"Удалено пользователей: {total}" + (f", архив в {args.archive}" if args.archive else ""))
+    if total and args.include_referred:
+        fixed = await reconcile_referrals()  # Пригласившие потеряли рефералов
+        print(f"Исправлено счётчиков рефералов: {fixed}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Выгрузить таблицу в CSV (можно .csv.gz) или Parquet")
+    export.add_argument("table", choices=sorted(TABLES))
+    export.add_argument("path", help="Файл или - для stdout")
+    export.add_argument("--format", choices=("csv", "parquet"), help="По умолчанию — по расширению файла")
+    export.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    export.set_defaults(handler=export_command)
+
+    load = commands.add_parser("import", help="Загрузить CSV или Parquet; существующие строки не меняются")
+    load.add_argument("table", choices=sorted(TABLES))
+    load.add_argument("path", help="Файл или - для stdin (только CSV)")
+    load.add_argument("--format", choices=("csv", "parquet"))
+    load.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    load.set_defaults(handler=import_command)
+
+    prune = commands.add_parser("prune", help="Архивировать и удалить неактивных и заблокировавших бота")
+    prune.add_argument("--inactive-days", type=int, help="Не писали боту столько дней")
+    prune.add_argument("--blocked", action="store_true", help="Заблокировали бота (по итогам рассылок)")
+    prune.add_argument("--include-referred", action="store_true",
+                       help="Удалять и приглашённых: у пригласивших уменьшатся счётчики")
+    prune.add_argument("--archive", help="Папка для архива удалённых строк (CSV.gz)")
+    prune.add_argument("--batch-size", type=int, default=1000)
+    prune.add_argument("--dry-run", action="store_true", help="Только посчитать")
+    prune.set_defaults(handler=prune_command)
+
+    args = parser.parse_args(argv)
+    if args.command == "prune" and args.inactive_days is None and not args.blocked:
+        parser.error("prune: укажите --inactive-days и/или --blocked")
+    return args
+
+
+async def main(args):
+    try:
+        await args.handler(args)
+    finally:
+        await close_redis()
+        await close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
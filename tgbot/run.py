@@ -3,36 +3,138 @@ import logging
 import os
 
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
 
 from dotenv import load_dotenv
 from app.handler import router
-from app.database.Models import init_db
-from app.Middleware import ErrorHandlerMiddleware, UpdateLastActivityMiddleware, AntiFloodMiddleware
-from app.redis_client import init_redis, close_redis
+from app.database.Models import close_db
+from app.database.migrations import init_db
+from app.Middleware import ErrorHandlerMiddleware, UserGateMiddleware, CallbackRateLimitMiddleware
+from app.redis_client import init_redis, close_redis, REDIS_URL
+from app.ai_client import start_ai_client, close_ai_client
+from app.activity import activity_buffer
+from app.ai_queue import ai_queue
+from app.referrals import referral_reconciler
+from app.cache import cache_invalidator
+from app.sender import send_scheduler
+from app.outbox import outbox
+from app.events import event_log, EventLogMiddleware
+from app.tasks import Deadline, SHUTDOWN_TIMEOUT, drain_polling, supervisor
+from app.metrics import MetricsMiddleware, start_metrics_server, METRICS_PORT
+from app.logs import setup_logging, stop_logging
+from app.broadcast import broadcast_watchdog, resume_broadcast
+from app.webhook import run_webhook
+from app.cluster import run_cluster
 
 load_dotenv()
 
-bot = Bot(token=os.getenv('TOKEN'))
-dp = Dispatcher()
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Свой Bot API сервер (или фейковый для локальных проверок)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "redis")  # redis — состояния общие для всех процессов, memory — только для одного
+WORKERS = int(os.getenv("WORKERS", "1"))  # Больше 1 — главный процесс принимает апдейты, воркеры их обрабатывают
 
-# Подключаем middleware
-dp.message.middleware(AntiFloodMiddleware(limit=2))
-dp.message.middleware(UpdateLastActivityMiddleware())
-dp.message.middleware(ErrorHandlerMiddleware())
 
+def create_bot():
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=os.getenv('TOKEN'), session=session)
+    bot.session.middleware(send_scheduler)  # Общий и по-чатовый темп отправок, приоритеты, повтор после 429
+    return bot
 
-async def main():
-    await init_db()  
-    await init_redis()  # Инициализация Redis
+
+def create_dispatcher():
+    storage = RedisStorage.from_url(REDIS_URL) if FSM_STORAGE == "redis" else MemoryStorage()
+    dp = Dispatcher(storage=storage)
+
+    # Подключаем middleware
+    dp.message.middleware(MetricsMiddleware("message"))  # Первым, чтобы мерить всё остальное
+    dp.message.middleware(UserGateMiddleware())  # Лимит частоты, last_activity и доступ за один проход
+    dp.message.middleware(EventLogMiddleware("message"))  # После гейта: в журнал попадает только пропущенное
+    dp.message.middleware(ErrorHandlerMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware("callback_query"))
+    dp.callback_query.middleware(CallbackRateLimitMiddleware())
+    dp.callback_query.middleware(EventLogMiddleware("callback"))
     dp.include_router(router)
+    return dp
+
+
+_metrics_runner = None
+
+
+async def startup(bot: Bot, init_schema=True, metrics_port=METRICS_PORT):
+    global _metrics_runner
+    if init_schema:
+        await init_db()
+    _metrics_runner = await start_metrics_server(metrics_port)  # /metrics, если задан порт
+    await init_redis()  # Инициализация Redis
+    await bot.me()  # aiogram запоминает профиль бота: дальше bot.me() не ходит в API
+    cache_invalidator.start()  # Подписка на инвалидацию L1 от других процессов
+    await start_ai_client()  # Один роутер ИИ на весь процесс, пул ключей из окружения и Redis
+    activity_buffer.start()  # Фоновая запись last_activity пачками
+    ai_queue.start()  # Общий пул воркеров для запросов к ИИ
+    referral_reconciler.start()  # Фоновая сверка счётчиков рефералов
+    outbox.start(bot)  # Уведомления после коммита
+    event_log.start()  # Журнал событий для аналитики пачками, секции и свёртка
+    await resume_broadcast(bot)  # Если прошлый процесс упал посреди рассылки, продолжаем её
+    broadcast_watchdog.start(bot)  # А если его замок ещё не истёк — подхватит сторож
+
+
+async def shutdown(dp: Dispatcher, bot: Bot, timeout=SHUTDOWN_TIMEOUT):
+    """Вызывается, когда приём апдейтов уже остановлен. Порядок: доработать, сбросить буферы, закрыть соединения."""
+    deadline = Deadline(timeout)
+    # 1. Доработка: хендлеры, начатые polling, ответы ИИ (и ждущие в очереди), фоновые задачи
+    await drain_polling(dp, deadline.remaining())
+    await ai_queue.stop(timeout=deadline.remaining())
+    await broadcast_watchdog.stop()  # До drain: сторож не должен запустить рассылку на остановке
+    await supervisor.drain(deadline.remaining())  # Рассылка выходит на чекпоинте
+    await referral_reconciler.stop()
+    # 2. Буферы: они пишут в Telegram, Redis и Postgres, поэтому до закрытия соединений
+    await outbox.stop()  # Досылаем накопленные уведомления
+    await activity_buffer.stop()  # Финальный сброс буфера
+    await event_log.stop()  # Дописываем журнал событий до закрытия базы
+    # 3. Соединения
+    await cache_invalidator.stop()
+    await close_ai_client()
+    await dp.storage.close()
+    await close_redis()
+    await close_db()  # engine.dispose()
+    await bot.session.close()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+
+
+async def receive_updates(dp: Dispatcher, bot: Bot):
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        await bot.delete_webhook()  # Иначе Telegram не отдаст апдейты через getUpdates
+        # Сессию закрывает shutdown: после остановки polling хендлеры и ИИ ещё дописывают ответы
+        await dp.start_polling(bot, close_bot_session=False)
+
+
+async def main():
+    bot = create_bot()
+    if WORKERS > 1:
+        # Схему создаём один раз до запуска воркеров, дальше главный процесс только раздаёт апдейты
+        await init_db()
+        await init_redis()
+        await run_cluster(bot, WORKERS, receive_updates)
+        return
+
+    dp = create_dispatcher()
+    await startup(bot)
     try:
-        await dp.start_polling(bot)
+        await receive_updates(dp, bot)
     finally:
-        await close_redis()
+        await shutdown(dp, bot)
 
 if __name__ == '__main__':
-#    logging.basicConfig(level=logging.INFO)
+    setup_logging()  # Файл логов пишет отдельный поток, хендлеры не ждут диск
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print('Закрываем эту шарманку')
\ No newline at end of file
+        print('Закрываем эту шарманку')
+    finally:
+        stop_logging()  # Дописываем очередь логов